@@ -0,0 +1,132 @@
+"""
+The benchmark cases: one per loader, join, aggregation, text scan and plot export on the hot paths of the
+analysis. Every case has a setup that prepares the arguments (not timed) and the function that is timed.
+The inputs come from the data_pipeline of src.build_figures, so the derived tables are computed once per
+dataset size and read from disk afterwards.
+"""
+
+import os
+
+from src.build_figures import data_pipeline, data_sources
+from src.data.some_dataloader import (
+    load_brewery_data,
+    load_rating_data,
+    load_rating_wo_text,
+    load_user_data,
+)
+from src.models.change_in_rating_distribution_mathplotlib import rating_evolution_with_rating_number
+from src.models.distance_analysis import calculate_distances, join_users_breweries_ratings
+from src.models.experience_words import (
+    calculate_style_distribution,
+    exp_words1,
+    get_experienced_users,
+    get_experienced_users2,
+    split_by_experience,
+)
+from src.models.foreign_beer import (
+    avg_rating_by_location,
+    filter_top_countries,
+    merge_users_and_ratings,
+    prepare_dataset,
+)
+from src.models.seasonality_analysis import (
+    filter_beer_style_ranking_by_amount,
+    plot_beer_style_ranking_by_amount,
+)
+from src.models.top10_beers_distribution import (
+    experience_threshold_sweep,
+    merge_top10_ratings,
+    top10beers_ratings,
+)
+
+
+class Case:
+    """
+    A benchmark case.
+    """
+
+    def __init__(self, name, group, func, setup):
+        """
+        :param name: the name of the case
+        :param group: loader, join, aggregation, text or export
+        :param func: the timed function
+        :param setup: function that gets the BenchmarkData and returns (args, kwargs) for func. It runs before
+        every repetition, so cases with functions that change their inputs can hand out fresh copies.
+        """
+        self.name = name
+        self.group = group
+        self.func = func
+        self.setup = setup
+
+
+class BenchmarkData:
+    """
+    Lazy access to the datasets of one generated data directory.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.paths = data_sources(data_dir)
+        self.pipeline = data_pipeline(cache_dir=os.path.join(data_dir, "pipeline"))
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name in self.paths:
+            return self.paths[name]
+        if name not in self.values:
+            self.values.update(self.pipeline.run(self.paths, targets=[name]))
+        return self.values[name]
+
+    def copy(self, name):
+        return self[name].copy()
+
+
+def _top50(data):
+    df_users_ratings = merge_users_and_ratings(data["rb_ratings_wo_text"], data["rb_users"])
+    return filter_top_countries(df_users_ratings, top_n=50)[0]
+
+
+def _exp_split(data):
+    if "exp_split" not in data.values:
+        exp_user_ids = get_experienced_users2(data["ba_ratings"], exp_words1)
+        data.values["exp_split"] = split_by_experience(data["ba_ratings"], exp_user_ids)
+    return data.values["exp_split"]
+
+
+CASES = [
+    # loaders
+    Case("load_rating_data", "loader", load_rating_data,
+         lambda d: ((d["ba_ratings_path"], d["rb_ratings_path"]), {})),
+    Case("load_rating_wo_text", "loader", load_rating_wo_text, lambda d: ((d["rb_ratings_path"],), {})),
+    Case("load_user_data", "loader", load_user_data, lambda d: ((d["ba_users_path"], d["rb_users_path"]), {})),
+    Case("load_brewery_data", "loader", load_brewery_data, lambda d: ((d["rb_brew_path"],), {})),
+    # joins
+    Case("merge_users_and_ratings", "join", merge_users_and_ratings,
+         lambda d: ((d["rb_ratings_wo_text"], d["rb_users"]), {})),
+    Case("join_users_breweries_ratings", "join", join_users_breweries_ratings,
+         lambda d: ((d.copy("rb_users"), d.copy("rb_brew"), d.copy("rb_ratings_wo_text")), dict(ratebeer=True))),
+    Case("prepare_dataset", "join", prepare_dataset,
+         lambda d: ((d["ba_users"], d["ba_ratings_wo_text"], "BeerAdvocate"), {})),
+    Case("merge_top10_ratings", "join", merge_top10_ratings, lambda d: ((d["rb_ratings"], d["rb_users"]), {})),
+    # aggregations
+    Case("avg_rating_by_location", "aggregation", avg_rating_by_location, lambda d: ((_top50(d),), {})),
+    Case("calculate_distances", "aggregation", calculate_distances,
+         lambda d: ((d.copy("ba_joined"), d["locations"]), {})),
+    Case("filter_beer_style_ranking_by_amount", "aggregation", filter_beer_style_ranking_by_amount,
+         lambda d: ((d.copy("rb_ratings"), d["rb_styles"]), {})),
+    Case("calculate_style_distribution", "aggregation", calculate_style_distribution,
+         lambda d: (_exp_split(d), {})),
+    Case("experience_threshold_sweep", "aggregation", experience_threshold_sweep,
+         lambda d: ((merge_top10_ratings(d["rb_ratings"], d["rb_users"]),), dict(by_beer=True))),
+    Case("rating_evolution_with_rating_number", "aggregation", rating_evolution_with_rating_number,
+         lambda d: ((d["rb_ratings"], "Rate Beer", os.path.join(d.data_dir, "plots", "rating_evolution.png")), {})),
+    # text scans
+    Case("get_experienced_users", "text", get_experienced_users, lambda d: ((d["ba_ratings"], exp_words1), {})),
+    Case("get_experienced_users2", "text", get_experienced_users2, lambda d: ((d["ba_ratings"], exp_words1), {})),
+    # plot exports (they write below the working directory, which is the data directory in the benchmarks)
+    Case("write_html", "export", plot_beer_style_ranking_by_amount,
+         lambda d: ((d["rb_ratings"], d["rb_styles"]), {})),
+    Case("savefig", "export", top10beers_ratings,
+         lambda d: ((d["rb_ratings"], d["rb_users"], "Rate Beer"),
+                    dict(path=os.path.join(d.data_dir, "plots", "top10.png")))),
+]
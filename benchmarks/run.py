@@ -0,0 +1,250 @@
+"""
+Runs the benchmark cases of benchmarks/cases.py on synthetic datasets of several sizes.
+
+    python -m benchmarks.run --sizes 10000 100000            # run everything, store results/<commit>.json
+    python -m benchmarks.run --only get_experienced_users2 --against main --tolerance 0.2
+    python -m benchmarks.run --list
+
+Every case runs in a fresh child process, so the peak RSS belongs to that case alone. We report the median
+wall time over the repetitions, the peak RSS during the timed part (on Linux the high-water mark is reset after
+the setup, elsewhere it includes the setup) and the ratings per second. With --against the results are compared
+to the stored results of another commit (or a json file), the exit code is 1 if a case got slower or needs more
+memory than the tolerance allows.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(REPO, "benchmarks", ".data")
+RESULTS_DIR = os.path.join(REPO, "benchmarks", "results")
+
+# differences below these are noise, no matter the tolerance
+MIN_SECONDS = 0.005
+MIN_RSS_MB = 2.0
+
+
+def dataset_dir(size, seed):
+    """
+    Generates the synthetic dataset of the given size once and reuses it afterwards.
+    :return: the data directory (laid out like src/data, plus data/locations.csv for distance_analysis)
+    """
+    from src.data.synthetic import generate
+
+    root = os.path.join(DATA_DIR, f"{size}-seed{seed}")
+    marker = os.path.join(root, ".complete")
+    if not os.path.exists(marker):
+        generate(root, size, seed, locations_path=os.path.join(root, "data", "locations.csv"))
+        open(marker, "w").close()
+    return root
+
+
+def run_case(name, data_dir, repeat):
+    """
+    Runs one case in the current process, called in the child.
+    :return: dict with the measurements
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from benchmarks.cases import CASES, BenchmarkData
+
+    case = next(c for c in CASES if c.name == name)
+    data = BenchmarkData(data_dir)
+    seconds = []
+    peak_rss_mb = 0.0
+    for _ in range(repeat):
+        args, kwargs = case.setup(data)
+        _reset_peak_rss()
+        start = time.perf_counter()
+        case.func(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+        peak_rss_mb = max(peak_rss_mb, _peak_rss_mb())
+        plt.close("all")
+    return {"seconds": seconds, "peak_rss_mb": peak_rss_mb}
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of the process to the current RSS (Linux only), so that the peak we read afterwards
+    belongs to the timed part. Elsewhere the peak also covers the setup.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def measure(name, size, seed, repeat, timeout):
+    """
+    Runs a case in a child process.
+    :return: the result row of the case
+    """
+    data_dir = dataset_dir(size, seed)
+    command = [
+        sys.executable, "-m", "benchmarks.run", "--child", name, "--data-dir", data_dir, "--repeat", str(repeat)
+    ]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO, os.environ.get("PYTHONPATH")])))
+    # the cases use relative paths (src/plots, data/locations.csv), so they run inside the data directory
+    completed = subprocess.run(command, cwd=data_dir, env=env, capture_output=True, text=True, timeout=timeout)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{completed.stderr[-2000:]}")
+    # the cases print a lot, the measurements are on the last line
+    measured = json.loads(completed.stdout.strip().splitlines()[-1])
+    median = statistics.median(measured["seconds"])
+    return {
+        "case": name,
+        "size": size,
+        "seconds": median,
+        "min_seconds": min(measured["seconds"]),
+        "repeat": repeat,
+        "peak_rss_mb": round(measured["peak_rss_mb"], 1),
+        "rows_per_second": size / median if median > 0 else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: the result rows of this run
+    :param baseline: the result rows of the baseline
+    :param tolerance: allowed relative slowdown / memory growth (0.1 = 10%)
+    :return: list of (case, size, metric, old, new) for every regression
+    """
+    old = {(r["case"], r["size"]): r for r in baseline}
+    regressions = []
+    for row in results:
+        base = old.get((row["case"], row["size"]))
+        if base is None:
+            continue
+        for metric, noise in [("seconds", MIN_SECONDS), ("peak_rss_mb", MIN_RSS_MB)]:
+            if row[metric] > base[metric] * (1 + tolerance) and row[metric] - base[metric] > noise:
+                regressions.append((row["case"], row["size"], metric, base[metric], row[metric]))
+    return regressions
+
+
+def _commit():
+    try:
+        sha = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=REPO).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty else "")
+
+
+def _baseline_path(against):
+    if os.path.isfile(against):
+        return against
+    sha = subprocess.run(
+        ["git", "rev-parse", "--short", against], cwd=REPO, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    return os.path.join(RESULTS_DIR, f"{sha}.json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the analysis.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="ratings per dataset")
+    parser.add_argument("--only", nargs="+", help="run only these cases")
+    parser.add_argument("--group", nargs="+", choices=["loader", "join", "aggregation", "text", "export"])
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per case, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds per case")
+    parser.add_argument("--out", default=None, help="result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--against", default=None, help="commit or result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_case(args.child, args.data_dir, args.repeat)))
+        return 0
+
+    from benchmarks.cases import CASES
+
+    cases = [
+        c for c in CASES
+        if (not args.only or c.name in args.only) and (not args.group or c.group in args.group)
+    ]
+    if args.list:
+        for c in cases:
+            print(f"{c.group:12} {c.name}")
+        return 0
+
+    results, failed = [], []
+    for size in args.sizes:
+        for c in cases:
+            try:
+                row = measure(c.name, size, args.seed, args.repeat, args.timeout)
+            except (RuntimeError, subprocess.TimeoutExpired) as e:
+                print(f"{c.name} ({size}): {e}")
+                failed.append((c.name, size))
+                continue
+            results.append(row)
+            print(
+                f"{c.name:40} {size:>11,} {row['seconds']:9.3f}s {row['peak_rss_mb']:9.1f} MB "
+                f"{row['rows_per_second'] or 0:>14,.0f} rows/s"
+            )
+
+    commit = _commit()
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    # runs of a subset of the cases update the stored results instead of replacing them
+    stored = {}
+    if os.path.exists(out):
+        with open(out) as f:
+            stored = {(r["case"], r["size"]): r for r in json.load(f)["results"]}
+    stored.update({(r["case"], r["size"]): r for r in results})
+    with open(out, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "results": list(stored.values()),
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {out}")
+
+    if args.against:
+        with open(_baseline_path(args.against)) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for case, size, metric, old, new in regressions:
+            print(f"REGRESSION {case} ({size}): {metric} {old:.3f} -> {new:.3f}")
+        print(f"{len(regressions)} regression(s) against {baseline['commit']} (tolerance {args.tolerance:.0%})")
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
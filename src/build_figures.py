@@ -0,0 +1,401 @@
+"""
+Headless build of all the figures of the site.
+
+    python -m src.build_figures              # rebuild all stale figures with one worker per core
+    python -m src.build_figures --list       # show the figures and the figure functions in src/models
+    python -m src.build_figures --only US_map US_map2 --force
+    python -m src.build_figures --copy-on-write --check-mutations   # pandas CoW, fail on changed input frames
+
+The shared data (ratings, users, breweries and the derived tables) comes from the data_pipeline and is
+computed once in the main process, intermediates that are still up to date are read from disk. The stale figures
+are then rendered in a pool of forked worker processes, which see the already loaded frames
+through copy-on-write memory instead of getting them pickled.
+"""
+
+import argparse
+import importlib
+import inspect
+import multiprocessing
+import os
+import pkgutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+matplotlib.use("Agg")  # no display in headless runs, has to happen before pyplot is imported
+
+import matplotlib.pyplot as plt
+
+import src.models
+from src.data.some_dataloader import (
+    load_brewery_data,
+    load_rating_data,
+    load_rating_wo_text,
+    load_user_data,
+)
+from src.models.change_in_rating_distribution_mathplotlib import (
+    rating_evolution_over_time,
+    rating_evolution_with_rating_number,
+)
+from src.models.distance_analysis import (
+    calculate_distances,
+    join_users_breweries_ratings,
+    plot_distance_ratings,
+    retrieve_location_data,
+)
+from src.models.experience_words import (
+    calculate_rating_difference_with_ci,
+    calculate_style_distribution,
+    exp_words1,
+    get_experienced_users2,
+    save_plot_combined_distribution_and_rating_difference_with_ci,
+    save_plot_separate_distribution_and_rating_difference_with_ci,
+    split_by_experience,
+    trajectories_by_experience,
+)
+from src.models.foreign_beer import (
+    accumulate_us2,
+    avg_rating_by_location,
+    filter_top_countries,
+    merge_users_and_ratings,
+    plot_avg_ratings_map,
+    plot_bar_chart,
+    plot_choropleth_map,
+    plot_mean_rating_by_location,
+    us_patriotism_pipeline,
+)
+from src.models.seasonality_analysis import (
+    plot_and_head_average_rating_per_month,
+    plot_beer_style_ranking_by_amount,
+    plot_beer_style_ranking_by_avg_score,
+)
+from src.models.top10_beers_distribution import top10beers_ratings
+from src.models.user_trajectories import user_trajectories
+from src.utils.backend import set_copy_on_write
+from src.utils.instrument import enable_mutation_check
+from src.utils.pipeline import Pipeline, Stage
+from src.utils.plot_registry import PlotRegistry
+
+
+def _unique_styles(df_ratings):
+    return df_ratings["style"].unique()
+
+
+def _world_avg(rb_users, rb_ratings_wo_text):
+    df_rb_users_us = accumulate_us2(rb_users, "location")
+    df_rb_users_ratings = merge_users_and_ratings(rb_ratings_wo_text, df_rb_users_us)
+    df_rb_users_ratings_top50, _ = filter_top_countries(df_rb_users_ratings, top_n=50)
+    return avg_rating_by_location(df_rb_users_ratings_top50)
+
+
+def _experienced_users(ba_ratings):
+    return get_experienced_users2(ba_ratings, exp_words1)
+
+
+def _experience_differences(ba_ratings, exp_user_ids):
+    df_exp, df_inexp = split_by_experience(ba_ratings, exp_user_ids)
+    plot_df, most_rated = calculate_style_distribution(df_exp, df_inexp)
+    rating_diff_df, dist_diff_df = calculate_rating_difference_with_ci(df_exp, df_inexp, most_rated)
+    return plot_df, rating_diff_df, dist_diff_df
+
+
+def data_sources(data_dir="src/data"):
+    """
+    :param data_dir: the directory with the BeerAdvocate and RateBeer folders
+    :return: the sources of the data_pipeline, i.e. the paths of all the csv files
+    """
+    return {
+        "ba_ratings_path": os.path.join(data_dir, "BeerAdvocate/BA_ratings.csv"),
+        "rb_ratings_path": os.path.join(data_dir, "RateBeer/RB_ratings.csv"),
+        "ba_users_path": os.path.join(data_dir, "BeerAdvocate/users.csv"),
+        "rb_users_path": os.path.join(data_dir, "RateBeer/users.csv"),
+        "ba_brew_path": os.path.join(data_dir, "BeerAdvocate/breweries.csv"),
+        "rb_brew_path": os.path.join(data_dir, "RateBeer/breweries.csv"),
+    }
+
+
+def data_pipeline(cache_dir="src/data/pipeline", max_workers=None):
+    """
+    All the data the figures depend on as one Pipeline: the loaders, the US analysis of foreign_beer and
+    the other derived tables. Every stage runs at most once per build and only if its inputs changed.
+    :param cache_dir: where the intermediates are stored
+    :param max_workers: the number of threads for independent stages
+    :return: the pipeline
+    """
+    stages = [
+        Stage(load_rating_data, ["ba_ratings_path", "rb_ratings_path"], ["ba_ratings", "rb_ratings"]),
+        Stage(load_user_data, ["ba_users_path", "rb_users_path"], ["ba_users", "rb_users"]),
+        Stage(load_brewery_data, ["ba_brew_path"], ["ba_brew"], name="load_ba_brewery_data"),
+        Stage(load_brewery_data, ["rb_brew_path"], ["rb_brew"], name="load_rb_brewery_data"),
+        Stage(load_rating_wo_text, ["ba_ratings_path"], ["ba_ratings_wo_text"], name="load_ba_rating_wo_text"),
+        Stage(load_rating_wo_text, ["rb_ratings_path"], ["rb_ratings_wo_text"], name="load_rb_rating_wo_text"),
+        Stage(_unique_styles, ["rb_ratings"], ["rb_styles"], persist=False),
+        Stage(_world_avg, ["rb_users", "rb_ratings_wo_text"], ["world_avg"]),
+        Stage(_experienced_users, ["ba_ratings"], ["ba_exp_user_ids"]),
+        Stage(
+            _experience_differences,
+            ["ba_ratings", "ba_exp_user_ids"],
+            ["experience_plot_df", "experience_rating_diff", "experience_dist_diff"],
+        ),
+        # the per-user rating drift, persisted once and shared by the analyses that compare groups of users
+        Stage(user_trajectories, ["ba_ratings_wo_text"], ["ba_trajectories"], name="trajectories_ba"),
+        Stage(user_trajectories, ["rb_ratings_wo_text"], ["rb_trajectories"], name="trajectories_rb"),
+        Stage(trajectories_by_experience, ["ba_trajectories", "ba_exp_user_ids"], ["experience_trajectories"]),
+        Stage(join_users_breweries_ratings, ["ba_users", "ba_brew", "ba_ratings_wo_text"], ["ba_joined"],
+              name="join_ba", params=dict(ratebeer=False)),
+        Stage(join_users_breweries_ratings, ["rb_users", "rb_brew", "rb_ratings_wo_text"], ["rb_joined"],
+              name="join_rb", params=dict(ratebeer=True)),
+        Stage(retrieve_location_data, ["ba_joined", "rb_joined"], ["locations"]),
+        Stage(calculate_distances, ["ba_joined", "locations"], ["ba_distances"], name="distances_ba"),
+        Stage(calculate_distances, ["rb_joined", "locations"], ["rb_distances"], name="distances_rb"),
+    ]
+    # the US analysis without its plot, the map is one of the figures below
+    stages += [s for s in us_patriotism_pipeline().stages.values() if s.outputs]
+    return Pipeline(stages, cache_dir, max_workers)
+
+
+# all the figures of the site: name -> function, names of its data inputs (datasets of the data_pipeline),
+# extra keyword arguments and the files it writes
+FIGURES = {
+    "average_rating_per_month": dict(
+        func=plot_and_head_average_rating_per_month,
+        inputs=["rb_ratings"],
+        outputs=["src/plots/average_rating_per_month.html"],
+    ),
+    "beer_style_ranking_by_amount": dict(
+        func=plot_beer_style_ranking_by_amount,
+        inputs=["rb_ratings", "rb_styles"],
+        outputs=["src/plots/beer_style_ranking_by_amount.html"],
+    ),
+    "beer_style_ranking_by_avg_score": dict(
+        func=plot_beer_style_ranking_by_avg_score,
+        inputs=["rb_ratings"],
+        outputs=["src/plots/beer_style_ranking_by_avg_score.html"],
+    ),
+    "world_avg_map": dict(
+        func=plot_mean_rating_by_location,
+        inputs=["world_avg"],
+        outputs=["src/plots/world_avg_map.html"],
+    ),
+    "bar_chart_avg_rating": dict(
+        func=plot_bar_chart,
+        inputs=["world_avg"],
+        outputs=["src/plots/bar_chart_avg_rating.html"],
+    ),
+    "choropleth_map_avg_rating": dict(
+        func=plot_choropleth_map,
+        inputs=["world_avg"],
+        outputs=["src/plots/choropleth_map_avg_rating.html"],
+    ),
+    "US_map": dict(
+        func=plot_avg_ratings_map,
+        inputs=["avg_ratings_per_location"],
+        kwargs=dict(large_map=False),
+        outputs=["src/plots/US_map.html"],
+    ),
+    "US_map2": dict(
+        func=plot_avg_ratings_map,
+        inputs=["avg_ratings_per_location"],
+        kwargs=dict(large_map=True),
+        outputs=["src/plots/US_map2.html"],
+    ),
+    "combined_distribution_and_rating_difference": dict(
+        func=save_plot_combined_distribution_and_rating_difference_with_ci,
+        inputs=["experience_plot_df", "experience_rating_diff", "experience_dist_diff"],
+        outputs=["src/plots/combined_distribution_and_rating_difference.html"],
+    ),
+    "distribution_and_rating_difference": dict(
+        func=save_plot_separate_distribution_and_rating_difference_with_ci,
+        inputs=["experience_plot_df", "experience_rating_diff", "experience_dist_diff"],
+        outputs=["src/plots/distribution_difference.html", "src/plots/rating_difference.html"],
+    ),
+    # the site's figures of the 10 most reviewed beer styles, with the threshold of 50 ratings given in the text
+    "top10styles_rate_beer": dict(
+        func=top10beers_ratings,
+        inputs=["rb_ratings", "rb_users"],
+        kwargs=dict(df_name="RateBeer", threshold=50, by="style", path="src/plots/imgs/top10styles_rate_beer.png"),
+        outputs=["src/plots/imgs/top10styles_rate_beer.png"],
+    ),
+    "top10styles_beer_advocate": dict(
+        func=top10beers_ratings,
+        inputs=["ba_ratings", "ba_users"],
+        kwargs=dict(
+            df_name="BeerAdvocate", threshold=50, by="style", path="src/plots/imgs/top10styles_beer_advocate.png"
+        ),
+        outputs=["src/plots/imgs/top10styles_beer_advocate.png"],
+    ),
+    "distance_rate_beer": dict(
+        func=plot_distance_ratings,
+        inputs=["rb_distances"],
+        kwargs=dict(ratebeer=True, path="src/plots/imgs/distance_rate_beer.png"),
+        outputs=["src/plots/imgs/distance_rate_beer.png"],
+    ),
+    "distance_beer_advocate": dict(
+        func=plot_distance_ratings,
+        inputs=["ba_distances"],
+        kwargs=dict(ratebeer=False, path="src/plots/imgs/distance_beer_advocate.png"),
+        outputs=["src/plots/imgs/distance_beer_advocate.png"],
+    ),
+}
+
+# the rating evolution plots exist for both datasets
+for _key, _name in [("rb", "Rate_Beer"), ("ba", "Beer_Advocate")]:
+    for _func in (rating_evolution_with_rating_number, rating_evolution_over_time):
+        _path = f"src/plots/imgs/{_func.__name__}_{_name}.png"
+        FIGURES[f"{_func.__name__}_{_name}"] = dict(
+            func=_func,
+            inputs=[f"{_key}_ratings"],
+            kwargs=dict(df_name=_name.replace("_", " "), path=_path),
+            outputs=[_path],
+        )
+
+
+def discover_figure_functions():
+    """
+    Finds all functions in src/models that write a figure (i.e. call write_html or savefig).
+    :return: dict "module.function" -> function
+    """
+    found = {}
+    for module_info in pkgutil.iter_modules(src.models.__path__):
+        module = importlib.import_module(f"src.models.{module_info.name}")
+        for name, func in inspect.getmembers(module, inspect.isfunction):
+            if func.__module__ != module.__name__:
+                continue  # imported from somewhere else
+            source = inspect.getsource(func)
+            if "write_html(" in source or "savefig(" in source:
+                found[f"{module_info.name}.{name}"] = func
+    return found
+
+
+def _arguments(figure, resolved):
+    return [resolved[name] for name in figure["inputs"]], figure.get("kwargs", {})
+
+
+# set by build() right before the worker processes are forked, the workers only read from it
+_shared_inputs = {}
+
+
+def _render(name):
+    """
+    Renders one figure inside a worker process.
+    :return: (name, error message or None, seconds)
+    """
+    figure = FIGURES[name]
+    start = time.perf_counter()
+    try:
+        args, kwargs = _arguments(figure, _shared_inputs)
+        figure["func"](*args, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        plt.close("all")
+    return name, error, time.perf_counter() - start
+
+
+def build(names=None, data_dir="src/data", jobs=None, force=False, registry=None):
+    """
+    Builds the given figures (all by default), skipping the ones that are up to date.
+    :param names: the names of the figures in FIGURES
+    :param data_dir: the directory with the BeerAdvocate and RateBeer folders
+    :param jobs: the number of worker processes (default: number of cores)
+    :param force: rebuild even if nothing changed
+    :param registry: the PlotRegistry used for the staleness check
+    :return: dict name -> error message for all the figures that failed
+    """
+    global _shared_inputs
+    names = list(FIGURES) if names is None else names
+    registry = PlotRegistry() if registry is None else registry
+    pipeline = data_pipeline()
+    sources = data_sources(data_dir)
+    failures = {}
+
+    # the dataset keys of the pipeline identify the inputs, so checking for stale figures doesn't load anything
+    keys = pipeline.keys(sources)
+    stale = {}
+    for name in names:
+        figure = FIGURES[name]
+        state = registry.state(
+            figure["func"],
+            kwargs=figure.get("kwargs", {}),
+            input_keys=[keys[data_name] for data_name in figure["inputs"]],
+        )
+        if force or registry.is_stale(name, figure["outputs"], state):
+            stale[name] = state
+        else:
+            registry.record(name, figure["outputs"], state, 0.0, rebuilt=False)
+            print(f"{name}: up to date")
+
+    # computing the shared data of the stale figures, every stage at most once
+    needed = sorted({data_name for name in stale for data_name in FIGURES[name]["inputs"]})
+    resolved = {}
+    try:
+        resolved = pipeline.run(sources, targets=needed)
+    except Exception:
+        # finding out which inputs are affected, the stages that succeeded are persisted by now
+        for data_name in needed:
+            try:
+                resolved.update(pipeline.run(sources, targets=[data_name]))
+            except Exception:
+                error = traceback.format_exc()
+                for name in list(stale):
+                    if data_name in FIGURES[name]["inputs"]:
+                        failures[name] = error
+                        del stale[name]
+
+    # rendering the figures in parallel, the workers inherit the data when they are forked
+    _shared_inputs = resolved
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        futures = [pool.submit(_render, name) for name in stale]
+        for future in as_completed(futures):
+            name, error, seconds = future.result()
+            if error is None:
+                registry.record(name, FIGURES[name]["outputs"], stale[name], seconds)
+                print(f"{name}: built in {seconds:.1f}s")
+            else:
+                failures[name] = error
+    _shared_inputs = {}
+
+    for name, error in failures.items():
+        print(f"{name}: FAILED\n{error}", file=sys.stderr)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds all the figures of the site.")
+    parser.add_argument("--only", nargs="+", choices=sorted(FIGURES), help="build only these figures")
+    parser.add_argument("--data-dir", default="src/data", help="directory with the datasets")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="rebuild up to date figures as well")
+    parser.add_argument("--list", action="store_true", help="list the figures and exit")
+    parser.add_argument("--copy-on-write", action="store_true", help="run pandas in Copy-on-Write mode")
+    parser.add_argument(
+        "--check-mutations", action="store_true", help="fail if a function changes one of its input frames (slow)"
+    )
+    args = parser.parse_args(argv)
+
+    if args.list:
+        covered = {figure["func"] for figure in FIGURES.values()}
+        for name, figure in FIGURES.items():
+            print(f"{name}: {figure['func'].__name__} -> {', '.join(figure['outputs'])}")
+        for name, func in discover_figure_functions().items():
+            if func not in covered and getattr(func, "__wrapped__", None) not in covered:
+                print(f"(not part of the build) {name}")
+        return 0
+
+    if args.copy_on_write:
+        set_copy_on_write()
+    if args.check_mutations:
+        enable_mutation_check()  # the worker processes inherit it
+    start = time.perf_counter()
+    failures = build(args.only, args.data_dir, args.jobs, args.force)
+    print(f"Done in {time.perf_counter() - start:.1f}s, {len(failures)} figure(s) failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""
+On-disk column store for the ratings tables.
+
+A store is a directory next to the csv (BA_ratings.csv -> BA_ratings.columns/) with one .npy file per column:
+numeric columns as they are (rating, date, beer_id, ...), string columns (user_name, style, ...) as int32 codes
+into a dictionary (<column>.dict.json, -1 for missing values). The text column is left out, it has its own store.
+The columns are opened with np.memmap, so opening a store costs nothing no matter its size and all the processes
+using the same store share the same physical pages through the page cache.
+
+    build_column_store("src/data/RateBeer/RB_ratings.csv")   # once, streams through the csv
+    df = ColumnStore("src/data/RateBeer/RB_ratings.columns").frame(["user_id", "date", "rating"])
+"""
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+META_NAME = "meta.json"
+FORMAT_VERSION = 1
+# room for the .npy header, it is written before we know the number of rows and rewritten at the end
+HEADER_BYTES = 128
+
+
+class ColumnStore:
+    """
+    Read access to a column store written by build_column_store.
+    """
+
+    def __init__(self, directory, mode="c"):
+        """
+        :param directory: the store directory
+        :param mode: the np.memmap mode: "c" (copy-on-write, writes to a frame only change the private copy of the
+        touched pages) or "r" (read-only, writes raise)
+        """
+        self.directory = directory
+        self.mode = mode
+        with open(os.path.join(directory, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta["rows"]
+        self.columns = list(self.meta["columns"])
+        self._dictionaries = {}
+
+    def column(self, name):
+        """
+        :param name: the column
+        :return: the values (numeric columns) or the codes (string columns), memory-mapped
+        """
+        if self.rows == 0:
+            # np.memmap can't map empty files
+            return np.empty(0, dtype=self.meta["columns"][name]["dtype"])
+        values = np.load(os.path.join(self.directory, name + ".npy"), mmap_mode=self.mode)
+        # a plain ndarray on the same memory, so the memmap subclass doesn't leak into the results
+        return values.view(np.ndarray)
+
+    def dictionary(self, name):
+        """
+        :param name: a string column
+        :return: the values of its codes, as pd.Index
+        """
+        if name not in self._dictionaries:
+            with open(os.path.join(self.directory, name + ".dict.json")) as f:
+                self._dictionaries[name] = pd.Index(json.load(f), dtype=object)
+        return self._dictionaries[name]
+
+    def is_coded(self, name):
+        """
+        :return: whether the column is stored as codes into a dictionary
+        """
+        return self.meta["columns"][name]["kind"] == "codes"
+
+    def frame(self, columns=None, strings="object"):
+        """
+        The store as a pandas df. The numeric columns are views on the memory-mapped files (no copy).
+        :param columns: the columns to load (default: all)
+        :param strings: how string columns are returned: "object" (the same as pd.read_csv), "category" (a
+        Categorical over the dictionary, much less memory) or "codes" (the memory-mapped codes, see dictionary)
+        :return: the df
+        """
+        if strings not in ("object", "category", "codes"):
+            raise ValueError(f"Unknown strings option {strings}, use object, category or codes")
+        data = {}
+        for name in columns or self.columns:
+            values = self.column(name)
+            if self.is_coded(name) and strings != "codes":
+                categorical = pd.Categorical.from_codes(values, categories=self.dictionary(name))
+                values = categorical if strings == "category" else np.asarray(categorical, dtype=object)
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+
+def column_store_path(csv_path):
+    """
+    :param csv_path: the path of a ratings csv
+    :return: the directory of its column store
+    """
+    return os.path.splitext(csv_path)[0] + ".columns"
+
+
+def _source_stats(csv_path):
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_current(directory, csv_path):
+    """
+    :return: whether the store exists and was built from the current version of the csv
+    """
+    try:
+        with open(os.path.join(directory, META_NAME)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("source") == _source_stats(csv_path)
+
+
+def _npy_header(dtype, rows):
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows,)})
+    # magic string, version 1.0 and the header length take 10 bytes, the header ends with a newline
+    header = header.ljust(HEADER_BYTES - 10 - 1) + "\n"
+    return np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class _ColumnWriter:
+    """
+    Appends the chunks of one column to its .npy file.
+    """
+
+    def __init__(self, path, kind, dtype):
+        self.path = path
+        self.kind = kind
+        self.dtype = dtype
+        self.rows = 0
+        self.codes = {}  # value -> code, for string columns
+        self.file = open(path, "wb")
+        self.file.write(_npy_header(dtype, 0))
+
+    def append(self, values):
+        if self.kind == "codes":
+            values = self._encode(values)
+        else:
+            values = values.to_numpy()
+            if values.dtype == object:
+                raise ValueError(
+                    f"Column {os.path.basename(self.path)[:-4]} has non-numeric values after row {self.rows}, "
+                    f"pass it in string_columns"
+                )
+            dtype = np.result_type(self.dtype, values.dtype)
+            if dtype != self.dtype:
+                self._widen(dtype)  # e.g. an int column with its first missing value
+            values = values.astype(self.dtype, copy=False)
+        self.file.write(np.ascontiguousarray(values).tobytes())
+        self.rows += len(values)
+
+    def _encode(self, values):
+        chunk_codes, uniques = pd.factorize(values)
+        lookup = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques):
+            lookup[i] = self.codes.setdefault(value, len(self.codes))
+        codes = np.full(len(chunk_codes), -1, dtype=np.int32)
+        found = chunk_codes >= 0
+        codes[found] = lookup[chunk_codes[found]]
+        return codes
+
+    def _widen(self, dtype):
+        self.file.flush()
+        old = np.fromfile(self.path, dtype=self.dtype, offset=HEADER_BYTES)
+        self.dtype = dtype
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(_npy_header(dtype, 0))
+        self.file.write(old.astype(dtype).tobytes())
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, self.rows))
+        self.file.close()
+        if self.kind == "codes":
+            with open(self.path[: -len(".npy")] + ".dict.json", "w") as f:
+                json.dump(list(self.codes), f)
+
+
+def build_column_store(csv_path, directory=None, chunksize=500_000, string_columns=(), progress=None):
+    """
+    Builds the column store of a ratings csv in one streaming pass (the memory needed depends on chunksize, not on
+    the size of the csv). The store is written to a temporary directory first and then moved into place, so readers
+    never see a half-written store.
+    :param csv_path: the ratings csv
+    :param directory: the store directory (default: column_store_path(csv_path))
+    :param chunksize: the number of rows per chunk
+    :param string_columns: columns to store as strings even if their values look numeric (the type of the other
+    columns is taken from the first chunk)
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: the store directory
+    """
+    directory = directory or column_store_path(csv_path)
+    source = _source_stats(csv_path)
+    # the kinds of the columns come from the first chunk, the string columns are then read as strings throughout
+    first = pd.read_csv(csv_path, nrows=chunksize, usecols=lambda col: col != "text")
+    strings = [
+        name for name in first.columns
+        if name in string_columns or first[name].dtype == object or isinstance(first[name].dtype, pd.StringDtype)
+    ]
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-" + os.path.basename(directory))
+    try:
+        writers = {
+            name: _ColumnWriter(
+                os.path.join(tmp_directory, name + ".npy"),
+                "codes" if name in strings else "numeric",
+                np.dtype(np.int32) if name in strings else first[name].dtype,
+            )
+            for name in first.columns
+        }
+        del first
+        with open(csv_path, "rb") as f, track(
+            progress, f"column store {os.path.basename(csv_path)}", total=source["size"], unit="bytes"
+        ) as tracker:
+            reader = pd.read_csv(
+                f, chunksize=chunksize, usecols=list(writers), dtype={name: str for name in strings}
+            )
+            for chunk in reader:
+                for name, writer in writers.items():
+                    writer.append(chunk[name])
+                tracker.update(f.tell() - tracker.done, rows=len(chunk))
+        for writer in writers.values():
+            writer.close()
+        rows = next(iter(writers.values())).rows if writers else 0
+        meta = {
+            "version": FORMAT_VERSION,
+            "rows": rows,
+            "source": source,
+            "columns": {name: {"kind": w.kind, "dtype": str(w.dtype)} for name, w in writers.items()},
+        }
+        with open(os.path.join(tmp_directory, META_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return directory
+
+
+instrument_module(__name__)
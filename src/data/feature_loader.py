@@ -0,0 +1,272 @@
+"""
+Out-of-core training batches from the feature table of the preference predictor (see build_feature_table).
+
+The table stays on disk. An epoch reads its parquet row groups (the blocks) in a shuffled order, a few of them ahead
+in background threads (pyarrow decodes without holding the GIL), keeps the rows of the split, and mixes the rows of
+consecutive blocks in a shuffle buffer before it cuts them into mini-batches. The batches are float32 NumPy arrays
+built straight from the Arrow columns, no DataFrame is created. Only the prefetched blocks and the buffer are in
+memory, so the table can be much larger than the RAM.
+
+The splits are deterministic: by user (a stable hash of the user decides, so all the ratings of a user are in the
+same split) or by time (the oldest ratings train, the newest test). The same seed and epoch give the same batches.
+
+    loader = FeatureLoader("src/data/features.parquet", split="train", split_by="user", batch_size=4096)
+    for epoch in range(10):
+        for X, y in loader.batches(epoch):
+            ...
+    X_valid, y_valid = FeatureLoader("src/data/features.parquet", split="valid").read_all()
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.utils.instrument import instrument_module
+
+SPLITS = ("train", "valid", "test")
+# the columns of the table that describe the rating but are no features
+NON_FEATURES = ("dataset", "row", "user_id", "beer_id", "brewery_id", "style", "date", "rating", "target")
+
+
+def _pyarrow_parquet():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("The feature loader needs the pyarrow package (pip install pyarrow)") from e
+    return pq
+
+
+def _numpy(column):
+    # an Arrow column as one numpy array, nulls become NaN
+    return column.to_numpy()
+
+
+def _is_numeric(arrow_type):
+    import pyarrow.types as types
+
+    return types.is_integer(arrow_type) or types.is_floating(arrow_type) or types.is_boolean(arrow_type)
+
+
+def _stable_hash(column, seed):
+    """
+    :return: a hash in [0, 1) of every value of an Arrow column, the same in every process and run
+    """
+    key = f"{seed:016d}"
+    hashes = []
+    for chunk in column.chunks:
+        if hasattr(chunk, "dictionary"):
+            # only the distinct values of the chunk are hashed, they are already unique
+            values = chunk.dictionary.to_numpy(zero_copy_only=False)
+            hashes.append(pd.util.hash_array(values, hash_key=key, categorize=False)[chunk.indices.to_numpy()])
+        else:
+            values = chunk.to_numpy(zero_copy_only=False)
+            hashes.append(pd.util.hash_array(values, hash_key=key))
+    return np.concatenate(hashes) / np.float64(2**64) if hashes else np.zeros(0)
+
+
+class FeatureLoader:
+    """
+    Shuffled float32 mini-batches of one split of the feature table, streamed from disk.
+    """
+
+    def __init__(
+        self,
+        path,
+        features=None,
+        target="target",
+        split="train",
+        split_by="user",
+        fractions=(0.8, 0.1, 0.1),
+        batch_size=1024,
+        shuffle=True,
+        buffer_size=200_000,
+        prefetch=4,
+        workers=None,
+        fill_nan=0.0,
+        drop_last=False,
+        seed=0,
+    ):
+        """
+        :param path: the parquet file of build_feature_table
+        :param features: the feature columns, in the order of the columns of X (default: all numeric columns but
+        NON_FEATURES)
+        :param target: the column of y. Rows where it is missing are left out.
+        :param split: train, valid, test or None for all the rows
+        :param split_by: "user" (every user is in exactly one split) or "time" (by the date of the rating)
+        :param fractions: the shares of train, valid and test (of the users, or of the ratings for time)
+        :param batch_size: rows per batch
+        :param shuffle: shuffle the blocks and the rows (False: the order of the table)
+        :param buffer_size: rows in the shuffle buffer, larger mixes the blocks better
+        :param prefetch: blocks read ahead
+        :param workers: threads reading the blocks (default: prefetch)
+        :param fill_nan: missing features (e.g. user_mean of a first rating) become this, None keeps NaN
+        :param drop_last: leave out the last, smaller batch of an epoch
+        :param seed: the seed of the shuffling and of the user split
+        """
+        if split not in SPLITS + (None,):
+            raise ValueError(f"Unknown split {split}, use one of {SPLITS} or None")
+        if split_by not in ("user", "time"):
+            raise ValueError(f"Unknown split_by {split_by}, use user or time")
+        pq = _pyarrow_parquet()
+        self.path = path
+        self.metadata = pq.ParquetFile(path).metadata
+        schema = pq.read_schema(path)
+        if features is None:
+            features = [
+                field.name
+                for field in schema
+                if field.name not in NON_FEATURES and field.name != target and _is_numeric(field.type)
+            ]
+        for name in list(features) + [target]:
+            if name not in schema.names:
+                raise ValueError(f"The feature table has no column {name}")
+            if not _is_numeric(schema.field(name).type):
+                raise ValueError(f"Column {name} is not numeric, it can't be part of a float32 batch")
+        self.features = list(features)
+        self.target = target
+        self.split = split
+        self.split_by = split_by
+        self.fractions = np.asarray(fractions, dtype=np.float64) / np.sum(fractions)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, batch_size)
+        self.prefetch = max(prefetch, 1)
+        self.workers = workers or self.prefetch
+        self.fill_nan = fill_nan
+        self.drop_last = drop_last
+        self.seed = seed
+        self._local = threading.local()
+        # the rows of every block that belong to the split, one bit per row, filled by the first epoch
+        self._kept = {}
+        self._date_bounds = self._time_bounds() if split is not None and split_by == "time" else None
+
+    @property
+    def n_blocks(self):
+        return self.metadata.num_row_groups
+
+    def _file(self):
+        # one ParquetFile per thread
+        if not hasattr(self._local, "file"):
+            self._local.file = _pyarrow_parquet().ParquetFile(self.path)
+        return self._local.file
+
+    def _time_bounds(self):
+        # the dates at which valid and test start, from the dates of all the rows that have a target
+        dates, targets = [], []
+        for block in range(self.n_blocks):
+            table = self._file().read_row_group(block, columns=["date", self.target])
+            dates.append(_numpy(table.column("date")))
+            targets.append(_numpy(table.column(self.target)).astype(np.float64))
+        dates = np.concatenate(dates)[~np.isnan(np.concatenate(targets))] if dates else np.zeros(0)
+        if not len(dates):
+            return np.zeros(2)
+        return np.quantile(dates, np.cumsum(self.fractions)[:2], method="lower")
+
+    def _split_mask(self, table):
+        if self.split is None:
+            return np.ones(table.num_rows, dtype=bool)
+        if self.split_by == "user":
+            # a user is in the split its hash falls into
+            position = _stable_hash(table.column("user_id"), self.seed)
+            bounds = np.r_[0.0, np.cumsum(self.fractions)]
+        else:
+            position = _numpy(table.column("date"))
+            bounds = np.r_[-np.inf, self._date_bounds, np.inf]
+        number = SPLITS.index(self.split)
+        return (position >= bounds[number]) & (position < bounds[number + 1])
+
+    def _read_block(self, block):
+        """
+        Reads one row group and converts the rows of the split, runs in the reader threads.
+        :return: (X, y) of the block
+        """
+        kept = self._kept.get(block)
+        columns = self.features + [self.target]
+        if self.split is not None and kept is None:
+            columns = columns + ["user_id" if self.split_by == "user" else "date"]
+        table = self._file().read_row_group(block, columns=list(dict.fromkeys(columns)))
+        y = _numpy(table.column(self.target)).astype(np.float32)
+        if kept is None:
+            keep = self._split_mask(table) & ~np.isnan(y)
+            self._kept[block] = np.packbits(keep)
+        else:
+            keep = np.unpackbits(kept, count=table.num_rows).astype(bool)
+        # column by column into a features × rows array (contiguous copies), the row selection of its transpose
+        # then gives the rows × features batch layout in one pass
+        columns = np.empty((len(self.features), table.num_rows), dtype=np.float32)
+        for j, name in enumerate(self.features):
+            columns[j] = _numpy(table.column(name))
+        if self.fill_nan is not None:
+            np.nan_to_num(columns, copy=False, nan=self.fill_nan)
+        rows = np.flatnonzero(keep)
+        return columns.T[rows], y[rows]
+
+    def _blocks(self, order):
+        """
+        The blocks in the given order, read by the thread pool with up to prefetch blocks ahead.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = queue.Queue()
+            blocks = iter(order)
+            for block in blocks:
+                pending.put(pool.submit(self._read_block, block))
+                if pending.qsize() >= self.prefetch:
+                    break
+            while not pending.empty():
+                result = pending.get().result()
+                block = next(blocks, None)
+                if block is not None:
+                    pending.put(pool.submit(self._read_block, block))
+                yield result
+
+    def batches(self, epoch=0):
+        """
+        One pass over the split.
+        :param epoch: the number of the epoch, every epoch has another (but reproducible) order
+        :return: generator of (X, y): X float32 (rows × features, in the order of self.features), y float32
+        """
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(self.n_blocks) if self.shuffle else np.arange(self.n_blocks)
+        buffer_X, buffer_y, buffered = [], [], 0
+        for X, y in self._blocks(order):
+            buffer_X.append(X)
+            buffer_y.append(y)
+            buffered += len(y)
+            if buffered < self.buffer_size:
+                continue
+            X, y = np.concatenate(buffer_X), np.concatenate(buffer_y)
+            if self.shuffle:
+                permutation = rng.permutation(len(y))
+                X, y = X[permutation], y[permutation]
+            # half of the buffer stays to be mixed with the next blocks
+            emit = (len(y) - self.buffer_size // 2) // self.batch_size * self.batch_size
+            for start in range(0, emit, self.batch_size):
+                yield X[start : start + self.batch_size], y[start : start + self.batch_size]
+            buffer_X, buffer_y, buffered = [X[emit:]], [y[emit:]], len(y) - emit
+        if buffered:
+            X, y = np.concatenate(buffer_X), np.concatenate(buffer_y)
+            if self.shuffle:
+                permutation = rng.permutation(len(y))
+                X, y = X[permutation], y[permutation]
+            end = len(y) // self.batch_size * self.batch_size if self.drop_last else len(y)
+            for start in range(0, end, self.batch_size):
+                yield X[start : start + self.batch_size], y[start : start + self.batch_size]
+
+    def __iter__(self):
+        return self.batches()
+
+    def read_all(self):
+        """
+        The whole split at once, in the order of the table (e.g. for a validation set that fits into memory).
+        :return: (X, y)
+        """
+        parts = list(self._blocks(range(self.n_blocks)))
+        if not parts:
+            return np.zeros((0, len(self.features)), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return np.concatenate([X for X, _ in parts]), np.concatenate([y for _, y in parts])
+
+
+instrument_module(__name__)
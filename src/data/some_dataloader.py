@@ -1,38 +1,70 @@
+import os
+
 import pandas as pd
 
+from src.data import column_store, text_index, text_store
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+
+def read_csv(path, progress=None, chunksize=200_000, **kwargs):
+    """
+    pd.read_csv that reports its progress. Without progress it is just pd.read_csv, with progress the file is
+    read in chunks and the bytes read so far are reported (the total is the file size, which gives the ETA).
+    :param path: the csv file
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :param chunksize: the number of rows per chunk
+    :param kwargs: passed on to pd.read_csv
+    :return: the loaded df
+    """
+    if progress is None:
+        return pd.read_csv(path, **kwargs)
+    chunks = []
+    with open(path, "rb") as f, track(
+        progress, f"load {os.path.basename(path)}", total=os.path.getsize(path), unit="bytes"
+    ) as tracker:
+        for chunk in pd.read_csv(f, chunksize=chunksize, **kwargs):
+            chunks.append(chunk)
+            tracker.update(f.tell() - tracker.done, rows=len(chunk))
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.read_csv(path, **kwargs)
+
 
-def load_rating_wo_text(path):
+def load_rating_wo_text(path, progress=None):
     """
     Load a ratings dataset without the text column
     :param path: the path to the ratings.csv
+    :param progress: None, True or a progress callback (see src.utils.progress)
     :return: the loaded dataframe without the text column
     """
-    return pd.read_csv(path, usecols=lambda col: col != "text")
+    return read_csv(path, progress, usecols=lambda col: col != "text")
 
 
 def load_user_data(
     ba_path="src/data/BeerAdvocate/users.csv",
     rb_path="src/data/RateBeer/users.csv",
+    progress=None,
 ):
     """
     Loads the users.csv for both datasets
     :param ba_path: Path to the BeerAdvocate users.csv
     :param rb_path: Path to the RateBeer users.csv
+    :param progress: None, True or a progress callback (see src.utils.progress)
     :return:
     """
-    df_ba_users = pd.read_csv(ba_path)
-    df_rb_users = pd.read_csv(rb_path)
+    df_ba_users = read_csv(ba_path, progress)
+    df_rb_users = read_csv(rb_path, progress)
     return df_ba_users, df_rb_users
 
 
-def load_brewery_data(brewery_path="./data/RateBeer/breweries.csv"):
+def load_brewery_data(brewery_path="./data/RateBeer/breweries.csv", progress=None):
     """
     Loading the brewery dataset.
     CAUTION: The location attribute is renamed to brewery_location.
     :param brewery_path: Path to the breweries.csv
+    :param progress: None, True or a progress callback (see src.utils.progress)
     :return: the brewery dataset in a pandas df
     """
-    df_brew = pd.read_csv(brewery_path)
+    df_brew = read_csv(brewery_path, progress)
     df_brew.rename(
         columns={"id": "brewery_id", "location": "brewery_location"}, inplace=True
     )
@@ -42,11 +74,63 @@ def load_brewery_data(brewery_path="./data/RateBeer/breweries.csv"):
 def load_rating_data(
     ba_path="src/data/BeerAdvocate/BA_ratings.csv",
     rb_path="src/data/RateBeer/RB_ratings.csv",
+    progress=None,
 ):
     """
     Loads rating data in pandas dataframes
+    :param progress: None, True or a progress callback (see src.utils.progress)
     :return: these dataframes
     """
-    df_ba_ratings = pd.read_csv(ba_path)
-    df_rb_ratings = pd.read_csv(rb_path)
+    df_ba_ratings = read_csv(ba_path, progress)
+    df_rb_ratings = read_csv(rb_path, progress)
     return df_ba_ratings, df_rb_ratings
+
+
+def load_rating_columns(path, columns=None, strings="object", progress=None):
+    """
+    Load a ratings dataset without the text column from its column store (see src.data.column_store).
+    The store is built next to the csv on first use and rebuilt whenever the csv changes. Afterwards loading is
+    almost free: the numeric columns are views on memory-mapped files, which all processes share.
+    :param path: the path to the ratings.csv
+    :param columns: the columns to load (default: all but the text)
+    :param strings: "object" (like load_rating_wo_text), "category" or "codes", see ColumnStore.frame
+    :param progress: None, True or a progress callback for building the store (see src.utils.progress)
+    :return: the loaded dataframe
+    """
+    store = column_store.column_store_path(path)
+    if not column_store.is_current(store, path):
+        column_store.build_column_store(path, store, progress=progress)
+    return column_store.ColumnStore(store).frame(columns, strings)
+
+
+def load_rating_texts(path, progress=None):
+    """
+    Opens the texts of a ratings dataset from their compressed store (see src.data.text_store), the counterpart of
+    load_rating_columns / load_rating_wo_text. The store is built next to the csv on first use and rebuilt whenever
+    the csv changes. The texts are only decompressed when they are read.
+    :param path: the path to the ratings.csv
+    :param progress: None, True or a progress callback for building the store (see src.utils.progress)
+    :return: the TextStore, its row ids are the index of the loaded ratings
+    """
+    store = text_store.text_store_path(path)
+    if not text_store.is_current(store, path):
+        text_store.build_text_store(path, store, progress=progress)
+    return text_store.TextStore(store)
+
+
+def load_text_index(path, progress=None):
+    """
+    Opens the inverted index over the texts of a ratings dataset (see src.data.text_index). The text store and the
+    index are built on first use and rebuilt whenever the csv changes.
+    :param path: the path to the ratings.csv
+    :param progress: None, True or a progress callback for building them (see src.utils.progress)
+    :return: the TextIndex, its row ids are the index of the loaded ratings
+    """
+    texts = load_rating_texts(path, progress)
+    index = text_index.text_index_path(path)
+    if not text_index.is_current(index, texts):
+        text_index.build_text_index(texts, index, progress=progress)
+    return text_index.TextIndex(index)
+
+
+instrument_module(__name__)
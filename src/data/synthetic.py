@@ -0,0 +1,464 @@
+"""
+Deterministic synthetic BeerAdvocate/RateBeer data, so the loaders and src/models can be run without the real
+multi-GB dumps (e.g. on CI boxes without network).
+
+    python -m src.data.synthetic --rows 100000 --out /tmp/beer          # 100K ratings per dataset
+    python -m src.data.synthetic --rows 100000000 --chunk-size 2000000   # the full scale, in bounded memory
+
+The files have the same layout as the real ones (data_dir/BeerAdvocate/BA_ratings.csv, users.csv,
+breweries.csv and the same for RateBeer/RB_*), so everything that takes a data_dir just works. Users, beers and
+breweries are drawn with a Zipf skew (a few users write most of the ratings, a few beers get most of them), the
+ratings are written chunk by chunk and the users only at the end, when we know how many ratings each one has.
+The same seed and chunk size always give the same files.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from src.models.experience_words import exp_words1
+from src.utils.evaluation_utils import US_STATES_CODES
+from src.utils.plot_export import atomic_write
+from src.utils.progress import track
+from src.utils.instrument import instrument_module
+
+# the 50 states and DC, the territories hardly ever show up in the real data
+US_STATES = list(US_STATES_CODES)[:51]
+COUNTRIES = [
+    "Canada",
+    "England",
+    "Germany",
+    "Belgium",
+    "Netherlands",
+    "Australia",
+    "Sweden",
+    "Denmark",
+    "Poland",
+    "Italy",
+    "Spain",
+    "France",
+    "Norway",
+    "Finland",
+    "Brazil",
+    "Scotland",
+    "Ireland",
+    "Czech Republic",
+    "Japan",
+    "Russia",
+    "Hungary",
+    "El Salvador",
+    "New Zealand",
+    "Switzerland",
+    "Austria",
+]
+STYLES = [
+    "American IPA",
+    "American Double / Imperial IPA",
+    "American Pale Ale (APA)",
+    "Russian Imperial Stout",
+    "American Double / Imperial Stout",
+    "Saison / Farmhouse Ale",
+    "American Porter",
+    "Fruit / Vegetable Beer",
+    "American Amber / Red Ale",
+    "Belgian Strong Dark Ale",
+    "Witbier",
+    "American Strong Ale",
+    "Hefeweizen",
+    "Tripel",
+    "German Pilsener",
+    "American Stout",
+    "Euro Pale Lager",
+    "Oatmeal Stout",
+    "Märzen / Oktoberfest",
+    "American Wild Ale",
+    "Pumpkin Ale",
+    "Winter Warmer",
+    "Doppelbock",
+    "English Bitter",
+    "Light Lager",
+]
+
+FILLER = [
+    "Poured from a bottle into a tulip glass.",
+    "Nice head that fades quickly.",
+    "Smells of citrus and pine.",
+    "Malty sweetness up front with a bitter finish.",
+    "Dark brown color, roasted malt and coffee.",
+    "Light body, very drinkable.",
+    "A bit too sweet for my taste.",
+    "Would definitely have this again.",
+    "Hazy golden color with a white head.",
+    "Notes of caramel, toffee and dark fruit.",
+    "Crisp and clean, a good summer beer.",
+    "Not much going on here.",
+]
+
+START_DATE = 1_000_000_000  # 2001-09-09
+END_DATE = 1_501_545_600  # 2017-08-01
+
+# the rating columns of both datasets, BA additionally has the review flag
+RATING_COLUMNS = [
+    "beer_name",
+    "beer_id",
+    "brewery_name",
+    "brewery_id",
+    "style",
+    "abv",
+    "date",
+    "user_name",
+    "user_id",
+    "appearance",
+    "aroma",
+    "palate",
+    "taste",
+    "overall",
+    "rating",
+    "text",
+]
+
+DATASETS = {
+    # name: (file prefix, share of US users)
+    "BeerAdvocate": ("BA", 0.85),
+    "RateBeer": ("RB", 0.35),
+}
+
+
+def zipf_cdf(n, exponent, rng):
+    """
+    :param n: the number of items
+    :param exponent: the Zipf exponent (~1 for real world popularity)
+    :param rng: the random generator, it shuffles which item gets which rank
+    :return: the cumulative distribution to sample item indices with np.searchsorted(cdf, rng.random(size))
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    weights = weights[rng.permutation(n)]
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample(cdf, size, rng):
+    """
+    :return: size item indices drawn from the distribution given by cdf
+    """
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side="right"), len(cdf) - 1)
+
+
+def random_locations(n, us_share, rng, missing_share=0.03):
+    """
+    :param n: the number of locations
+    :param us_share: the share of "United States, <State>" locations, the rest are countries
+    :param rng: the random generator
+    :param missing_share: the share of missing locations
+    :return: object array with the locations
+    """
+    states = np.array([f"United States, {state}" for state in US_STATES], dtype=object)
+    countries = np.array(COUNTRIES, dtype=object)
+    locations = np.where(
+        rng.random(n) < us_share,
+        states[sample(zipf_cdf(len(states), 0.8, rng), n, rng)],
+        countries[sample(zipf_cdf(len(countries), 1.0, rng), n, rng)],
+    )
+    locations[rng.random(n) < missing_share] = np.nan
+    return locations
+
+
+def text_pool(exp_words, rng, size=4096):
+    """
+    Pre-built review texts, the ratings only pick indices into them (building one string per rating
+    would dominate the generation time).
+    :return: (texts without experience words, texts with 1 to 3 experience words)
+    """
+    filler = np.array(FILLER, dtype=object)
+    plain, expert = [], []
+    for _ in range(size):
+        sentences = list(filler[rng.choice(len(filler), rng.integers(2, 5), replace=False)])
+        plain.append(" ".join(sentences))
+        words = rng.choice(exp_words, rng.integers(1, 4), replace=False)
+        for word in words:
+            sentences.insert(rng.integers(0, len(sentences) + 1), f"Some {word.lower()} in there.")
+        expert.append(" ".join(sentences))
+    return np.array(plain, dtype=object), np.array(expert, dtype=object)
+
+
+def generate_breweries(n_breweries, us_share, rng, html_share=0.1):
+    """
+    :param html_share: the share of locations that carry an html suffix like in the RateBeer dump
+    (see distance_analysis.remove_html_tags)
+    :return: df with the columns of breweries.csv (id, location, name, nbr_beers)
+    """
+    locations = random_locations(n_breweries, us_share, rng, missing_share=0)
+    ids = np.arange(n_breweries)
+    html = rng.random(n_breweries) < html_share
+    locations[html] = [
+        f'{location}<br><a href="http://www.brewery{i}.com" target="_blank">brewery{i}.com</a>'
+        for location, i in zip(locations[html], ids[html])
+    ]
+    return pd.DataFrame(
+        {"id": ids, "location": locations, "name": [f"Brewery {i}" for i in ids], "nbr_beers": 0}
+    )
+
+
+def generate_users(n_users, n_shared, us_share, prefix, rng, shared_rng):
+    """
+    The first n_shared users exist in both datasets (same user_name and location), like the users that are on
+    BeerAdvocate and RateBeer.
+    :return: df with user_id, user_name and location (the counts are added at the end)
+    """
+    locations = random_locations(n_users, us_share, rng)
+    # shared_rng is seeded the same for both datasets, so the shared users get the same location
+    locations[:n_shared] = random_locations(n_shared, 0.6, shared_rng)
+    names = np.array(
+        [f"user{i}" if i < n_shared else f"{prefix.lower()}_user{i}" for i in range(n_users)], dtype=object
+    )
+    if prefix == "BA":
+        # BeerAdvocate ids are strings made from the name, RateBeer ids are numbers
+        user_ids = np.array([f"{name}.{i}" for i, name in enumerate(names)], dtype=object)
+    else:
+        user_ids = np.arange(n_users)
+    return pd.DataFrame({"user_id": user_ids, "user_name": names, "location": locations})
+
+
+def generate_dataset(
+    dataset,
+    data_dir="src/data",
+    n_ratings=100_000,
+    seed=0,
+    chunk_size=1_000_000,
+    n_users=None,
+    n_beers=None,
+    n_breweries=None,
+    user_overlap=0.3,
+    exp_user_share=0.05,
+    exp_text_rate=0.6,
+    exp_word_rate=0.01,
+    review_rate=0.7,
+    zipf_exponent=1.05,
+    exp_words=exp_words1,
+    progress=None,
+):
+    """
+    Writes ratings, users and breweries of one dataset.
+    :param dataset: "BeerAdvocate" or "RateBeer"
+    :param data_dir: the files go to data_dir/<dataset>/
+    :param n_ratings: the number of ratings
+    :param seed: the seed, together with chunk_size it fully determines the output
+    :param chunk_size: the number of ratings generated and written at once (bounds the memory)
+    :param n_users: the number of users (default: one per 25 ratings)
+    :param n_beers: the number of beers (default: one per 30 ratings)
+    :param n_breweries: the number of breweries (default: one per 15 beers)
+    :param user_overlap: the share of users that also exist in the other dataset
+    :param exp_user_share: the share of (active enough) users that write like experienced users
+    :param exp_text_rate: the share of reviews of experienced users that contain experience words
+    :param exp_word_rate: the share of reviews of everybody else that contain experience words
+    :param review_rate: the share of BeerAdvocate ratings with a text (the review column)
+    :param zipf_exponent: the skew of the user activity and the beer popularity
+    :param exp_words: the vocabulary of the experienced users
+    :param progress: None, True or a progress callback (see src.utils.progress), reports the written ratings
+    :return: dict with the paths of the ratings, users and breweries files
+    """
+    prefix, us_share = DATASETS[dataset]
+    n_users = n_users or max(50, n_ratings // 25)
+    n_beers = n_beers or max(50, n_ratings // 30)
+    n_breweries = n_breweries or max(10, n_beers // 15)
+    n_shared = int(user_overlap * n_users)
+    # independent streams for the entities and every chunk, derived from the seed and the dataset
+    seeds = np.random.SeedSequence([seed, list(DATASETS).index(dataset)])
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    shared_rng = np.random.default_rng([seed, 1000])
+
+    breweries = generate_breweries(n_breweries, us_share, rng)
+    users = generate_users(n_users, n_shared, us_share, prefix, rng, shared_rng)
+
+    # beers: a brewery, a style, an abv and a quality that drives the ratings
+    beer_brewery = sample(zipf_cdf(n_breweries, 1.0, rng), n_beers, rng)
+    beer_style = sample(zipf_cdf(len(STYLES), 0.7, rng), n_beers, rng)
+    beer_abv = np.round(np.clip(rng.normal(6.5, 2.0, n_beers), 2.5, 15), 1)
+    beer_quality = rng.normal(3.8, 0.35, n_beers)
+    beer_names = np.array([f"Beer {i}" for i in range(n_beers)], dtype=object)
+    breweries["nbr_beers"] = np.bincount(beer_brewery, minlength=n_breweries)
+
+    user_cdf = zipf_cdf(n_users, zipf_exponent, rng)
+    beer_cdf = zipf_cdf(n_beers, zipf_exponent, rng)
+    user_bias = rng.normal(0, 0.25, n_users)
+    # only users with enough ratings can show up as experienced in get_experienced_users2
+    expected = np.diff(user_cdf, prepend=0) * n_ratings
+    active = np.flatnonzero(expected >= 10)
+    experienced = np.zeros(n_users, dtype=bool)
+    experienced[rng.choice(active, int(exp_user_share * len(active)), replace=False)] = True
+    plain_texts, expert_texts = text_pool(exp_words, rng)
+
+    styles = np.array(STYLES, dtype=object)
+    brewery_names = breweries["name"].to_numpy()
+    user_names = users["user_name"].to_numpy()
+    user_ids = users["user_id"].to_numpy()
+    nbr_ratings = np.zeros(n_users, dtype=np.int64)
+    nbr_reviews = np.zeros(n_users, dtype=np.int64)
+    first_date = np.full(n_users, END_DATE, dtype=np.int64)
+
+    directory = os.path.join(data_dir, dataset)
+    paths = {
+        "ratings": os.path.join(directory, f"{prefix}_ratings.csv"),
+        "users": os.path.join(directory, "users.csv"),
+        "breweries": os.path.join(directory, "breweries.csv"),
+    }
+
+    def write_ratings(f):
+        with track(progress, f"generate {prefix}_ratings.csv", total=n_ratings) as tracker:
+            for chunk_index, start in enumerate(range(0, n_ratings, chunk_size)):
+                size = min(chunk_size, n_ratings - start)
+                chunk_rng = np.random.default_rng(seeds.spawn(1)[0])
+                df_chunk = rating_chunk(size, chunk_rng)
+                # pyarrow's csv writer is several times faster than to_csv, which would dominate the run time
+                pa_csv.write_csv(
+                    pa.Table.from_pandas(df_chunk, preserve_index=False),
+                    f,
+                    pa_csv.WriteOptions(include_header=chunk_index == 0),
+                )
+                tracker.update(size)
+
+    def rating_chunk(size, chunk_rng):
+        user = sample(user_cdf, size, chunk_rng)
+        beer = sample(beer_cdf, size, chunk_rng)
+        # more ratings in later years, like on the real sites
+        date = (START_DATE + (END_DATE - START_DATE) * np.sqrt(chunk_rng.random(size))).astype(np.int64)
+        score = beer_quality[beer] + user_bias[user] + chunk_rng.normal(0, 0.45, size)
+        aspects = {
+            name: np.clip(score + chunk_rng.normal(0, 0.3, size), 1, 5)
+            for name in ["appearance", "aroma", "palate", "taste", "overall"]
+        }
+        if prefix == "BA":
+            # BeerAdvocate scores are given in quarter steps, the rating is a weighted mean of them
+            aspects = {name: np.round(values * 4) / 4 for name, values in aspects.items()}
+            weights = {"appearance": 0.06, "aroma": 0.24, "palate": 0.1, "taste": 0.4, "overall": 0.2}
+            rating = np.round(sum(weights[name] * aspects[name] for name in weights), 2)
+        else:
+            # RateBeer: appearance and palate out of 5, aroma and taste out of 10, overall out of 20
+            scales = {"appearance": 1, "aroma": 2, "palate": 1, "taste": 2, "overall": 4}
+            aspects = {name: np.round(aspects[name] * scales[name]).astype(int) for name in scales}
+            rating = np.round(sum(aspects.values()) / 10, 1)
+
+        has_exp_words = chunk_rng.random(size) < np.where(experienced[user], exp_text_rate, exp_word_rate)
+        pool_index = chunk_rng.integers(0, len(plain_texts), size)
+        text = np.where(has_exp_words, expert_texts[pool_index], plain_texts[pool_index])
+        review = chunk_rng.random(size) < review_rate if prefix == "BA" else np.ones(size, dtype=bool)
+        text[~review] = np.nan
+
+        nbr_ratings[:] += np.bincount(user, minlength=n_users)
+        nbr_reviews[:] += np.bincount(user[review], minlength=n_users)
+        np.minimum.at(first_date, user, date)
+
+        df_chunk = pd.DataFrame(
+            {
+                "beer_name": beer_names[beer],
+                "beer_id": beer,
+                "brewery_name": brewery_names[beer_brewery[beer]],
+                "brewery_id": beer_brewery[beer],
+                "style": styles[beer_style[beer]],
+                "abv": beer_abv[beer],
+                "date": date,
+                "user_name": user_names[user],
+                "user_id": user_ids[user],
+                **aspects,
+                "rating": rating,
+                "text": text,
+            },
+            columns=RATING_COLUMNS,
+        )
+        if prefix == "BA":
+            df_chunk["review"] = review
+        return df_chunk
+
+    atomic_write(paths["ratings"], write_ratings, binary=True)
+    atomic_write(paths["breweries"], lambda f: breweries.to_csv(f, index=False), binary=False)
+
+    # the users are written last, their counts come from all the chunks
+    users.insert(0, "nbr_ratings", nbr_ratings)
+    if prefix == "BA":
+        users.insert(1, "nbr_reviews", nbr_reviews)
+    users.insert(len(users.columns) - 1, "joined", np.where(nbr_ratings > 0, first_date - 86400, np.nan))
+    atomic_write(paths["users"], lambda f: users.to_csv(f, index=False), binary=False)
+    return paths
+
+
+def generate_locations(path="data/locations.csv", seed=0):
+    """
+    Writes made up coordinates for all the locations, so that distance_analysis.retrieve_location_data finds
+    them on disk instead of asking the geocoding service.
+    :param path: where distance_analysis looks for the file
+    :param seed: the seed
+    """
+    rng = np.random.default_rng([seed, 2000])
+    states = [f"United States, {state}" for state in US_STATES]
+    df_locations = pd.DataFrame(
+        {
+            "location": states + COUNTRIES,
+            "latitude": np.r_[rng.uniform(25, 49, len(states)), rng.uniform(-40, 65, len(COUNTRIES))],
+            "longitude": np.r_[rng.uniform(-124, -67, len(states)), rng.uniform(-100, 150, len(COUNTRIES))],
+        }
+    )
+    atomic_write(path, lambda f: df_locations.to_csv(f, index=False), binary=False)
+
+
+def generate(data_dir="src/data", n_ratings=100_000, seed=0, locations_path=None, **kwargs):
+    """
+    Writes both datasets (see generate_dataset for the kwargs).
+    :param data_dir: the files go to data_dir/BeerAdvocate and data_dir/RateBeer
+    :param n_ratings: the number of ratings per dataset
+    :param seed: the seed
+    :param locations_path: if given, the coordinates for distance_analysis are written there as well
+    :return: dict dataset -> paths of its files
+    """
+    paths = {
+        dataset: generate_dataset(dataset, data_dir, n_ratings, seed, **kwargs) for dataset in DATASETS
+    }
+    if locations_path is not None:
+        generate_locations(locations_path, seed)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates synthetic BeerAdvocate and RateBeer datasets.")
+    parser.add_argument("--out", default="src/data", help="data directory the datasets are written to")
+    parser.add_argument("--rows", type=int, default=100_000, help="number of ratings per dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="ratings generated at once")
+    parser.add_argument("--users", type=int, default=None, help="number of users per dataset")
+    parser.add_argument("--beers", type=int, default=None, help="number of beers per dataset")
+    parser.add_argument("--user-overlap", type=float, default=0.3, help="share of users in both datasets")
+    parser.add_argument("--exp-user-share", type=float, default=0.05, help="share of experienced users")
+    parser.add_argument("--exp-text-rate", type=float, default=0.6, help="exp. word rate of experienced users")
+    parser.add_argument("--exp-word-rate", type=float, default=0.01, help="exp. word rate of everybody else")
+    parser.add_argument("--locations", default=None, help="also write coordinates to this csv")
+    parser.add_argument("--progress", action="store_true", help="show a progress bar")
+    args = parser.parse_args(argv)
+
+    paths = generate(
+        args.out,
+        args.rows,
+        args.seed,
+        locations_path=args.locations,
+        chunk_size=args.chunk_size,
+        n_users=args.users,
+        n_beers=args.beers,
+        user_overlap=args.user_overlap,
+        exp_user_share=args.exp_user_share,
+        exp_text_rate=args.exp_text_rate,
+        exp_word_rate=args.exp_word_rate,
+        progress=args.progress or None,
+    )
+    for dataset, dataset_paths in paths.items():
+        print(dataset, *dataset_paths.values())
+    return 0
+
+
+instrument_module(__name__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
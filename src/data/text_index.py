@@ -0,0 +1,461 @@
+"""
+Inverted index over the review texts of a text store (see src.data.text_store).
+
+The texts are lowercased and split into word tokens (tokenize). For every term the index keeps the sorted row ids of
+the ratings that contain it, how often it occurs there and at which token positions. The lists are delta-encoded
+varints in three files (docs.bin, freqs.bin, positions.bin), so a boolean query only reads the row ids of its terms
+and only phrase queries read positions.
+
+Queries (TextIndex.search):
+    malty                         rows containing the term
+    malty acidic, malty AND acidic   both terms
+    malty OR acidic, NOT malty, (sour OR acidic) AND NOT vinegar
+    "dry hop"                     phrase, the tokens right after each other
+    hop*, "dry hop*"              prefix, also as the last word of a phrase
+
+    index = load_text_index("src/data/BeerAdvocate/BA_ratings.csv")
+    index.search('"dry hop*" AND NOT sour')            # row ids, i.e. index values of the ratings frame
+    index.count_by("malty", df_ratings["user_id"])     # ratings per user that mention it
+"""
+
+import bisect
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+META_NAME = "meta.json"
+FORMAT_VERSION = 1
+TOKEN_PATTERN = r"\w+"
+# phrase matching combines row and position into one int64, so texts may have at most that many tokens
+MAX_POSITIONS = 1 << 24
+
+_token_re = re.compile(TOKEN_PATTERN)
+_query_re = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+
+def tokenize(text):
+    """
+    :param text: a text
+    :return: its normalized tokens (the terms of the index)
+    """
+    return _token_re.findall(text.lower())
+
+
+def encode_varints(values):
+    """
+    LEB128-style varints: 7 bits per byte, the high bit is set on all but the last byte of a value.
+    :param values: non-negative integers
+    :return: (the encoded bytes as uint8 array, the number of bytes of every value)
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * k))
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    shift = np.arange(len(owner)) - np.repeat(np.cumsum(nbytes) - nbytes, nbytes)
+    out = (values[owner] >> (7 * shift).astype(np.uint64)) & np.uint64(0x7F)
+    out |= (shift < nbytes[owner] - 1).astype(np.uint64) << np.uint64(7)
+    return out.astype(np.uint8), nbytes
+
+
+def decode_varints(data):
+    """
+    :param data: bytes or uint8 array written by encode_varints
+    :return: the values as int64 array
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7F).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(values, starts)
+
+
+class TextIndex:
+    """
+    Query access to an index written by build_text_index.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta["rows"]
+        with open(os.path.join(directory, "terms.json")) as f:
+            self.terms = json.load(f)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.doc_freqs = np.load(os.path.join(directory, "doc_freqs.npy"))
+        self._files = {name: self._map(name) for name in ("docs", "freqs", "positions")}
+
+    def _map(self, name):
+        path = os.path.join(self.directory, name + ".bin")
+        # np.memmap can't map empty files
+        return np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+
+    def _term_id(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def _read(self, name, term_id):
+        column = ("docs", "freqs", "positions").index(name)
+        start, end = self.offsets[term_id, column], self.offsets[term_id + 1, column]
+        return decode_varints(self._files[name][start:end])
+
+    def doc_freq(self, term):
+        """
+        :return: the number of rows that contain the term
+        """
+        term_id = self._term_id(term)
+        return 0 if term_id is None else int(self.doc_freqs[term_id])
+
+    def expand(self, prefix):
+        """
+        :return: all the terms starting with prefix
+        """
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\U0010ffff")
+        return self.terms[start:end]
+
+    def postings(self, term):
+        """
+        :param term: a normalized term
+        :return: the sorted row ids of the texts that contain it
+        """
+        term_id = self._term_id(term)
+        if term_id is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.cumsum(self._read("docs", term_id))
+
+    def positions(self, term):
+        """
+        :param term: a normalized term
+        :return: (row ids, token positions) of all its occurrences
+        """
+        term_id = self._term_id(term)
+        if term_id is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.cumsum(self._read("docs", term_id))
+        freqs = self._read("freqs", term_id)
+        deltas = self._read("positions", term_id)
+        # the positions are delta-encoded within every row, the first one of a row absolutely
+        doc_starts = np.cumsum(freqs) - freqs
+        cumulative = np.cumsum(deltas)
+        positions = cumulative - np.repeat(cumulative[doc_starts] - deltas[doc_starts], freqs)
+        return np.repeat(rows, freqs), positions
+
+    def term(self, word):
+        """
+        :param word: a word of a query, "hop*" for all the terms starting with hop
+        :return: the sorted row ids that contain it
+        """
+        if word.endswith("*"):
+            terms = self.expand(word[:-1])
+            return _union([self.postings(t) for t in terms])
+        return self.postings(word)
+
+    def phrase(self, words):
+        """
+        :param words: the words of the phrase, the last one may end with * for a prefix
+        :return: the sorted row ids whose text contains the words right after each other
+        """
+        if len(words) == 1:
+            return self.term(words[0])
+        return np.unique(self.occurrences(words))
+
+    def occurrences(self, words):
+        """
+        :param words: the words of a phrase (or a single word), the last one may end with * for a prefix
+        :return: the sorted row ids of all the occurrences of the phrase, a row that contains it twice is there twice
+        """
+        keys = None
+        for i, word in enumerate(words):
+            terms = self.expand(word[:-1]) if word.endswith("*") else [word]
+            # (row, start position of the phrase) as one number
+            word_keys = []
+            for term in terms:
+                rows, positions = self.positions(term)
+                valid = positions >= i
+                word_keys.append(rows[valid] * MAX_POSITIONS + positions[valid] - i)
+            word_keys = _union(word_keys)
+            keys = word_keys if keys is None else np.intersect1d(keys, word_keys, assume_unique=True)
+            if len(keys) == 0:
+                break
+        return keys // MAX_POSITIONS
+
+    def search(self, query):
+        """
+        :param query: a boolean query, see the module docstring
+        :return: the sorted row ids that match
+        """
+        tokens = _query_re.findall(query)
+        rows, position = self._parse_or(tokens, 0)
+        if position != len(tokens):
+            raise ValueError(f"Unexpected {tokens[position]!r} in query {query!r}")
+        return rows
+
+    def any_of(self, queries):
+        """
+        :param queries: several queries
+        :return: the rows that match at least one of them (the union of their postings)
+        """
+        return _union([self.search(q) for q in queries])
+
+    def count_by(self, query, keys):
+        """
+        :param query: a query or already the row ids of one
+        :param keys: Series indexed by row ids, e.g. df_ratings["user_id"] or df_ratings["beer_id"]
+        :return: for every key, the number of its rows that match, sorted descending
+        """
+        rows = self.search(query) if isinstance(query, str) else np.asarray(query)
+        return keys[np.isin(keys.index.to_numpy(), rows)].value_counts()
+
+    def _parse_or(self, tokens, position):
+        rows, position = self._parse_and(tokens, position)
+        while position < len(tokens) and tokens[position] == "OR":
+            other, position = self._parse_and(tokens, position + 1)
+            rows = np.union1d(rows, other)
+        return rows, position
+
+    def _parse_and(self, tokens, position):
+        rows, position = self._parse_not(tokens, position)
+        while position < len(tokens) and tokens[position] not in ("OR", ")"):
+            if tokens[position] == "AND":
+                position += 1
+            other, position = self._parse_not(tokens, position)
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows, position
+
+    def _parse_not(self, tokens, position):
+        if position < len(tokens) and tokens[position] == "NOT":
+            rows, position = self._parse_not(tokens, position + 1)
+            return np.setdiff1d(np.arange(self.rows), rows, assume_unique=True), position
+        return self._parse_atom(tokens, position)
+
+    def _parse_atom(self, tokens, position):
+        if position >= len(tokens):
+            raise ValueError("Incomplete query")
+        token = tokens[position]
+        if token == "(":
+            rows, position = self._parse_or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ")":
+                raise ValueError("Missing )")
+            return rows, position + 1
+        if token in (")", "AND", "OR"):
+            raise ValueError(f"Unexpected {token!r} in query")
+        return self.phrase(_query_words(token.strip('"'))), position + 1
+
+
+def _query_words(text):
+    # normalized like the texts, a trailing * stays on the last word
+    words = tokenize(text)
+    if not words:
+        raise ValueError(f"No words in {text!r}")
+    if text.endswith("*"):
+        words[-1] += "*"
+    return words
+
+
+def _union(arrays):
+    arrays = [a for a in arrays if len(a)]
+    if not arrays:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(arrays))
+
+
+def text_index_path(csv_path):
+    """
+    :param csv_path: the path of a ratings csv
+    :return: the directory of the index over its texts
+    """
+    return os.path.splitext(csv_path)[0] + ".index"
+
+
+def is_current(directory, texts):
+    """
+    :param directory: the index directory
+    :param texts: the TextStore it was built from
+    :return: whether the index exists and was built from the current version of the texts
+    """
+    try:
+        with open(os.path.join(directory, META_NAME)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("source") == texts.meta["source"]
+
+
+def _tokenize_chunk(texts):
+    # one row per token: (row id, token, position), in row and position order
+    texts = texts.dropna()
+    if len(texts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64)
+    tokens = texts.str.lower().str.findall(TOKEN_PATTERN).explode().dropna()
+    positions = tokens.groupby(level=0).cumcount().to_numpy()
+    if len(positions) and positions.max() >= MAX_POSITIONS:
+        raise ValueError(f"A text has more than {MAX_POSITIONS} tokens")
+    return tokens.index.to_numpy(dtype=np.int64), tokens.to_numpy(dtype=object), positions
+
+
+def _write_segment(directory, number, parts):
+    # a segment: the postings of a range of rows, sorted by term, row and position
+    rows = np.concatenate([p[0] for p in parts])
+    codes, terms = pd.factorize(np.concatenate([p[1] for p in parts]), sort=True)
+    positions = np.concatenate([p[2] for p in parts])
+    order = np.lexsort((positions, rows, codes))
+    path = os.path.join(directory, f"segment{number}")
+    os.makedirs(path)
+    np.save(os.path.join(path, "rows.npy"), rows[order])
+    np.save(os.path.join(path, "positions.npy"), positions[order].astype(np.int64))
+    np.save(os.path.join(path, "starts.npy"), np.searchsorted(codes[order], np.arange(len(terms) + 1)))
+    with open(os.path.join(path, "terms.json"), "w") as f:
+        json.dump(list(terms), f)
+    return path
+
+
+def _open_segment(path):
+    with open(os.path.join(path, "terms.json")) as f:
+        terms = json.load(f)
+    return {
+        "terms": terms,
+        "starts": np.load(os.path.join(path, "starts.npy")),
+        "rows": np.load(os.path.join(path, "rows.npy"), mmap_mode="r"),
+        "positions": np.load(os.path.join(path, "positions.npy"), mmap_mode="r"),
+    }
+
+
+def _encode_batch(term_ids, rows, positions):
+    # the three streams of a batch of terms, plus the bytes per term in each
+    new_doc = np.ones(len(rows), dtype=bool)
+    new_doc[1:] = (term_ids[1:] != term_ids[:-1]) | (rows[1:] != rows[:-1])
+    doc_index = np.flatnonzero(new_doc)
+    doc_terms, doc_rows = term_ids[doc_index], rows[doc_index]
+    freqs = np.diff(np.append(doc_index, len(rows)))
+
+    row_deltas = doc_rows.copy()
+    same_term = doc_terms[1:] == doc_terms[:-1]
+    row_deltas[1:][same_term] = doc_rows[1:][same_term] - doc_rows[:-1][same_term]
+    position_deltas = positions.copy()
+    same_doc = ~new_doc[1:]
+    position_deltas[1:][same_doc] = positions[1:][same_doc] - positions[:-1][same_doc]
+
+    streams = []
+    for values, owners in [(row_deltas, doc_terms), (freqs, doc_terms), (position_deltas, term_ids)]:
+        data, nbytes = encode_varints(values)
+        streams.append((data, owners, nbytes))
+    return streams, doc_terms
+
+
+def build_text_index(texts, directory, segment_rows=200_000, batch_postings=20_000_000, progress=None):
+    """
+    Builds the index in two steps with bounded memory: the texts are tokenized in segments of segment_rows rows,
+    every segment is sorted and written to disk, then the segments are merged term by term (in batches of about
+    batch_postings postings) into the final lists. Like the stores, the index is moved into place at the end.
+    :param texts: the TextStore
+    :param directory: the index directory (see text_index_path)
+    :param segment_rows: rows per segment
+    :param batch_postings: postings encoded at once in the merge
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: the index directory
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-" + os.path.basename(directory))
+    try:
+        segments, parts, part_rows = [], [], 0
+        with track(progress, "tokenize texts", total=len(texts)) as tracker:
+            for chunk in texts.iter_chunks(chunksize=min(segment_rows, 50_000)):
+                parts.append(_tokenize_chunk(chunk))
+                part_rows += len(chunk)
+                if part_rows >= segment_rows:
+                    segments.append(_write_segment(tmp_directory, len(segments), parts))
+                    parts, part_rows = [], 0
+                tracker.update(len(chunk))
+            if parts:
+                segments.append(_write_segment(tmp_directory, len(segments), parts))
+
+        segments = [_open_segment(path) for path in segments]
+        terms = sorted(set().union(*(s["terms"] for s in segments)))
+        vocabulary = np.array(terms, dtype=object)
+        postings_per_term = np.zeros(len(terms), dtype=np.int64)
+        for segment in segments:
+            segment["term_ids"] = np.searchsorted(vocabulary, np.array(segment["terms"], dtype=object))
+            postings_per_term[segment["term_ids"]] += np.diff(segment["starts"])
+
+        # batches of consecutive terms, so that every segment contributes one slice per batch
+        cumulative = np.cumsum(postings_per_term)
+        bounds = [0]
+        while bounds[-1] < len(terms):
+            done = cumulative[bounds[-1] - 1] if bounds[-1] else 0
+            end = int(np.searchsorted(cumulative, done + batch_postings, side="right"))
+            bounds.append(max(end, bounds[-1] + 1))
+
+        offsets = np.zeros((len(terms) + 1, 3), dtype=np.int64)
+        doc_freqs = np.zeros(len(terms), dtype=np.int64)
+        names = ("docs", "freqs", "positions")
+        files = [open(os.path.join(tmp_directory, name + ".bin"), "wb") for name in names]
+        try:
+            with track(progress, "merge index segments", total=len(terms), unit="terms") as tracker:
+                for first, end in zip(bounds[:-1], bounds[1:]):
+                    batch_terms, batch_rows, batch_positions = [], [], []
+                    for segment in segments:
+                        lo, hi = np.searchsorted(segment["term_ids"], [first, end])
+                        start, stop = segment["starts"][lo], segment["starts"][hi]
+                        counts = np.diff(segment["starts"][lo : hi + 1])
+                        batch_terms.append(np.repeat(segment["term_ids"][lo:hi], counts))
+                        batch_rows.append(np.asarray(segment["rows"][start:stop]))
+                        batch_positions.append(np.asarray(segment["positions"][start:stop]))
+                    term_ids = np.concatenate(batch_terms)
+                    # stable, so the rows stay in segment (i.e. row) order within a term
+                    order = np.argsort(term_ids, kind="stable")
+                    streams, doc_terms = _encode_batch(
+                        term_ids[order], np.concatenate(batch_rows)[order], np.concatenate(batch_positions)[order]
+                    )
+                    doc_freqs[first:end] = np.bincount(doc_terms - first, minlength=end - first)
+                    for column, (f, (data, owners, nbytes)) in enumerate(zip(files, streams)):
+                        f.write(data.tobytes())
+                        per_term = np.bincount(owners - first, weights=nbytes, minlength=end - first)
+                        offsets[first + 1 : end + 1, column] = offsets[first, column] + np.cumsum(per_term)
+                    tracker.update(end - first)
+        finally:
+            for f in files:
+                f.close()
+
+        for segment in segments:
+            del segment["rows"], segment["positions"]
+        for name in os.listdir(tmp_directory):
+            if name.startswith("segment"):
+                shutil.rmtree(os.path.join(tmp_directory, name))
+        np.save(os.path.join(tmp_directory, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_directory, "doc_freqs.npy"), doc_freqs)
+        with open(os.path.join(tmp_directory, "terms.json"), "w") as f:
+            json.dump(terms, f)
+        meta = {
+            "version": FORMAT_VERSION,
+            "rows": len(texts),
+            "terms": len(terms),
+            "postings": int(postings_per_term.sum()),
+            "token_pattern": TOKEN_PATTERN,
+            "source": texts.meta["source"],
+        }
+        with open(os.path.join(tmp_directory, META_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return directory
+
+
+instrument_module(__name__)
@@ -0,0 +1,246 @@
+"""
+Compressed store for the review texts, kept apart from the other columns (see src.data.column_store).
+
+A store is a directory next to the csv (BA_ratings.csv -> BA_ratings.text/). The texts are cut into blocks of
+block_rows consecutive rows, every block is one zstd frame in blocks.bin. block_offsets.npy holds where the frames
+start, row_offsets.npy where every text starts in the uncompressed data, missing.npy which rows have no text.
+The row id of a text is its row in the csv, i.e. its index in the frames of the loaders (a RangeIndex), which
+survives filtering. Reading a text only decompresses its block, recently used blocks are kept decompressed.
+
+    texts = TextStore(build_text_store("src/data/BeerAdvocate/BA_ratings.csv"))
+    texts[42]                               # one text
+    texts.take(df_ratings.index)            # the texts of the rows of a frame, as Series
+    for chunk in texts.iter_chunks(df_ratings.index):   # the same, streamed
+        ...
+"""
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+META_NAME = "meta.json"
+FORMAT_VERSION = 1
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("The text store needs the zstandard package (pip install zstandard)") from e
+    return zstandard
+
+
+class TextStore:
+    """
+    Random and streaming access to a text store written by build_text_store. Not thread-safe (one per thread).
+    """
+
+    def __init__(self, directory, cache_blocks=16):
+        """
+        :param directory: the store directory
+        :param cache_blocks: how many decompressed blocks are kept
+        """
+        self.directory = directory
+        with open(os.path.join(directory, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta["rows"]
+        self.block_rows = self.meta["block_rows"]
+        self.block_offsets = np.load(os.path.join(directory, "block_offsets.npy"))
+        self.row_offsets = np.load(os.path.join(directory, "row_offsets.npy"), mmap_mode="r")
+        self.missing = np.load(os.path.join(directory, "missing.npy"), mmap_mode="r")
+        blocks_path = os.path.join(directory, "blocks.bin")
+        # np.memmap can't map empty files
+        self._blocks = np.memmap(blocks_path, dtype=np.uint8, mode="r") if os.path.getsize(blocks_path) else None
+        self._decompressor = _zstd().ZstdDecompressor()
+        self.cache_blocks = cache_blocks
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        return self.get(row)
+
+    def get(self, row):
+        """
+        :param row: the row id
+        :return: the text of the row (NaN if it has none, like pd.read_csv)
+        """
+        if not 0 <= row < self.rows:
+            raise IndexError(f"Row {row} is out of range for a store with {self.rows} rows")
+        if self.missing[row]:
+            return np.nan
+        block = row // self.block_rows
+        data = self._block(block)
+        base = self.row_offsets[block * self.block_rows]
+        return data[self.row_offsets[row] - base : self.row_offsets[row + 1] - base].decode()
+
+    def take(self, rows):
+        """
+        The texts of many rows, every block that is needed is decompressed once.
+        :param rows: the row ids (e.g. df.index), in any order
+        :return: Series of the texts, indexed by the row ids
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.rows):
+            raise IndexError(f"Row ids out of range for a store with {self.rows} rows")
+        texts = np.full(len(rows), np.nan, dtype=object)
+        blocks = rows // self.block_rows
+        order = np.argsort(blocks, kind="stable")
+        bounds = np.flatnonzero(np.diff(blocks[order])) + 1
+        for positions in np.split(order, bounds) if len(rows) else []:
+            block = blocks[positions[0]]
+            data = self._block(block)
+            base = self.row_offsets[block * self.block_rows]
+            for position in positions:
+                row = rows[position]
+                if not self.missing[row]:
+                    texts[position] = data[self.row_offsets[row] - base : self.row_offsets[row + 1] - base].decode()
+        return pd.Series(texts, index=rows, name="text", dtype=object)
+
+    def iter_chunks(self, rows=None, chunksize=None):
+        """
+        Streams the texts in chunks, so only one chunk is in memory at a time.
+        :param rows: the row ids (default: all rows)
+        :param chunksize: rows per chunk (default: one block)
+        :return: generator of Series like take
+        """
+        rows = np.arange(self.rows) if rows is None else np.asarray(rows, dtype=np.int64)
+        chunksize = chunksize or self.block_rows
+        for start in range(0, len(rows), chunksize):
+            yield self.take(rows[start : start + chunksize])
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def _block(self, block):
+        data = self._cache.get(block)
+        if data is not None:
+            self._cache.move_to_end(block)
+            return data
+        start, end = self.block_offsets[block], self.block_offsets[block + 1]
+        data = self._decompressor.decompress(self._blocks[start:end].tobytes())
+        self._cache[block] = data
+        if len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return data
+
+
+def text_store_path(csv_path):
+    """
+    :param csv_path: the path of a ratings csv
+    :return: the directory of its text store
+    """
+    return os.path.splitext(csv_path)[0] + ".text"
+
+
+def _source_stats(csv_path):
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_current(directory, csv_path):
+    """
+    :return: whether the store exists and was built from the current version of the csv
+    """
+    try:
+        with open(os.path.join(directory, META_NAME)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("source") == _source_stats(csv_path)
+
+
+def build_text_store(csv_path, directory=None, block_rows=256, level=3, chunksize=100_000, progress=None):
+    """
+    Builds the text store of a ratings csv in one streaming pass. Like build_column_store, the store is written to a
+    temporary directory and moved into place at the end.
+    :param csv_path: the ratings csv
+    :param directory: the store directory (default: text_store_path(csv_path))
+    :param block_rows: rows per compressed block. Smaller blocks make random access cheaper, larger ones compress
+    better.
+    :param level: the zstd compression level
+    :param chunksize: the number of csv rows read at a time
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: the store directory
+    """
+    compressor = _zstd().ZstdCompressor(level=level)
+    directory = directory or text_store_path(csv_path)
+    source = _source_stats(csv_path)
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-" + os.path.basename(directory))
+    try:
+        block_offsets = [0]
+        row_lengths = []
+        missing = []
+        pending = []
+
+        def flush(blocks_file):
+            encoded = [b"" if isinstance(text, float) else text.encode() for text in pending]
+            blocks_file.write(compressor.compress(b"".join(encoded)))
+            block_offsets.append(blocks_file.tell())
+            row_lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+            pending.clear()
+
+        with open(csv_path, "rb") as f, open(os.path.join(tmp_directory, "blocks.bin"), "wb") as blocks_file, track(
+            progress, f"text store {os.path.basename(csv_path)}", total=source["size"], unit="bytes"
+        ) as tracker:
+            for chunk in pd.read_csv(f, usecols=["text"], dtype={"text": str}, chunksize=chunksize):
+                texts = chunk["text"]
+                missing.append(texts.isna().to_numpy())
+                for text in texts:
+                    pending.append(text)
+                    if len(pending) == block_rows:
+                        flush(blocks_file)
+                tracker.update(f.tell() - tracker.done, rows=len(chunk))
+            if pending:
+                flush(blocks_file)
+
+        lengths = np.concatenate(row_lengths) if row_lengths else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(tmp_directory, "row_offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]))
+        np.save(os.path.join(tmp_directory, "block_offsets.npy"), np.asarray(block_offsets, dtype=np.int64))
+        np.save(
+            os.path.join(tmp_directory, "missing.npy"),
+            np.concatenate(missing) if missing else np.zeros(0, dtype=bool),
+        )
+        meta = {
+            "version": FORMAT_VERSION,
+            "rows": len(lengths),
+            "block_rows": block_rows,
+            "compression": "zstd",
+            "level": level,
+            "source": source,
+        }
+        with open(os.path.join(tmp_directory, META_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return directory
+
+
+def attach_text(df, texts):
+    """
+    Adds the text column to a frame without it, for the functions that need the texts of all its rows
+    (e.g. filter_usa_duplicates).
+    :param df: a frame whose index are row ids of the store
+    :param texts: the TextStore
+    :return: a copy of df with the text column
+    """
+    return df.assign(text=texts.take(df.index).to_numpy())
+
+
+instrument_module(__name__)
@@ -2,31 +2,82 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime
 import numpy as np
+from src.utils.backend import import_polars, is_polars, lazy
 from src.utils.evaluation_utils import CB_color_cycle
+from src.utils.instrument import instrument_module
 
 # Define rating buckets for readability
 rating_buckets = np.arange(0, 5.5, 0.5)
 
 
-def rating_evolution_over_time(
-    df,
-    df_name,
-    bucket=rating_buckets,
-    min_ratings=1000,
-    colors=CB_color_cycle,
-):
+def _bucket_columns(bucket):
+    # the columns pd.cut(bins=bucket, right=False) gives after the groupby
+    intervals = pd.IntervalIndex.from_breaks(bucket, closed="left")
+    return pd.CategoricalIndex(intervals, categories=intervals, ordered=True, name="rating_buckets")
 
-    # changes unix timestamp to date
-    df["datetime"] = df["date"].apply(datetime.datetime.fromtimestamp)
-    df["year"] = df["datetime"].dt.strftime("%Y")
 
-    # Clean and process the DataFrame
-    df_cleaned = df.dropna(subset=["rating"])
-    df_cleaned["rating"] = df_cleaned["rating"].astype(float)
+def _polars_bucket(pl, bucket):
+    # position of the rating in the buckets, like pd.cut(right=False): -1 or len(bucket) - 1 if outside
+    return (
+        pl.sum_horizontal([pl.col("rating") >= float(edge) for edge in bucket]) - 1
+    ).alias("bucket")
 
-    # Apply rating buckets
-    df_cleaned["rating_buckets"] = pd.cut(
-        df_cleaned["rating"], bins=bucket, right=False, include_lowest=True
+
+def _polars_shares(counts, index, bucket):
+    # counts of (index, bucket) pairs -> share of every bucket per index value, as pandas
+    shares = (
+        counts.to_pandas()
+        .pivot(index=index, columns="bucket", values="count")
+        .reindex(columns=range(len(bucket) - 1))
+        .fillna(0)
+    )
+    shares = shares.div(shares.sum(axis=1), axis=0)
+    shares.columns = _bucket_columns(bucket)
+    return shares
+
+
+def rating_distribution_per_year(df, bucket=rating_buckets, min_ratings=1000):
+    """
+    The distribution of the ratings over the rating buckets for every year with more than min_ratings ratings.
+    :param df: the ratings, or a polars (Lazy)Frame of them for the lazy mode (see src.utils.backend). The lazy
+    mode takes the years in UTC, the pandas one in the local time zone.
+    :param bucket: the edges of the rating buckets
+    :param min_ratings: years with fewer ratings are left out
+    :return: (df with the share of every bucket per year, the number of ratings of these years)
+    """
+    if is_polars(df):
+        pl = import_polars()
+        df_cleaned = (
+            lazy(df)
+            .select(
+                pl.from_epoch("date", time_unit="s").dt.year().cast(pl.String).alias("year"),
+                pl.col("rating").cast(pl.Float64),
+            )
+            .filter(pl.col("rating").is_not_null() & pl.col("rating").is_not_nan())
+        )
+        ratings_count = df_cleaned.group_by("year").agg(pl.len().cast(pl.Int64).alias("count"))
+        ratings_count = ratings_count.filter(pl.col("count") > min_ratings)
+        counts = (
+            df_cleaned.join(ratings_count.select("year"), on="year")
+            .group_by("year", _polars_bucket(pl, bucket))
+            .agg(pl.len().alias("count"))
+            .filter(pl.col("bucket").is_between(0, len(bucket) - 2))
+        )
+        ratings_count, counts = pl.collect_all([ratings_count.sort("year"), counts])
+        ratings_count_filtered = ratings_count.to_pandas().set_index("year")["count"].rename(None)
+        return _polars_shares(counts, "year", bucket), ratings_count_filtered
+
+    # Clean and process the DataFrame, only the columns we need and without touching the caller's df
+    df_cleaned = df.loc[df["rating"].notna(), ["date", "rating"]]
+    rating = df_cleaned["rating"].astype(float)
+    df_cleaned = pd.DataFrame(
+        {
+            # changes unix timestamp to date
+            "year": df_cleaned["date"].apply(datetime.datetime.fromtimestamp).dt.strftime("%Y"),
+            "rating": rating,
+            # Apply rating buckets
+            "rating_buckets": pd.cut(rating, bins=bucket, right=False, include_lowest=True),
+        }
     )
 
     # Calculate the total number of ratings per year
@@ -39,11 +90,91 @@ def rating_evolution_over_time(
     # Calculate distribution of ratings per filtered year
     grouped = df_filtered.groupby(["year", "rating_buckets"], observed=False).size()
     percentage_df = (
-        grouped.groupby(level=0).apply(lambda x: x / x.sum()).unstack(fill_value=0)
-    )
+        grouped / grouped.groupby(level=0).transform("sum")
+    ).unstack(fill_value=0)
 
     # Recalculate the ratings count for filtered years
     ratings_count_filtered = ratings_count[ratings_count > min_ratings]
+    return percentage_df, ratings_count_filtered
+
+
+def rating_distribution_by_rating_number(df, bucket=rating_buckets, nr_reviews=300):
+    """
+    The distribution of the ratings over the rating buckets by the number of the rating (the 1st, 2nd, ... rating
+    of a user).
+    :param df: the ratings, or a polars (Lazy)Frame of them for the lazy mode (see src.utils.backend)
+    :param bucket: the edges of the rating buckets
+    :param nr_reviews: the highest rating number in the distribution
+    :return: (df with the share of every bucket per rating number, the number of ratings per rating number)
+    """
+    if is_polars(df):
+        pl = import_polars()
+        df_sorted = (
+            lazy(df)
+            .select("user_id", "date", pl.col("rating").cast(pl.Float64))
+            .filter(pl.col("rating").is_not_null() & pl.col("rating").is_not_nan())
+            .slice(1)
+            .sort("user_id", "date", nulls_last=True, maintain_order=True)
+            .with_columns((pl.int_range(pl.len()).over("user_id") + 1).alias("rating_order"))
+        )
+        response_count = (
+            df_sorted.filter(pl.col("user_id").is_not_null())
+            .group_by("rating_order")
+            .agg(pl.len().cast(pl.Int64).alias("user_id"))
+            .sort("rating_order")
+        )
+        counts = (
+            df_sorted.filter(pl.col("rating_order") <= nr_reviews)
+            .group_by("rating_order", _polars_bucket(pl, bucket))
+            .agg(pl.len().alias("count"))
+        )
+        response_count, counts = pl.collect_all([response_count, counts])
+        response_count = response_count.to_pandas().set_index("rating_order")["user_id"]
+        inside = counts.filter(pl.col("bucket").is_between(0, len(bucket) - 2))
+        return _polars_shares(inside, "rating_order", bucket), response_count
+
+    # Cleaning the dataframe, only the columns we need and without touching the caller's df
+    df_cleaned = df.loc[df["rating"].notna(), ["user_id", "rating", "date"]][1:]
+    df_cleaned = df_cleaned.assign(
+        rating=df_cleaned["rating"].astype(float)
+    )  # tranforms all ratings to int
+
+    # Sorts the DataFrame by user and date to ensure correct order of ratings and adds column for rating number for respective user
+    df_sorted = df_cleaned.sort_values(by=["user_id", "date"])
+    df_sorted = df_sorted.assign(rating_order=df_sorted.groupby("user_id").cumcount() + 1)
+
+    # Uses a cutoff for amount of ratings, applies buckets to dataframe and calculates distribution
+    df_filtered = df_sorted[df_sorted["rating_order"] <= nr_reviews]
+    df_filtered = df_filtered.assign(
+        rating_buckets=pd.cut(df_filtered["rating"], bins=bucket, right=False, include_lowest=True)
+    )
+    df_amount = (
+        df_filtered.groupby(["rating_order", "rating_buckets"], observed=False)
+        .size()
+        .reset_index(name="count")
+    )
+    df_amount["percentage"] = df_amount.groupby("rating_order")["count"].transform(
+        lambda x: x / x.sum()
+    )
+
+    # Pivots the data for stacked bar plot
+    pivot_df = df_amount.pivot(
+        index="rating_order", columns="rating_buckets", values="percentage"
+    ).fillna(0)
+
+    # Aggregate the total number of responses for each rating order
+    response_count = df_sorted.groupby("rating_order")["user_id"].count()
+    return pivot_df, response_count
+
+
+def rating_evolution_over_time(
+    df,
+    df_name,
+    bucket=rating_buckets,
+    min_ratings=1000,
+    colors=CB_color_cycle,
+):
+    percentage_df, ratings_count_filtered = rating_distribution_per_year(df, bucket, min_ratings)
 
     # Plot the stacked bar chart with the secondary y-axis
     fig, ax1 = plt.subplots(figsize=(12, 6))
@@ -84,35 +215,7 @@ def rating_evolution_with_rating_number(
     bucket=rating_buckets,
     nr_reviews=300,
 ):
-    # Cleaning and merging dataframes
-    df_cleaned = df.dropna(subset=["rating"])[1:]
-    df_cleaned["rating"] = df_cleaned["rating"].astype(
-        float
-    )  # tranforms all ratings to int
-    df_cleaned[["user_id", "rating", "date"]].drop_duplicates()
-
-    # Sorts the DataFrame by user and date to ensure correct order of ratings and adds column for rating number for respective user
-    df_sorted = df_cleaned.sort_values(by=["user_id", "date"])
-    df_sorted["rating_order"] = df_sorted.groupby("user_id").cumcount() + 1
-
-    # Uses a cutoff for amount of ratings, applies buckets to dataframe and calculates distribution
-    df_filtered = df_sorted[df_sorted["rating_order"] <= nr_reviews].copy()
-    df_filtered["rating_buckets"] = pd.cut(
-        df_filtered["rating"], bins=bucket, right=False, include_lowest=True
-    )
-    df_amount = (
-        df_filtered.groupby(["rating_order", "rating_buckets"], observed=False)
-        .size()
-        .reset_index(name="count")
-    )
-    df_amount["percentage"] = df_amount.groupby("rating_order")["count"].transform(
-        lambda x: x / x.sum()
-    )
-
-    # Pivots the data for stacked bar plot
-    pivot_df = df_amount.pivot(
-        index="rating_order", columns="rating_buckets", values="percentage"
-    ).fillna(0)
+    pivot_df, response_count = rating_distribution_by_rating_number(df, bucket, nr_reviews)
 
     # Create the plot with two y-axes
     fig, ax1 = plt.subplots(figsize=(12, 6))
@@ -134,8 +237,6 @@ def rating_evolution_with_rating_number(
     )
 
     ax2 = ax1.twinx()
-    # Aggregate the total number of responses for each rating order
-    response_count = df_sorted.groupby("rating_order")["user_id"].count()
     ax2.plot(
         np.arange(0, len(response_count), 1),
         response_count.values,
@@ -146,3 +247,6 @@ def rating_evolution_with_rating_number(
     ax2.set_ylabel("Number of ratings")
     ax2.legend(loc="upper right")
     plt.show()
+
+
+instrument_module(__name__)
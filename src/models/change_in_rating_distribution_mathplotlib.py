@@ -1,11 +1,13 @@
-import pandas as pd
 import matplotlib.pyplot as plt
-import datetime
 import numpy as np
-from src.utils.evaluation_utils import CB_color_cycle_flipped
-
-# Define rating buckets for readability
-rating_buckets = np.arange(0, 5.5, 0.5)
+from src.models.change_in_rating_distribution import (
+    rating_buckets,
+    rating_distribution_by_rating_number,
+    rating_distribution_per_year,
+)
+from src.utils.evaluation_utils import CB_color_cycle, CB_color_cycle_flipped
+from src.utils.plot_export import savefig
+from src.utils.instrument import instrument_module
 
 
 def rating_evolution_over_time(
@@ -16,35 +18,7 @@ def rating_evolution_over_time(
     min_ratings=1000,
     colors=CB_color_cycle_flipped ,
 ):
-
-    # changes unix timestamp to date
-    df["datetime"] = df["date"].apply(datetime.datetime.fromtimestamp)
-    df["year"] = df["datetime"].dt.strftime("%Y")
-
-    # Clean and process the DataFrame
-    df_cleaned = df.dropna(subset=["rating"])
-    df_cleaned["rating"] = df_cleaned["rating"].astype(float)
-
-    # Apply rating buckets
-    df_cleaned["rating_buckets"] = pd.cut(
-        df_cleaned["rating"], bins=bucket, right=False, include_lowest=True
-    )
-
-    # Calculate the total number of ratings per year
-    ratings_count = df_cleaned.groupby("year").size()
-
-    # Filter for years with more than `min_ratings` ratings
-    filtered_years = ratings_count[ratings_count > min_ratings].index
-    df_filtered = df_cleaned[df_cleaned["year"].isin(filtered_years)]
-
-    # Calculate distribution of ratings per filtered year
-    grouped = df_filtered.groupby(["year", "rating_buckets"], observed=False).size()
-    percentage_df = (
-        grouped.groupby(level=0).apply(lambda x: x / x.sum()).unstack(fill_value=0)
-    )
-
-    # Recalculate the ratings count for filtered years
-    ratings_count_filtered = ratings_count[ratings_count > min_ratings]
+    percentage_df, ratings_count_filtered = rating_distribution_per_year(df, bucket, min_ratings)
 
     # Plot the stacked bar chart with the secondary y-axis
     fig, ax1 = plt.subplots(figsize=(12, 6))
@@ -73,7 +47,7 @@ def rating_evolution_over_time(
     ax1.set_xticks(range(len(ratings_count_filtered.index)))
     ax1.set_xticklabels(ratings_count_filtered.index, rotation=45)
 
-    fig.savefig(path, bbox_inches="tight")
+    savefig(fig, path, bbox_inches="tight")
 
 
 # Function for filtering and diplaying the change in reviewers rating over time
@@ -85,35 +59,7 @@ def rating_evolution_with_rating_number(
     bucket=rating_buckets,
     nr_reviews=200,
 ):
-    # Cleaning and merging dataframes
-    df_cleaned = df.dropna(subset=["rating"])[1:]
-    df_cleaned["rating"] = df_cleaned["rating"].astype(
-        float
-    )  # tranforms all ratings to int
-    df_cleaned[["user_id", "rating", "date"]].drop_duplicates()
-
-    # Sorts the DataFrame by user and date to ensure correct order of ratings and adds column for rating number for respective user
-    df_sorted = df_cleaned.sort_values(by=["user_id", "date"])
-    df_sorted["rating_order"] = df_sorted.groupby("user_id").cumcount() + 1
-
-    # Uses a cutoff for amount of ratings, applies buckets to dataframe and calculates distribution
-    df_filtered = df_sorted[df_sorted["rating_order"] <= nr_reviews].copy()
-    df_filtered["rating_buckets"] = pd.cut(
-        df_filtered["rating"], bins=bucket, right=False, include_lowest=True
-    )
-    df_amount = (
-        df_filtered.groupby(["rating_order", "rating_buckets"], observed=False)
-        .size()
-        .reset_index(name="count")
-    )
-    df_amount["percentage"] = df_amount.groupby("rating_order")["count"].transform(
-        lambda x: x / x.sum()
-    )
-
-    # Pivots the data for stacked bar plot
-    pivot_df = df_amount.pivot(
-        index="rating_order", columns="rating_buckets", values="percentage"
-    ).fillna(0)
+    pivot_df, response_count = rating_distribution_by_rating_number(df, bucket, nr_reviews)
 
     # Create the plot with two y-axes
     fig, ax1 = plt.subplots(figsize=(12, 6))
@@ -135,8 +81,6 @@ def rating_evolution_with_rating_number(
     )
 
     ax2 = ax1.twinx()
-    # Aggregate the total number of responses for each rating order
-    response_count = df_sorted.groupby("rating_order")["user_id"].count()
     ax2.plot(
         np.arange(0, len(response_count), 1),
         response_count.values,
@@ -146,4 +90,7 @@ def rating_evolution_with_rating_number(
     )
     ax2.set_ylabel("Number of ratings")
     ax2.legend(loc="upper left")
-    fig.savefig(path, bbox_inches="tight")
+    savefig(fig, path, bbox_inches="tight")
+
+
+instrument_module(__name__)
@@ -10,51 +10,52 @@ import seaborn as sns
 from geopy.distance import geodesic as GD
 from geopy.geocoders import Nominatim
 from src.utils.evaluation_utils import US_STATES_CODES
-
-import pandas as pd
-
-pd.options.mode.chained_assignment = None  # default='warn'
+from src.utils.cache import memoize
+from src.utils.plot_export import savefig
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
 
 
-def join_users_breweries_ratings(df_users, df_breweries, df_ratings, ratebeer=True):
+def join_users_breweries_ratings(df_users, df_breweries, df_ratings, ratebeer=True, progress=None):
     """
     Join the user, breweries and ratings dataframes
     :param df_user: the user dataframe
     :param df_breweries: the breweries dataframe
     :param df_ratings: the ratings dataframe
-    :return: a merged dataframe
+    :param progress: None, True or a progress callback (see src.utils.progress), reports the 3 steps
+    :return: a merged dataframe (the given dataframes stay unchanged)
     """
-    df_breweries.rename(columns={"id": "brewery_id"}, inplace=True)
-    if ratebeer:
-        df_users.dropna(subset="user_name", inplace=True)
-        df_ratings.dropna(subset="user_name", inplace=True)
-
-        df_ratings = df_ratings.convert_dtypes()
-        df_users = df_users.convert_dtypes()
-        df_users["user_name"] = df_users["user_name"].astype(str)
-        df_ratings["user_name"] = df_ratings["user_name"].astype(str)
-
-        df_joined = df_ratings.merge(
-            df_users, on="user_name", how="left", suffixes=["_ratings", "_users"]
+    with track(progress, "join users, breweries and ratings", total=3, unit="steps") as tracker:
+        df_breweries = df_breweries.rename(columns={"id": "brewery_id"})
+        if ratebeer:
+            df_users = df_users.dropna(subset="user_name").convert_dtypes()
+            df_ratings = df_ratings.dropna(subset="user_name").convert_dtypes()
+            df_users = df_users.assign(user_name=df_users["user_name"].astype(str))
+            df_ratings = df_ratings.assign(user_name=df_ratings["user_name"].astype(str))
+
+            df_joined = df_ratings.merge(
+                df_users, on="user_name", how="left", suffixes=["_ratings", "_users"]
+            )
+
+        else:
+            df_ratings = df_ratings.convert_dtypes()
+            df_users = df_users.convert_dtypes()
+            df_joined = df_ratings.merge(
+                df_users, on="user_id", how="left", suffixes=["_ratings", "_users"]
+            )
+        tracker.update(rows=len(df_ratings))
+        df_joined = df_joined.merge(
+            df_breweries,
+            on="brewery_id",
+            how="inner",
+            suffixes=["_joined", "_breweries"],
         )
+        tracker.update()
 
-    else:
-        df_ratings = df_ratings.convert_dtypes()
-        df_users = df_users.convert_dtypes()
-        df_joined = df_ratings.merge(
-            df_users, on="user_id", how="left", suffixes=["_ratings", "_users"]
+        df_joined.dropna(subset=["location"], inplace=True)
+        df_joined["brewery_location"] = df_joined["brewery_location"].apply(
+            remove_html_tags
         )
-    df_joined = df_joined.merge(
-        df_breweries,
-        on="brewery_id",
-        how="inner",
-        suffixes=["_joined", "_breweries"],
-    )
-
-    df_joined.dropna(subset=["location"], inplace=True)
-    df_joined["brewery_location"] = df_joined["brewery_location"].apply(
-        remove_html_tags
-    )
     return df_joined
 
 
@@ -62,7 +63,16 @@ def remove_html_tags(value: str):
     return value.split("<")[0]
 
 
-def retrieve_location_data(df_ba_joined, df_rb_joined):
+def retrieve_location_data(df_ba_joined, df_rb_joined, progress=None):
+    """
+    Looks up the coordinates of all the user and brewery locations (one request per second to the geocoding
+    service), unless they are already stored in data/locations.csv.
+    :param df_ba_joined: BeerAdvocate result of join_users_breweries_ratings
+    :param df_rb_joined: RateBeer result of join_users_breweries_ratings
+    :param progress: None, True or a progress callback (see src.utils.progress). With progress, the locations
+    are reported through it instead of being printed one per line.
+    :return: df with location, latitude and longitude
+    """
 
     if os.path.exists("data/locations.csv"):
         df_locations = pd.read_csv("data/locations.csv")
@@ -79,29 +89,34 @@ def retrieve_location_data(df_ba_joined, df_rb_joined):
             df_rb_joined["brewery_location"].unique()
         )
         all_locations = ba_locations.union(rb_locations)
-        print("Total locations: {}".format(len(all_locations)))
-
-        for location in list(all_locations):
-            sleep(1)  # Only one query per second is allowed by the API
-            try:
-                geo_info = geolocator.geocode(location)
-                latitudes.append(geo_info.latitude)
-                longitudes.append(geo_info.longitude)
-                locations.append(location)
-                print(
-                    location,
-                    "information fetched:",
-                    str(geo_info),
-                    "(",
-                    geo_info.latitude,
-                    geo_info.longitude,
-                    ")",
-                )
-            except:
-                latitudes.append(np.nan)
-                longitudes.append(np.nan)
-                locations.append(location)
-                print("Error fetching information for", location)
+        if progress is None:
+            print("Total locations: {}".format(len(all_locations)))
+
+        with track(progress, "geocode locations", total=len(all_locations), unit="locations") as tracker:
+            for location in list(all_locations):
+                sleep(1)  # Only one query per second is allowed by the API
+                try:
+                    geo_info = geolocator.geocode(location)
+                    latitudes.append(geo_info.latitude)
+                    longitudes.append(geo_info.longitude)
+                    locations.append(location)
+                    if progress is None:
+                        print(
+                            location,
+                            "information fetched:",
+                            str(geo_info),
+                            "(",
+                            geo_info.latitude,
+                            geo_info.longitude,
+                            ")",
+                        )
+                except:
+                    latitudes.append(np.nan)
+                    longitudes.append(np.nan)
+                    locations.append(location)
+                    if progress is None:
+                        print("Error fetching information for", location)
+                tracker.update()
 
         df_locations = pd.DataFrame(
             {"location": locations, "latitude": latitudes, "longitude": longitudes}
@@ -112,30 +127,28 @@ def retrieve_location_data(df_ba_joined, df_rb_joined):
 
 
 def translate_locations(joined_df, df_locations):
-    """Translates locations into longitutde and latitude coordinates."""
-    joined_df["longitude_user"] = joined_df["location"].map(
-        df_locations.set_index("location")["longitude"].to_dict()
-    )
-    joined_df["latitude_user"] = joined_df["location"].map(
-        df_locations.set_index("location")["latitude"].to_dict()
-    )
-    joined_df["longitude_brewery"] = joined_df["brewery_location"].map(
-        df_locations.set_index("location")["longitude"].to_dict()
-    )
-    joined_df["latitude_brewery"] = joined_df["brewery_location"].map(
-        df_locations.set_index("location")["latitude"].to_dict()
+    """Translates locations into longitutde and latitude coordinates (as new columns of a new df)."""
+    coordinates = df_locations.set_index("location")
+    longitudes = coordinates["longitude"].to_dict()
+    latitudes = coordinates["latitude"].to_dict()
+    return joined_df.assign(
+        longitude_user=joined_df["location"].map(longitudes),
+        latitude_user=joined_df["location"].map(latitudes),
+        longitude_brewery=joined_df["brewery_location"].map(longitudes),
+        latitude_brewery=joined_df["brewery_location"].map(latitudes),
     )
-    return joined_df
 
 
+@memoize
 def calculate_distances(joined_df, df_locations):
-    """Calculates the distances between users and breweries."""
+    """Calculates the distances between users and breweries (as new columns of a new df)."""
     joined_df = translate_locations(joined_df, df_locations)
-    joined_df["distance_user_brewery"] = haversine_distance(
-        joined_df[["latitude_user", "longitude_user"]].values,
-        joined_df[["latitude_brewery", "longitude_brewery"]].values,
+    return joined_df.assign(
+        distance_user_brewery=haversine_distance(
+            joined_df[["latitude_user", "longitude_user"]].values,
+            joined_df[["latitude_brewery", "longitude_brewery"]].values,
+        )
     )
-    return joined_df
 
 
 def haversine_distance(origin, destination):
@@ -164,9 +177,10 @@ def haversine_distance(origin, destination):
 
 
 def plot_distance_ratings(
-    joined_df, ratebeer=True, max_distance=15000, bucket_per_distance=250
+    joined_df, ratebeer=True, max_distance=15000, bucket_per_distance=250, path=None
 ):
-    """Plots the distance between users and breweries against the ratings given by the users."""
+    """Plots the distance between users and breweries against the ratings given by the users.
+    If a path is given, the plot is saved there instead of shown."""
     if ratebeer:
         user_column = "user_name"
     else:
@@ -192,22 +206,24 @@ def plot_distance_ratings(
 
     # Cleaning and merging dataframes
     df_cleaned = joined_df.dropna(subset=["rating"])[1:]
-    df_cleaned["rating"] = df_cleaned["rating"].astype(
-        float
+    df_cleaned = df_cleaned.assign(
+        rating=df_cleaned["rating"].astype(float)
     )  # tranforms all ratings to int
     df_cleaned[[user_column, "rating", "date"]].drop_duplicates()
 
     # Uses a cutoff for distance between brewery and reviewer, applies buckets to dataframe and calculates distribution
     df_filtered = df_cleaned[df_cleaned["distance_user_brewery"] <= max_distance]
-    df_filtered["rating_buckets"] = pd.cut(
-        df_filtered["rating"], bins=rating_buckets, right=False, include_lowest=True
-    )
-    df_filtered["distance_user_brewery_buckets"] = pd.cut(
-        df_filtered["distance_user_brewery"],
-        bins=np.arange(0, max_distance + 1, bucket_per_distance),
-        right=True,
-        include_lowest=True,
-        labels=np.arange(0, max_distance, bucket_per_distance),
+    df_filtered = df_filtered.assign(
+        rating_buckets=pd.cut(
+            df_filtered["rating"], bins=rating_buckets, right=False, include_lowest=True
+        ),
+        distance_user_brewery_buckets=pd.cut(
+            df_filtered["distance_user_brewery"],
+            bins=np.arange(0, max_distance + 1, bucket_per_distance),
+            right=True,
+            include_lowest=True,
+            labels=np.arange(0, max_distance, bucket_per_distance),
+        ),
     )
     df_amount = (
         df_filtered.groupby(
@@ -263,4 +279,10 @@ def plot_distance_ratings(
     ax2.set_yscale("log")
     ax2.set_ylabel("Number of ratings")
     ax2.legend(loc="upper right")
-    plt.show()
+    if path is not None:
+        savefig(fig, path, bbox_inches="tight")
+    else:
+        plt.show()
+
+
+instrument_module(__name__)
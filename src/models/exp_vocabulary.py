@@ -0,0 +1,235 @@
+"""
+Data-driven alternative to the hand-picked exp_words lists of experience_words.
+
+We stream all the review texts, count words and word pairs (bigrams) separately for the ratings of users with many
+ratings and of users with few, and rank them by how much more the experienced users use them: the log-odds ratio
+with an informative Dirichlet prior (Monroe, Colaresi & Quinn, "Fightin' Words", 2008), as z-score. The terms are
+hashed into a fixed number of buckets (like sklearn's HashingVectorizer), so the memory needed doesn't depend on
+the size of the vocabulary, and the chunks of texts are counted in parallel processes.
+
+    ranking = score_vocabulary(df_ba_ratings, df_ba_users, texts=load_rating_texts(ba_path))
+    exp_words = discover_exp_words(df_ba_ratings, df_ba_users, top_n=20)   # works with get_experienced_users2
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.data.text_index import TOKEN_PATTERN
+from src.data.text_store import TextStore
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+LOW, HIGH = 0, 1
+
+# function words say nothing about experience, and as part of a regex they would match nearly every review
+STOP_WORDS = frozenset(
+    """
+    a about above after again all also am an and any are as at be because been before being below between both but
+    by can could did do does doing down during each few for from further had has have having he her here hers him his
+    how i if in into is it its itself just me more most my no nor not now of off on once only or other our out over
+    own same she should so some such than that the their them then there these they this those through to too under
+    until up very was we were what when where which while who whom why will with would you your
+    """.split()
+)
+
+
+def experience_classes(df_ratings, df_users, high_quantile=0.9, low_quantile=0.5):
+    """
+    Labels every rating with the experience class of its user, taken from the number of ratings of the user.
+    :param df_ratings: the ratings (user_id)
+    :param df_users: the users (user_id, nbr_ratings)
+    :param high_quantile: users with at least this quantile of nbr_ratings are experienced
+    :param low_quantile: users with at most this quantile of nbr_ratings are inexperienced, the ones in between are
+    left out
+    :return: Series indexed like df_ratings: 1 (experienced), 0 (inexperienced) or -1 (left out)
+    """
+    nbr_ratings = df_users.set_index("user_id")["nbr_ratings"]
+    nbr_ratings = nbr_ratings[nbr_ratings > 0]
+    high = nbr_ratings.quantile(high_quantile)
+    low = min(nbr_ratings.quantile(low_quantile), high - 1)
+    user_class = pd.Series(-1, index=nbr_ratings.index, dtype=np.int8)
+    user_class[nbr_ratings >= high] = HIGH
+    user_class[nbr_ratings <= low] = LOW
+    labels = df_ratings["user_id"].map(user_class).fillna(-1).astype(np.int8)
+    return labels.rename("experience_class")
+
+
+def _features(texts, ngram_range):
+    # (row id, term) of every word / bigram of the texts
+    tokens = texts.dropna().str.lower().str.findall(TOKEN_PATTERN).explode().dropna()
+    rows = tokens.index.to_numpy(dtype=np.int64)
+    words = tokens.to_numpy(dtype=object)
+    feature_rows, features = [], []
+    if ngram_range[0] <= 1 <= ngram_range[1]:
+        feature_rows.append(rows)
+        features.append(words)
+    if ngram_range[0] <= 2 <= ngram_range[1] and len(words) > 1:
+        same_text = rows[1:] == rows[:-1]
+        feature_rows.append(rows[1:][same_text])
+        features.append(words[:-1][same_text] + " " + words[1:][same_text])
+    if not features:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object)
+    return np.concatenate(feature_rows), np.concatenate(features)
+
+
+def _count_chunk(task):
+    """
+    Counts one chunk of texts, runs in the worker processes.
+    :return: ({class: (buckets, counts)}, (buckets, most frequent term per bucket, its count))
+    """
+    source, rows, labels, n_features, ngram_range, binary = task
+    texts = TextStore(source).take(rows) if isinstance(source, str) else source
+    feature_rows, features = _features(texts, ngram_range)
+    if binary:
+        # every term counts once per rating
+        pairs = pd.DataFrame({"row": feature_rows, "term": features}).drop_duplicates()
+        feature_rows, features = pairs["row"].to_numpy(), pairs["term"].to_numpy(dtype=object)
+    # pandas' hash is stable across processes and runs, unlike hash()
+    buckets = (pd.util.hash_array(features) % np.uint64(n_features)).astype(np.int64)
+    feature_labels = labels[np.searchsorted(rows, feature_rows)]
+
+    counts = {}
+    for label in (LOW, HIGH):
+        counts[label] = np.unique(buckets[feature_labels == label], return_counts=True)
+    # the bucket's name: its most frequent term in the chunk
+    names = (
+        pd.DataFrame({"bucket": buckets, "term": features})
+        .value_counts()
+        .reset_index()
+        .drop_duplicates("bucket")
+    )
+    return counts, (names["bucket"].to_numpy(), names["term"].to_numpy(dtype=object), names["count"].to_numpy())
+
+
+def log_odds_z(counts_high, counts_low, alpha0=1000.0):
+    """
+    The log-odds ratio of every term between two corpora with an informative Dirichlet prior, divided by its
+    standard deviation. The prior is the pooled frequency of the term scaled to alpha0 pseudo-counts, so rare terms
+    are pulled towards zero instead of getting extreme ratios.
+    :param counts_high: the counts of the terms in the first corpus
+    :param counts_low: the counts of the terms in the second corpus
+    :param alpha0: the size of the prior
+    :return: (z-scores, log-odds ratios), positive for terms typical for the first corpus
+    """
+    counts_high = np.asarray(counts_high, dtype=np.float64)
+    counts_low = np.asarray(counts_low, dtype=np.float64)
+    pooled = counts_high + counts_low
+    prior = alpha0 * pooled / max(pooled.sum(), 1.0)
+    n_high, n_low = counts_high.sum(), counts_low.sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.log((counts_high + prior) / (n_high + alpha0 - counts_high - prior)) - np.log(
+            (counts_low + prior) / (n_low + alpha0 - counts_low - prior)
+        )
+        variance = 1 / (counts_high + prior) + 1 / (counts_low + prior)
+        z = delta / np.sqrt(variance)
+    return z, delta
+
+
+def score_vocabulary(
+    df_ratings,
+    df_users,
+    texts=None,
+    high_quantile=0.9,
+    low_quantile=0.5,
+    ngram_range=(1, 2),
+    n_features=2**20,
+    binary=True,
+    alpha0=1000.0,
+    min_count=20,
+    chunksize=20_000,
+    workers=None,
+    progress=None,
+):
+    """
+    Ranks the words and bigrams of the reviews by how typical they are for experienced users.
+    :param df_ratings: the ratings (user_id, and the text column if texts is not given). Its index are the row ids
+    of the text store.
+    :param df_users: the users (user_id, nbr_ratings), see experience_classes
+    :param texts: the TextStore of the ratings (see load_rating_texts), or None to use the text column
+    :param high_quantile: see experience_classes
+    :param low_quantile: see experience_classes
+    :param ngram_range: (1, 1) for words only, (1, 2) for words and bigrams
+    :param n_features: the number of hash buckets. Terms in the same bucket are counted together, the bucket is named
+    after its most frequent term.
+    :param binary: count every term once per rating (otherwise every occurrence)
+    :param alpha0: the size of the prior, see log_odds_z
+    :param min_count: terms used fewer times overall are left out
+    :param chunksize: texts per task
+    :param workers: the number of processes (default: all cores, 1 counts in this process)
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: df with the columns term, z, log_odds, count_high and count_low, sorted by z (most typical for
+    experienced users first)
+    """
+    labels = experience_classes(df_ratings, df_users, high_quantile, low_quantile)
+    labels = labels[labels >= 0].sort_index()
+    rows = labels.index.to_numpy(dtype=np.int64)
+    labels = labels.to_numpy()
+
+    def tasks():
+        for start in range(0, len(rows), chunksize):
+            chunk_rows = rows[start : start + chunksize]
+            source = texts.directory if texts is not None else df_ratings["text"].loc[chunk_rows]
+            yield source, chunk_rows, labels[start : start + chunksize], n_features, ngram_range, binary
+
+    totals = np.zeros((2, n_features), dtype=np.int64)
+    names = np.full(n_features, None, dtype=object)
+    name_counts = np.zeros(n_features, dtype=np.int64)
+    with track(progress, "count vocabulary", total=len(rows)) as tracker:
+        if workers == 1:
+            results = map(_count_chunk, tasks())
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+            results = pool.map(_count_chunk, tasks())
+        try:
+            for i, (counts, (buckets, terms, term_counts)) in enumerate(results):
+                for label, (label_buckets, label_counts) in counts.items():
+                    totals[label, label_buckets] += label_counts
+                same = names[buckets] == terms
+                name_counts[buckets[same]] += term_counts[same]
+                replace = ~same & (term_counts > name_counts[buckets])
+                names[buckets[replace]] = terms[replace]
+                name_counts[buckets[replace]] = term_counts[replace]
+                tracker.update(min(chunksize, len(rows) - i * chunksize))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    z, log_odds = log_odds_z(totals[HIGH], totals[LOW], alpha0)
+    used = np.flatnonzero(totals.sum(axis=0) >= min_count)
+    ranking = pd.DataFrame(
+        {
+            "term": names[used],
+            "z": z[used],
+            "log_odds": log_odds[used],
+            "count_high": totals[HIGH, used],
+            "count_low": totals[LOW, used],
+        }
+    )
+    return ranking.sort_values("z", ascending=False, kind="stable", ignore_index=True)
+
+
+def discover_exp_words(df_ratings, df_users, texts=None, top_n=20, min_z=3.0, min_length=3, **kwargs):
+    """
+    A data-driven exp_words list: the terms most typical for experienced users.
+    :param df_ratings: see score_vocabulary
+    :param df_users: see score_vocabulary
+    :param texts: see score_vocabulary
+    :param top_n: the maximal number of terms
+    :param min_z: only terms with at least this z-score (3 ~ significant at 0.1%)
+    :param min_length: terms with a shorter word or a stop word are left out, get_experienced_users2 searches the
+    terms as substrings
+    :param kwargs: passed to score_vocabulary
+    :return: list of terms, to be used like exp_words1 (e.g. in get_experienced_users2)
+    """
+    ranking = score_vocabulary(df_ratings, df_users, texts, **kwargs)
+    content = ranking["term"].map(
+        lambda term: all(len(word) >= min_length and word not in STOP_WORDS for word in term.split())
+    )
+    return ranking.loc[content & (ranking["z"] >= min_z), "term"].head(top_n).tolist()
+
+
+instrument_module(__name__)
@@ -4,6 +4,11 @@ import re
 import numpy as np
 from scipy.stats import t
 import plotly.graph_objects as go
+from src.models.user_trajectories import compare_trajectories
+from src.utils.cache import memoize
+from src.utils.plot_export import write_html
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
 
 # these are some possibilities of what one could consider
 # "word that only experienced beer consumers would use in there beer review"
@@ -50,23 +55,33 @@ exp_words4 = [
 ]
 
 
-def get_experienced_users(df_ratings, exp_words):
+def get_experienced_users(df_ratings, exp_words, texts=None, index=None):
     """
     Filters user_ids to those that are from experienced users, meaning that they've used
     one of the words in the given word list at least once
     :param df_ratings: the ratings we look at
     :param exp_words: the words we consider
+    :param texts: the TextStore of the ratings, if df_ratings comes without the text column (see load_rating_texts)
+    :param index: alternatively the TextIndex of the ratings (see load_text_index). The rows are then the union of
+    the postings of the words, no text is read. The words match at the start of a word ("ester" matches "esters",
+    but no longer "western"), so the result can differ a bit from the substring search.
     :return:
     """
+    if index is not None:
+        rows = index.any_of([f'"{word}*"' for word in exp_words])
+        return df_ratings.loc[df_ratings.index.intersection(rows), "user_id"].unique()
     regex_pattern = "|".join(exp_words)  # create a regular expression to filter
-    df_ratings_exp = df_ratings[
-        df_ratings["text"].str.contains(regex_pattern, case=False, na=False)
-    ]
+    if texts is not None:
+        df_ratings_exp = filter_ratings_with_exp_words(df_ratings, exp_words, texts=texts)
+    else:
+        df_ratings_exp = df_ratings[
+            df_ratings["text"].str.contains(regex_pattern, case=False, na=False)
+        ]
     exp_user_ids = df_ratings_exp["user_id"].unique()
     return exp_user_ids
 
 
-def get_experienced_users2(df_ratings, exp_words):
+def get_experienced_users2(df_ratings, exp_words, progress=None, texts=None):
     """
     This is a second way to define experienced users using the words they use.
     Here we give two criteria that need to be satisfied in order to call someone experienced.
@@ -76,27 +91,69 @@ def get_experienced_users2(df_ratings, exp_words):
     and filter_experienced_users.
     :param df_ratings: the rating dataset
     :param exp_words: the list of words we consider to come from experienced users
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :param texts: the TextStore of the ratings, if df_ratings comes without the text column (see load_rating_texts)
     :return: a list of ids of experienced users
     """
-    ratings_with_exp_words = filter_ratings_with_exp_words(df_ratings, exp_words)
-    users_with_exp_words = get_users_with_min_exp_words(
-        ratings_with_exp_words, exp_words
-    )
-    exp_users = filter_experienced_users(ratings_with_exp_words, users_with_exp_words)
+    ratings_with_exp_words = filter_ratings_with_exp_words(df_ratings, exp_words, progress, texts=texts)
+    with track(progress, "count exp. words per user", total=len(ratings_with_exp_words)) as tracker:
+        users_with_exp_words = get_users_with_min_exp_words(
+            ratings_with_exp_words, exp_words
+        )
+        exp_users = filter_experienced_users(ratings_with_exp_words, users_with_exp_words)
+        tracker.update(len(ratings_with_exp_words))
     return exp_users
 
 
-def filter_ratings_with_exp_words(df_ratings, exp_words):
+def filter_ratings_with_exp_words(df_ratings, exp_words, progress=None, chunksize=100_000, texts=None):
     """
     This filters the dataframe only to those entries that include at least one of the given words.
     :param df_ratings: the rating df
     :param exp_words: the list of words we consider to come from experienced users
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :param chunksize: with progress or texts, the texts are scanned in chunks of that many rows
+    :param texts: the TextStore of the ratings, if df_ratings comes without the text column. The texts are then
+    streamed from the store and only the matching rows get a text column.
     :return: filtered df
     """
     regex_pattern = "|".join(exp_words)
-    return df_ratings[
-        df_ratings["text"].str.contains(regex_pattern, case=False, na=False)
-    ]
+    if texts is not None:
+        matches = []
+        with track(progress, "scan texts for exp. words", total=len(df_ratings)) as tracker:
+            for chunk in texts.iter_chunks(df_ratings.index, chunksize):
+                matches.append(chunk[chunk.str.contains(regex_pattern, case=False, na=False).to_numpy(dtype=bool)])
+                tracker.update(len(chunk))
+        matched = pd.concat(matches) if matches else pd.Series([], name="text", dtype=object)
+        return df_ratings.loc[matched.index].assign(text=matched.to_numpy())
+    if progress is None:
+        return df_ratings[
+            df_ratings["text"].str.contains(regex_pattern, case=False, na=False)
+        ]
+    masks = []
+    with track(progress, "scan texts for exp. words", total=len(df_ratings)) as tracker:
+        for start in range(0, len(df_ratings), chunksize):
+            texts = df_ratings["text"].iloc[start : start + chunksize]
+            masks.append(texts.str.contains(regex_pattern, case=False, na=False).to_numpy(dtype=bool))
+            tracker.update(len(texts))
+    return df_ratings[np.concatenate(masks) if masks else np.zeros(0, dtype=bool)]
+
+
+def exp_word_matches(df_ratings, exp_words, progress=None, texts=None):
+    """
+    Every use of an exp word, for the features that need to know when a user used which word
+    (see src.models.user_features).
+    :param df_ratings: the rating df
+    :param exp_words: the list of words we consider to come from experienced users
+    :param progress: see filter_ratings_with_exp_words
+    :param texts: see filter_ratings_with_exp_words
+    :return: df with the columns row (the index of the rating in df_ratings) and word (lower case, so "Ester" and
+    "ester" are the same word), one row per distinct word of a rating
+    """
+    df_ratings_exp = filter_ratings_with_exp_words(df_ratings, exp_words, progress, texts=texts)
+    regex_pattern = "|".join(exp_words)
+    words = df_ratings_exp["text"].str.lower().str.findall(regex_pattern.lower()).explode().dropna()
+    matches = pd.DataFrame({"row": words.index.to_numpy(), "word": words.to_numpy(dtype=object)})
+    return matches.drop_duplicates(ignore_index=True)
 
 
 def get_users_with_min_exp_words(df_ratings_exp, exp_words, min_word_count=5):
@@ -148,18 +205,30 @@ def split_by_experience(df_ratings, exp_user_ids):
     :param exp_user_ids:
     :return:
     """
-    # we don't need the text attribute in the further analysis and it is very big
-    df_ratings_wo_text = df_ratings.drop(columns=["text"])
+    # we don't need the text attribute in the further analysis and it is very big, so we select the other columns
+    # right away instead of copying the whole df without it first
+    columns = df_ratings.columns.drop("text", errors="ignore")
     # splitting the dataframe via the id list givem
-    df_ratings_of_exp = df_ratings_wo_text[
-        df_ratings_wo_text["user_id"].isin(exp_user_ids)
-    ]
-    df_ratings_of_inexp = df_ratings_wo_text[
-        ~df_ratings_wo_text["user_id"].isin(exp_user_ids)
-    ]
+    is_exp = df_ratings["user_id"].isin(exp_user_ids)
+    df_ratings_of_exp = df_ratings.loc[is_exp, columns]
+    df_ratings_of_inexp = df_ratings.loc[~is_exp, columns]
     return df_ratings_of_exp, df_ratings_of_inexp
 
 
+def trajectories_by_experience(trajectories, exp_user_ids, min_ratings=10):
+    """
+    Compares how the ratings of experienced and inexperienced users drift over their ratings
+    :param trajectories: the table of user_trajectories (see src.models.user_trajectories)
+    :param exp_user_ids: the ids of the experienced users (e.g. from get_experienced_users2)
+    :param min_ratings: see compare_trajectories
+    :return: df indexed by Experienced / Inexperienced, see compare_trajectories
+    """
+    is_exp = trajectories["user_id"].isin(exp_user_ids).to_numpy()
+    groups = pd.Series(np.where(is_exp, "Experienced", "Inexperienced"), index=trajectories["user_id"])
+    return compare_trajectories(trajectories, groups, min_ratings)
+
+
+@memoize
 def calculate_style_distribution(df_ratings_of_exp, df_ratings_of_inexp, top_n=25):
     """
     Calculates the empirical distribution of ratings over the style attribute for both datframes
@@ -266,6 +335,7 @@ def plot_combined_distribution_and_rating_difference(plot_df, rating_diff_df):
     plt.show()
 
 
+@memoize
 def calculate_rating_difference(df_ratings_of_exp, df_ratings_of_inexp, most_rated):
     """Calculate rating difference between experienced and non-experienced users over styles"""
     # average rating per beer style for experienced users
@@ -290,6 +360,7 @@ def calculate_rating_difference(df_ratings_of_exp, df_ratings_of_inexp, most_rat
     return rating_diff_df
 
 
+@memoize
 def calculate_rating_difference_with_ci(
     df_ratings_of_exp, df_ratings_of_inexp, most_rated
 ):
@@ -551,7 +622,7 @@ def save_plot_combined_distribution_and_rating_difference_with_ci(
     )
 
     # Save to HTML
-    fig.write_html("src/plots/combined_distribution_and_rating_difference.html", include_plotlyjs="cdn")
+    write_html(fig, "src/plots/combined_distribution_and_rating_difference.html")
 
 
 def save_plot_separate_distribution_and_rating_difference_with_ci(
@@ -609,7 +680,7 @@ def save_plot_separate_distribution_and_rating_difference_with_ci(
         width=800,
     )
     # Save Distribution Difference Plot
-    fig_dist.write_html("src/plots/distribution_difference.html", include_plotlyjs="cdn")
+    write_html(fig_dist, "src/plots/distribution_difference.html")
 
     # Second Plot: Rating Difference
     fig_rating = go.Figure()
@@ -647,4 +718,7 @@ def save_plot_separate_distribution_and_rating_difference_with_ci(
         width=800,
     )
     # Save Rating Difference Plot
-    fig_rating.write_html("src/plots/rating_difference.html", include_plotlyjs="cdn")
+    write_html(fig_rating, "src/plots/rating_difference.html")
+
+
+instrument_module(__name__)
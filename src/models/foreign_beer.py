@@ -2,6 +2,12 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from src.utils.evaluation_utils import *
+from src.models.location_cube import LocationCube, build_location_cube
+from src.utils.backend import columns, connect, get_backend, query, quote, register
+from src.utils.cache import memoize
+from src.utils.plot_export import write_html
+from src.utils.pipeline import Pipeline, Stage
+from src.utils.instrument import instrument_module
 import pandas as pd
 from plotly.subplots import make_subplots
 from plotly import graph_objects as go
@@ -207,10 +213,9 @@ def accumulate_us2(df_users, col_name):
     :param col_name: the name of the location column (location or brewery_location)
     :return: accumulated df
     """
-    df_users_us = df_users.copy()
-    mask = df_users_us[col_name].str.contains("United States, ", na=False)
-    df_users_us.loc[mask, col_name] = "United States"
-    return df_users_us
+    mask = df_users[col_name].str.contains("United States, ", na=False)
+    # a new df that only replaces the location column, the given df stays unchanged
+    return df_users.assign(**{col_name: df_users[col_name].mask(mask, "United States")})
 
 
 def filter_top_countries(df_users_ratings, top_n=50):
@@ -226,12 +231,24 @@ def filter_top_countries(df_users_ratings, top_n=50):
     return df_users_ratings[df_users_ratings["location"].isin(top_countries)], top_50
 
 
-def avg_rating_by_location(df_users_ratings):
+@memoize
+def avg_rating_by_location(df_users_ratings, backend=None):
     """
     Calculates the average rating for every country,
     :param df_users_ratings: first return val of filter_top_countries
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: The grouped, averaged and sorted df
     """
+    if get_backend(backend) == "duckdb":
+        df_avg = query(
+            """
+            SELECT location, avg(rating) AS rating FROM ratings
+            WHERE location IS NOT NULL
+            GROUP BY location ORDER BY rating DESC NULLS LAST
+            """,
+            ratings=df_users_ratings,
+        )
+        return df_avg.set_index("location")["rating"]
     return (
         df_users_ratings.groupby("location")["rating"]
         .mean()
@@ -289,7 +306,7 @@ def plot_mean_rating_by_location(df_plot, save=True):
     )
 
     if save:
-        fig.write_html("src/plots/world_avg_map.html")
+        write_html(fig, "src/plots/world_avg_map.html")
     else:
         fig.show()
 
@@ -323,7 +340,7 @@ def plot_bar_chart(df_plot, save=True):
                       xaxis=dict(tickangle=90))
 
     if save:
-        fig.write_html("src/plots/bar_chart_avg_rating.html")
+        write_html(fig, "src/plots/bar_chart_avg_rating.html")
     else:
         fig.show()
 
@@ -354,7 +371,7 @@ def plot_choropleth_map(df_plot, save=True):
     fig.update_layout(title_text="Average Rating Per Country (Choropleth Map)")
 
     if save:
-        fig.write_html("src/plots/choropleth_map_avg_rating.html")
+        write_html(fig, "src/plots/choropleth_map_avg_rating.html")
     else:
         fig.show()
 
@@ -398,13 +415,16 @@ def plot_mean_rating_and_rating_count(df_plot, top50, log_scale=True):
     plt.show()
 
 
-def merge_ratings_with_breweries(df_users_ratings, df_brew_us):
+def merge_ratings_with_breweries(df_users_ratings, df_brew_us, backend=None):
     """
     Join the df that contains the user and rating information with the brewery df.
     :param df_users_ratings: the joined df of ratings and users
-    :param df_brew_us: the brewery df
+    :param df_brew_us: the brewery df (or with the duckdb backend also the breweries.csv)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: the joined df resulting from the two given dfs
     """
+    if get_backend(backend) == "duckdb":
+        return _merge_ratings_with_breweries_duckdb(df_users_ratings, df_brew_us)
     df_merged = df_users_ratings.merge(
         df_brew_us[["brewery_id", "brewery_location"]], on="brewery_id", how="inner"
     )
@@ -414,42 +434,152 @@ def merge_ratings_with_breweries(df_users_ratings, df_brew_us):
     return df_merged
 
 
-def foreign_beer_stats(df_users_ratings_brew):
+def _merge_ratings_with_breweries_duckdb(df_users_ratings, df_brew_us):
+    con = connect()
+    try:
+        register(con, "ratings", df_users_ratings)
+        register(con, "breweries", df_brew_us)
+        brewery_columns = columns(con, "breweries")
+        if "brewery_id" not in brewery_columns:
+            # the raw breweries.csv, load_brewery_data would rename these
+            brewery_id, brewery_location = "b.id", "b.location"
+        else:
+            brewery_id, brewery_location = "b.brewery_id", "b.brewery_location"
+        selected = [
+            f"r.{quote(c)} AS user_location" if c == "location" else f"r.{quote(c)}"
+            for c in columns(con, "ratings")
+        ]
+        # row numbers, so that the rows come in the same order as from the pandas merge
+        return con.execute(
+            f"""
+            SELECT {", ".join(selected)}, {brewery_location} AS brewery_location,
+                r.location IS DISTINCT FROM {brewery_location} AS "foreign"
+            FROM (SELECT *, row_number() OVER () AS __row FROM ratings) r
+            JOIN (SELECT *, row_number() OVER () AS __row FROM breweries) b
+                ON r.brewery_id = {brewery_id}
+            ORDER BY r.__row, b.__row
+            """
+        ).df()
+    finally:
+        con.close()
+
+
+@memoize
+def domestic_foreign_summary(df_users_ratings_brew, backend=None):
+    """
+    The statistics of the ratings per user location and domestic/foreign beer in one pass over the ratings.
+    foreign_beer_stats, grouped_counts, avg_scores_domestic_foreign and pivot_average_scores all derive their
+    results from this table, so it can be passed to them instead of the ratings.
+    :param df_users_ratings_brew: the result of merge_ratings_with_breweries (foreign flag) or of change_flag
+    (is_domestic flag)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
+    :return: df with the columns user_location (NaN for users without location, last), is_domestic, count (number
+    of rows), n (number of ratings), avg_rating, std_dev and proportion (of the rows of the user location)
+    """
+    if get_backend(backend) == "duckdb":
+        return _domestic_foreign_summary_duckdb(df_users_ratings_brew)
+
+    if "is_domestic" in df_users_ratings_brew.columns:
+        domestic = df_users_ratings_brew["is_domestic"].to_numpy(dtype=bool)
+    else:
+        domestic = ~df_users_ratings_brew["foreign"].to_numpy(dtype=bool)
+    location_codes, locations = pd.factorize(df_users_ratings_brew["user_location"], sort=True, use_na_sentinel=False)
+    group_codes = location_codes * 2 + domestic
+    n_groups = 2 * len(locations)
+
+    ratings = df_users_ratings_brew["rating"].to_numpy(dtype=np.float64)
+    rated = ~np.isnan(ratings)
+    # the moments around the overall mean, so the variances don't lose precision
+    shift = ratings[rated].mean() if rated.any() else 0.0
+    centered = np.where(rated, ratings - shift, 0.0)
+    count = np.bincount(group_codes, minlength=n_groups)
+    n = np.bincount(group_codes, weights=rated, minlength=n_groups)
+    total = np.bincount(group_codes, weights=centered, minlength=n_groups)
+    total_sq = np.bincount(group_codes, weights=centered**2, minlength=n_groups)
+    location_count = count.reshape(-1, 2).sum(axis=1)
+
+    groups = np.flatnonzero(count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg_rating = total / n + shift
+        std_dev = np.sqrt(np.maximum((total_sq - total**2 / n) / (n - 1), 0.0))
+    return pd.DataFrame(
+        {
+            "user_location": np.asarray(locations, dtype=object)[groups // 2],
+            "is_domestic": (groups % 2).astype(bool),
+            "count": count[groups],
+            "n": n[groups].astype(np.int64),
+            "avg_rating": avg_rating[groups],
+            "std_dev": std_dev[groups],
+            "proportion": count[groups] / location_count[groups // 2],
+        }
+    )
+
+
+def _domestic_foreign_summary_duckdb(df_users_ratings_brew):
+    con = connect()
+    try:
+        register(con, "ratings", df_users_ratings_brew)
+        domestic = "is_domestic" if "is_domestic" in columns(con, "ratings") else 'NOT "foreign"'
+        return con.execute(
+            f"""
+            SELECT user_location, is_domestic, count, n, avg_rating, std_dev,
+                count / sum(count) OVER (PARTITION BY user_location) AS proportion
+            FROM (
+                SELECT user_location, {domestic} AS is_domestic, count(*) AS count, count(rating) AS n,
+                    avg(rating) AS avg_rating, stddev_samp(rating) AS std_dev
+                FROM ratings GROUP BY ALL
+            )
+            ORDER BY user_location NULLS LAST, is_domestic
+            """
+        ).df()
+    finally:
+        con.close()
+
+
+def _summary(df_users_ratings_brew, backend):
+    if "proportion" in df_users_ratings_brew.columns and "rating" not in df_users_ratings_brew.columns:
+        return df_users_ratings_brew
+    return domestic_foreign_summary(df_users_ratings_brew, backend)
+
+
+def foreign_beer_stats(df_users_ratings_brew, backend=None):
     """
     Calculates some interesting statistics about the foreign/domestic beers
-    :param df_users_ratings_brew: the result of merge_ratings_with_breweries
+    :param df_users_ratings_brew: the result of merge_ratings_with_breweries (or of domestic_foreign_summary)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: number of foreign beers, number of domestic beers and also both expressed as relative percentages
     """
-    # split df in foreign and domestic/own beers
-    foreign_beers = df_users_ratings_brew[df_users_ratings_brew["foreign"]]
-    own_beers = df_users_ratings_brew[~df_users_ratings_brew["foreign"]]
+    summary = _summary(df_users_ratings_brew, backend)
+    # the number of foreign and domestic/own beers
+    n_foreign = int(summary.loc[~summary["is_domestic"].astype(bool), "count"].sum())
+    n_own = int(summary.loc[summary["is_domestic"].astype(bool), "count"].sum())
     # the total amount of ratings
-    total_ratings = len(df_users_ratings_brew)
+    total_ratings = n_foreign + n_own
     # ratio of foreign beers in the rating
-    foreign_percentage = ratio_to_percentage(len(foreign_beers) / total_ratings)
+    foreign_percentage = ratio_to_percentage(n_foreign / total_ratings)
     # ratio of domestic beers in the rating
-    own_percentage = ratio_to_percentage(len(own_beers) / total_ratings)
-    return len(foreign_beers), len(own_beers), foreign_percentage, own_percentage
+    own_percentage = ratio_to_percentage(n_own / total_ratings)
+    return n_foreign, n_own, foreign_percentage, own_percentage
 
 
-def grouped_counts(df_users_ratings_brew):
+@memoize
+def grouped_counts(df_users_ratings_brew, backend=None):
     """
     Creating the dataframe for the plot_foreign_vs_own_beer_counts method.
-    :param df_users_ratings_brew: the result of merge_ratings_with_breweries.
+    :param df_users_ratings_brew: the result of merge_ratings_with_breweries (or of domestic_foreign_summary)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: the df for plotting
     """
-    # first we group by the location of the user (that's going to be our x-axis), and then by the foreign attribute
-    # (this will determine the color change in the stacked bar). We count the number of entries with the same attribute
-    # combination. Then we use the unstack command to format the results.
-    df_grouped_counts = (
-        df_users_ratings_brew.groupby(["user_location", "foreign"])
-        .size()
-        .unstack(fill_value=0)
+    # the user location is going to be our x-axis, the foreign attribute determines the color change in the stacked
+    # bar. The proportions are scaled so all the bars are of the same size (if you don't the US bar totally
+    # dominates).
+    summary = _summary(df_users_ratings_brew, backend)
+    summary = summary[summary["user_location"].notna()]
+    return (
+        summary.assign(foreign=~summary["is_domestic"].astype(bool))
+        .pivot(index="user_location", columns="foreign", values="proportion")
+        .fillna(0.0)
     )
-    df_grouped_counts = df_grouped_counts.div(
-        df_grouped_counts.sum(axis=1), axis=0
-    )  # scaling the counts so all the bars are of the same size (if you don't the US bar totally dominates)
-    return df_grouped_counts
 
 
 def plot_foreign_vs_own_beer_counts(df_grouped_counts):
@@ -468,42 +598,41 @@ def plot_foreign_vs_own_beer_counts(df_grouped_counts):
     plt.show()
 
 
+@memoize
 def change_flag(df_users_ratings_brew):
     """
     Inverts the foreign flag and calls it is_domestic.
     This is basically a compatibility method to make the transition from Sven's to David's code easier.
     :param df_users_ratings_brew: result of merge_ratings_with_breweries
-    :return: The changed df.
+    :return: The changed df (a new one, the given df stays unchanged).
     """
-    df_users_ratings_brew["foreign"] = ~df_users_ratings_brew["foreign"]  # inverting
-    df_users_ratings_brew = df_users_ratings_brew.rename(
-        columns={"foreign": "is_domestic"}
-    )  # renaming
-
-    return df_users_ratings_brew
+    return df_users_ratings_brew.rename(columns={"foreign": "is_domestic"}).assign(
+        is_domestic=~df_users_ratings_brew["foreign"]
+    )
 
 
-def avg_scores_domestic_foreign(df_users_ratings_brew):
+@memoize
+def avg_scores_domestic_foreign(df_users_ratings_brew, backend=None):
     """
     Groups by user_location and is_domestic. Then calculates mean, std, and count for both foreign and domestic beers.
-    :param df_users_ratings_brew: result of change_flag
+    :param df_users_ratings_brew: result of change_flag (or of merge_ratings_with_breweries or
+    domestic_foreign_summary)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: the grouped df with statistics.
     """
-    return (
-        df_users_ratings_brew.groupby(["user_location", "is_domestic"])["rating"]
-        .agg(["mean", "std", "count"])
-        .reset_index()
-        .rename(columns={"mean": "avg_rating", "std": "std_dev", "count": "n"})
-    )
+    summary = _summary(df_users_ratings_brew, backend)
+    return summary.loc[
+        summary["user_location"].notna(), ["user_location", "is_domestic", "avg_rating", "std_dev", "n"]
+    ].reset_index(drop=True)
 
 
 def pivot_average_scores(df_average_scores):
     """
     Creates separate columns for domestic and foreign ratings along with std and count.
-    :param df_average_scores: the result of avg_scores_domestic_foreign_with_stats
+    :param df_average_scores: the result of avg_scores_domestic_foreign (or of domestic_foreign_summary)
     :return: The new dataframe
     """
-    df_pivot = df_average_scores.pivot(
+    df_pivot = df_average_scores[df_average_scores["user_location"].notna()].pivot(
         index="user_location",
         columns="is_domestic",
         values=["avg_rating", "std_dev", "n"],
@@ -522,24 +651,24 @@ def pivot_average_scores(df_average_scores):
 def calculate_score_difference(df_pivot):
     """
     Computes the difference between domestic and foreign ratings and calculates confidence intervals.
-    :param df_pivot: The result of pivot_average_scores_with_stats.
-    :return: The same df but with the new column difference and CI.
+    :param df_pivot: The result of pivot_average_scores.
+    :return: A copy of the df with the new columns difference, se_diff and ci_95.
     """
     # Calculate difference in average ratings
-    df_pivot["difference"] = df_pivot["Domestic_Avg"] - df_pivot["Foreign_Avg"]
+    difference = df_pivot["Domestic_Avg"] - df_pivot["Foreign_Avg"]
 
     # Calculate standard error for the difference
-    df_pivot["se_diff"] = np.sqrt(
+    se_diff = np.sqrt(
         (df_pivot["Domestic_Std"] ** 2) / df_pivot["Domestic_n"]
         + (df_pivot["Foreign_Std"] ** 2) / df_pivot["Foreign_n"]
     )
 
     # Calculate 95% confidence intervals (using t-distribution)
-    df_pivot["ci_95"] = df_pivot["se_diff"] * t.ppf(
-        0.975, df=(df_pivot["Domestic_n"] + df_pivot["Foreign_n"] - 2)
-    )
+    ci_95 = se_diff * t.ppf(0.975, df=(df_pivot["Domestic_n"] + df_pivot["Foreign_n"] - 2))
 
-    return df_pivot.sort_values(by="difference", ascending=False)
+    return df_pivot.assign(difference=difference, se_diff=se_diff, ci_95=ci_95).sort_values(
+        by="difference", ascending=False
+    )
 
 
 def plot_score_difference(df_diff):
@@ -571,19 +700,35 @@ def plot_score_difference(df_diff):
     plt.show()
 
 
-def plot_average_ratings_heatmap(df):
+def location_pair_stats(df, backend=None):
+    """
+    The average rating and the number of ratings for every combination of user location and brewery location.
+    :param df: the ratings joined with user joined with breweries, or its LocationCube (see build_location_cube)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
+    :return: df with the columns user_location, brewery_location, avg_rating and count_ratings
+    """
+    return _location_cube(df, backend).pair_stats()
+
+
+def _location_cube(df, backend):
+    return df if isinstance(df, LocationCube) else build_location_cube(df, backend)
+
+
+def plot_average_ratings_heatmap(df, user_locations=None, brewery_locations=None, min_count=1, backend=None):
     """
     An exploratory function to see whether user from some specific country like beer from some specific other country
     a lot
-    :param df: the ratings joined with user joined with breweries
+    :param df: the ratings joined with user joined with breweries, or its LocationCube (see build_location_cube)
+    :param user_locations: the user locations to show (default: all)
+    :param brewery_locations: the brewery locations to show (default: all)
+    :param min_count: combinations with fewer ratings are left blank
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: Nothing (plots stuff)
     """
 
-    # group by the location where the user comes from as well as the location the brewery is located
-    # then compute the mean rating for the combination
-    pivot_table = (
-        df.groupby(["user_location", "brewery_location"])["rating"].mean().unstack()
-    )
+    # the mean rating for every combination of the location where the user comes from and the location the brewery
+    # is located, as matrix
+    pivot_table = _location_cube(df, backend).heatmap(user_locations, brewery_locations, min_count)
 
     # plotting the heatmap
     plt.figure(figsize=(12, 8))
@@ -598,36 +743,31 @@ def plot_average_ratings_heatmap(df):
     plt.show()
 
 
-def best_and_worst_combinations(df, threshold=1000):
+def best_and_worst_combinations(df, threshold=1000, k=1, backend=None):
     """
     A method used to find the pair of user-country and brewery-country with the lowest and highest avg score
-    :param df: the joined (ratings-user-brewery) dataframe
+    :param df: the joined (ratings-user-brewery) dataframe, or its LocationCube (see build_location_cube)
     :param threshold: We use a threshold because if not we get for both best and worst a combination that is based on
     just one rating. So we say for a combination to be legitimate there need to be at least 1000(/threshold) many
     ratings in that combination.
+    :param k: the number of best and worst combinations to show
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: Nothing (prints stuff)
     """
-    # group by both locations, calculating both the number of ratings in the combination and the avg rating
-    average_ratings = (
-        df.groupby(["user_location", "brewery_location"])
-        .agg(avg_rating=("rating", "mean"), count_ratings=("rating", "size"))
-        .reset_index()
-    )
+    # the number of ratings and the avg rating (with its CI) of both locations
+    cube = _location_cube(df, backend)
 
     # for a combination to be valid we demand that there are at least 1000(/threshold)
     # many ratings from that combination
-    filtered_ratings = average_ratings[average_ratings["count_ratings"] >= threshold]
-
-    # finding the pair with highest and lowest avg rating
-    worst_rating = filtered_ratings.loc[filtered_ratings["avg_rating"].idxmin()]
-    best_rating = filtered_ratings.loc[filtered_ratings["avg_rating"].idxmax()]
+    worst_ratings = cube.top(k, min_count=threshold, best=False, confidence=0.95)
+    best_ratings = cube.top(k, min_count=threshold, best=True, confidence=0.95)
 
     # print statistics
     print("Combination with the worst average rating::")
-    print(worst_rating)
+    print(worst_ratings.iloc[0] if k == 1 else worst_ratings)
 
     print("\nCombination with the best average rating:")
-    print(best_rating)
+    print(best_ratings.iloc[0] if k == 1 else best_ratings)
 
 
 def filter_to_us_users(df_users):
@@ -636,12 +776,11 @@ def filter_to_us_users(df_users):
     :param df_users: the user dataframe in question
     :return: the filtered dataframe
     """
-    df_us_only = df_users.copy()
-    mask = df_us_only["location"].str.contains("United States, ", na=False)
-    return df_us_only[mask]
+    mask = df_users["location"].str.contains("United States, ", na=False)
+    return df_users[mask]
 
 
-def prepare_datasets(df_rb_users, df_ba_users, df_rb_ratings, df_ba_ratings):
+def prepare_datasets(df_rb_users, df_ba_users, df_rb_ratings, df_ba_ratings, backend=None):
     """
     This is the first preparation step for the "inner-US" analysis.
     It joins the users with the ratings datasets and performs some structural changes.
@@ -649,38 +788,76 @@ def prepare_datasets(df_rb_users, df_ba_users, df_rb_ratings, df_ba_ratings):
     :param df_ba_users: the BeerAdvocate users dataset
     :param df_rb_ratings: the RateBeer ratings dataset (presumably without the text column)
     :param df_ba_ratings: the BeerAdvocate ratings dataset (presumably without the text column)
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return: 2 joined and changed dataframes
     """
+    df_ba_users_ratings_us_only = prepare_dataset(df_ba_users, df_ba_ratings, "BeerAdvocate", backend)
+    df_rb_users_ratings_us_only = prepare_dataset(df_rb_users, df_rb_ratings, "RateBeer", backend)
+    return df_rb_users_ratings_us_only, df_ba_users_ratings_us_only
+
+
+def prepare_dataset(df_users, df_ratings, dataset, backend=None):
+    """
+    prepare_datasets for just one of the two datasets, so that both can be prepared independently.
+    :param df_users: the users dataset (or with the duckdb backend also the path of the users.csv)
+    :param df_ratings: the ratings dataset (presumably without the text column, or with the duckdb backend also
+    the path of a csv/parquet file)
+    :param dataset: "BeerAdvocate" or "RateBeer"
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
+    :return: the joined and changed dataframe
+    """
+    if get_backend(backend) == "duckdb":
+        df_users_ratings_us_only = _prepare_dataset_duckdb(df_users, df_ratings, dataset)
+        print(f"Number of ratings from US from {dataset}:", len(df_users_ratings_us_only))
+        return df_users_ratings_us_only
+
     # in this analysis we're only interested in users from th US
-    df_rb_users_us_only = filter_to_us_users(df_rb_users)
-    df_ba_users_us_only = filter_to_us_users(df_ba_users)
+    df_users_us_only = filter_to_us_users(df_users)
 
     # we drop the nbr_reviews column as it is not present in the RateBeer dataset
-    df_ba_users_us_only.drop(columns=["nbr_reviews"], inplace=True)
+    df_users_us_only = df_users_us_only.drop(columns=["nbr_reviews"], errors="ignore")
     # we add a column to specify from which dataset an entry comes
     # I don't think we will actually need this, but it also doesn't hurt
-    df_ba_users_us_only["dataset"] = "BeerAdvocate"
-    df_rb_users_us_only["dataset"] = "RateBeer"
+    df_users_us_only = df_users_us_only.assign(dataset=dataset)
 
-    # joining with the ratings datasets
-    df_ba_users_ratings_us_only = merge_users_and_ratings(
-        df_ba_ratings, df_ba_users_us_only
-    )
-    df_rb_users_ratings_us_only = merge_users_and_ratings(
-        df_rb_ratings, df_rb_users_us_only
-    )
+    # joining with the ratings dataset
+    df_users_ratings_us_only = merge_users_and_ratings(df_ratings, df_users_us_only)
 
     # some stats never hurt
-    print(
-        "Number of ratings from US from BeerAdvocate:", len(df_ba_users_ratings_us_only)
-    )
-    print("Number of ratings from US from RateBeer:", len(df_rb_users_ratings_us_only))
-
-    return df_rb_users_ratings_us_only, df_ba_users_ratings_us_only
+    print(f"Number of ratings from US from {dataset}:", len(df_users_ratings_us_only))
+
+    return df_users_ratings_us_only
+
+
+def _prepare_dataset_duckdb(df_users, df_ratings, dataset):
+    con = connect()
+    try:
+        register(con, "users", df_users)
+        register(con, "ratings", df_ratings)
+        rating_columns = columns(con, "ratings")
+        user_columns = [c for c in columns(con, "users") if c not in ("user_name", "nbr_reviews")]
+        # the same columns as merge_users_and_ratings: the ratings, then the users, _x/_y for the overlapping ones
+        selected = [
+            f"r.{quote(c)} AS {quote(c + '_x')}" if c in user_columns else f"r.{quote(c)}" for c in rating_columns
+        ] + [f"u.{quote(c)} AS {quote(c + '_y')}" if c in rating_columns else f"u.{quote(c)}" for c in user_columns]
+        dataset = dataset.replace("'", "''")
+        return con.execute(
+            f"""
+            SELECT {", ".join(selected)}, '{dataset}' AS dataset
+            FROM (SELECT *, row_number() OVER () AS __row FROM ratings) r
+            JOIN (
+                SELECT *, row_number() OVER () AS __row FROM users
+                WHERE contains(location, 'United States, ')
+            ) u ON r.user_name = u.user_name
+            ORDER BY r.__row, u.__row
+            """
+        ).df()
+    finally:
+        con.close()
 
 
 def merge_with_brewery(
-    df_rb_users_ratings_us_only, df_ba_users_ratings_us_only, df_rb_brew, df_ba_brew
+    df_rb_users_ratings_us_only, df_ba_users_ratings_us_only, df_rb_brew, df_ba_brew, backend=None
 ):
     """
     Merges the already joined (ratings-users) dataset further with the brewery dataset.
@@ -690,18 +867,29 @@ def merge_with_brewery(
     :param df_ba_users_ratings_us_only: second return value of prepare_datasets
     :param df_rb_brew: the RateBeer brewery dataset
     :param df_ba_brew: the BeerAdvocate brewery dataset
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
     :return:
     """
 
     # joining with brewery data
     df_rb_users_ratings_brew_us_only = merge_ratings_with_breweries(
-        df_rb_users_ratings_us_only, df_rb_brew
+        df_rb_users_ratings_us_only, df_rb_brew, backend
     )
     df_ba_users_ratings_brew_us_only = merge_ratings_with_breweries(
-        df_ba_users_ratings_us_only, df_ba_brew
+        df_ba_users_ratings_us_only, df_ba_brew, backend
+    )
+    return concat_us_datasets(
+        df_rb_users_ratings_brew_us_only, df_ba_users_ratings_brew_us_only
     )
 
-    # concat both dfs
+
+def concat_us_datasets(df_rb_users_ratings_brew_us_only, df_ba_users_ratings_brew_us_only):
+    """
+    Concatenates the RateBeer and the BeerAdvocate US-data (both already joined with the breweries).
+    :param df_rb_users_ratings_brew_us_only: the RateBeer part
+    :param df_ba_users_ratings_brew_us_only: the BeerAdvocate part
+    :return: the one dataframe containing all the US-data
+    """
     df_us_only = pd.concat(
         [df_rb_users_ratings_brew_us_only, df_ba_users_ratings_brew_us_only],
         ignore_index=True,
@@ -712,18 +900,19 @@ def merge_with_brewery(
     return df_us_only
 
 
+@memoize
 def avg_ratings_us(df_us_only):
     """
     Prints the average rating given by US-citizens to beer from the US as well as the average
     rating given by US-citizens to beer that is not from the US
     :param df_us_only: the return val of merge_with_brewery
-    :return: the same df given as an input but with the additional flag "is_us_beer"
+    :return: the df given as an input with the additional flag "is_us_beer" (a new df, the input stays unchanged)
     """
     mask = df_us_only["brewery_location"].str.contains("United States, ", na=False)
     # the foreign column now only tells, whether the beer comes from the exact same US state or not
     # maybe this will be interesting for future analyses, but I will add a new column called "is_us_beer"
     # containing the information whether the beer comes from the US
-    df_us_only["is_us_beer"] = mask
+    df_us_only = df_us_only.assign(is_us_beer=mask)
 
     avg_ratings = df_us_only.groupby("is_us_beer")["rating"].mean()
     print("Avg rating for US beer:", avg_ratings[True])
@@ -732,6 +921,7 @@ def avg_ratings_us(df_us_only):
     return df_us_only
 
 
+@memoize
 def avg_ratings_per_location_us(df_us_only):
     """
     Computes the average ratings for both foreign and US beer for all the US states individually.
@@ -739,13 +929,11 @@ def avg_ratings_per_location_us(df_us_only):
     :param df_us_only: the return val of avg_ratings_us
     :return: the average rating differences for both foreign and US beer for all the US states
     """
-    # we rename the user location to contain just the states name, as every user location is in the US by now
-    df_us_only["user_location"] = df_us_only["user_location"].str.replace(
-        "United States, ", "", regex=False
-    )
+    # we group by just the states name, as every user location is in the US by now
+    state = df_us_only["user_location"].str.replace("United States, ", "", regex=False)
     # compute the average ratings for both foreign and US beer for all the US states
     avg_ratings_per_location = (
-        df_us_only.groupby(["user_location", "is_us_beer"])["rating"].mean().unstack()
+        df_us_only.groupby([state, "is_us_beer"])["rating"].mean().unstack()
     )
     # calculate the differences
     avg_ratings_per_location["Difference"] = (
@@ -775,6 +963,7 @@ def plot_avg_ratings_per_location(avg_ratings_per_location):
     plt.show()
 
 
+@memoize
 def north_south_avg(df_us_only):
     """
     Creates a table for the avg ratings for northern US states and southern US states (and others that are neither)
@@ -782,19 +971,21 @@ def north_south_avg(df_us_only):
     :param df_us_only: the return val of avg_ratings_us
     :return: the table containing those averages
     """
-    # add a column "region" that can be "South" for a southern state where the user comes from
+    # the region can be "South" for a southern state where the user comes from
     # "North" for a northern state where the user comes from, or "Other" otherwise
-    df_us_only["region"] = df_us_only["user_location"].apply(
+    region = df_us_only["user_location"].str.replace(
+        "United States, ", "", regex=False
+    ).apply(
         lambda x: (
             "South"
             if x in southern_states
             else ("North" if x in northern_states else "Other")
         )
-    )
+    ).rename("region")
 
     # create the average rating for each group
     average_ratings = (
-        df_us_only.groupby(["region", "is_us_beer"])["rating"].mean().unstack()
+        df_us_only.groupby([region, "is_us_beer"])["rating"].mean().unstack()
     )
     # until now the columns are called True for is_us_beer=True and False for is_us_beer=False
     # renaming that for better readability
@@ -896,8 +1087,59 @@ def plot_avg_ratings_map(avg_ratings_per_location, large_map=True, save=True):
     # Show the plot
     if save:
         if large_map:
-            fig.write_html("src/plots/US_map2.html")  # different file name, so I am able to compare...
+            write_html(fig, "src/plots/US_map2.html")  # different file name, so I am able to compare...
             return
-        fig.write_html("src/plots/US_map.html")
+        write_html(fig, "src/plots/US_map.html")
     else:
         fig.show()
+
+
+def drop_text(df_ratings):
+    """
+    :param df_ratings: a ratings df with the text column
+    :return: the same df without the text column, we don't need it after the duplicate search and it is very big
+    """
+    return df_ratings.drop(columns=["text"])
+
+
+def us_patriotism_pipeline(cache_dir="src/data/pipeline", max_workers=None):
+    """
+    The whole "inner-US" analysis as a Pipeline. The BeerAdvocate and the RateBeer branch run concurrently,
+    the intermediates are persisted and on a re-run only the stages after a change are executed again.
+    Sources: rb_users, ba_users, rb_ratings, ba_ratings (both with the text column), rb_brew, ba_brew
+    Results: avg_ratings_per_location, north_south and the sink us_map (plot_avg_ratings_map)
+
+    Example:
+        pipeline = us_patriotism_pipeline()
+        results = pipeline.run(
+            dict(rb_users=df_rb_users, ba_users=df_ba_users, rb_ratings=df_rb_ratings, ba_ratings=df_ba_ratings,
+                 rb_brew=df_brew, ba_brew=df_ba_brew),
+            targets=["avg_ratings_per_location", "north_south"],
+        )
+    :param cache_dir: where the intermediates are stored
+    :param max_workers: the number of threads for independent stages
+    :return: the pipeline
+    """
+    stages = [
+        Stage(prepare_dataset, ["rb_users", "rb_ratings"], ["rb_us"], name="prepare_rb",
+              params=dict(dataset="RateBeer")),
+        Stage(prepare_dataset, ["ba_users", "ba_ratings"], ["ba_us"], name="prepare_ba",
+              params=dict(dataset="BeerAdvocate")),
+        # there are some duplicates in the two datasets
+        Stage(filter_usa_duplicates, ["rb_us", "ba_us"], ["rb_us_dedup"],
+              params=dict(cols=["style", "brewery_name", "abv", "text"])),
+        Stage(drop_text, ["rb_us_dedup"], ["rb_us_wo_text"], name="drop_text_rb", persist=False),
+        Stage(drop_text, ["ba_us"], ["ba_us_wo_text"], name="drop_text_ba", persist=False),
+        Stage(merge_ratings_with_breweries, ["rb_us_wo_text", "rb_brew"], ["rb_us_brew"], name="merge_brewery_rb"),
+        Stage(merge_ratings_with_breweries, ["ba_us_wo_text", "ba_brew"], ["ba_us_brew"], name="merge_brewery_ba"),
+        Stage(concat_us_datasets, ["rb_us_brew", "ba_us_brew"], ["us_only"]),
+        Stage(avg_ratings_us, ["us_only"], ["us_only_flagged"]),
+        Stage(avg_ratings_per_location_us, ["us_only_flagged"], ["avg_ratings_per_location"]),
+        Stage(north_south_avg, ["us_only_flagged"], ["north_south"]),
+        Stage(plot_avg_ratings_map, ["avg_ratings_per_location"], [], name="us_map",
+              params=dict(large_map=True, save=True)),
+    ]
+    return Pipeline(stages, cache_dir, max_workers)
+
+
+instrument_module(__name__)
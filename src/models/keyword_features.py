@@ -0,0 +1,186 @@
+"""
+Keyword similarity features of the rating preference predictor of the site ("Taking bias into account").
+
+The vocabulary are 77 keywords: words that describe beers positively or negatively plus the exp_words1 of
+experience_words. For every rating, the keyword distribution of the user's good reviews (rating > 3.7) is compared
+with the keyword distribution of the good reviews of the beer (inner product of the two distributions), and the same
+for the bad reviews (rating < 2.8). The rating itself is left out of both distributions (leave-one-out), otherwise
+its own words would tell the model whether it is a good or a bad rating.
+
+The texts are scanned once into a sparse rating × keyword count matrix (or the counts are read from the text index,
+without reading any text). The user × keyword and beer × keyword matrices are sums of its rows, and the similarities
+of all the ratings are row-wise sparse dot products in batches, where leaving the rating out is subtracting its own
+row:
+
+    counts = keyword_counts(df_ratings, index=load_text_index(ba_path))
+    similarities = keyword_similarity_features(df_ratings, counts)     # good_similarity, bad_similarity
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.models.experience_words import exp_words1
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+DESCRIPTIVE_WORDS = """
+    malty hoppy crisp smooth creamy balanced refreshing rich complex juicy fruity citrus tropical floral piney caramel
+    toffee chocolate coffee roasty vanilla honey bready biscuit nutty spicy clean dry velvety silky bright fresh sweet
+    bitter tart sour funky earthy herbal grassy acidic watery thin flat metallic skunky stale cardboard harsh cloying
+    syrupy soapy medicinal boozy solvent vinegar sulfur papery buttery bland muddy
+    """.split()
+KEYWORDS = DESCRIPTIVE_WORDS + [word.lower() for word in exp_words1]
+
+# fixed thresholds instead of per-user quantiles, see the site for why
+GOOD_THRESHOLD = 3.7
+BAD_THRESHOLD = 2.8
+
+
+def _keyword_regexes(keywords):
+    # whole words, phrases separately so that the "dry" of "dry hop" counts for both
+    words = [re.escape(k) for k in keywords if " " not in k]
+    phrases = [re.escape(k) for k in keywords if " " in k]
+    return [r"\b(?:" + "|".join(group) + r")\b" for group in (words, phrases) if group]
+
+
+def _matrix(rows, keyword_ids, n_rows, n_keywords):
+    # duplicates are summed up, i.e. the entries are the number of occurrences
+    data = np.ones(len(rows), dtype=np.float32)
+    return sparse.csr_matrix((data, (rows, keyword_ids)), shape=(n_rows, n_keywords))
+
+
+def keyword_counts(df, keywords=KEYWORDS, texts=None, index=None, chunksize=100_000, progress=None):
+    """
+    How often every keyword occurs in every review, in one scan of the texts. Keywords match as whole words,
+    case-insensitive.
+    :param df: the ratings (text, unless texts or index are given). Its index are the row ids of the stores.
+    :param keywords: the vocabulary, phrases like "dry hop" are possible
+    :param texts: the TextStore of the ratings (see load_rating_texts), the texts are then streamed from it
+    :param index: or the TextIndex of the ratings (see load_text_index), then no text is read at all
+    :param chunksize: the texts are scanned in chunks of that many rows
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: sparse matrix (csr) with a row per rating of df (in the order of df) and a column per keyword
+    """
+    keywords = [k.lower() for k in keywords]
+    positions = pd.Index(df.index)
+    row_parts, keyword_parts = [], []
+    if index is not None:
+        for keyword_id, keyword in enumerate(keywords):
+            rows = positions.get_indexer(index.occurrences(keyword.split()))
+            rows = rows[rows >= 0]
+            row_parts.append(rows)
+            keyword_parts.append(np.full(len(rows), keyword_id))
+    else:
+        keyword_ids = pd.Series(np.arange(len(keywords)), index=keywords)
+        patterns = _keyword_regexes(keywords)
+        chunks = texts.iter_chunks(df.index, chunksize) if texts is not None else (
+            df["text"].iloc[start : start + chunksize] for start in range(0, len(df), chunksize)
+        )
+        done = 0
+        with track(progress, "count keywords", total=len(df)) as tracker:
+            for chunk in chunks:
+                chunk = chunk.str.lower()
+                for pattern in patterns:
+                    found = chunk.str.findall(pattern)
+                    matches = found.explode().dropna()
+                    # the row of every match, the chunks are consecutive slices of df
+                    lengths = found.str.len().fillna(0).to_numpy(dtype=np.int64)
+                    row_parts.append(done + np.repeat(np.arange(len(chunk)), lengths))
+                    keyword_parts.append(keyword_ids[matches.to_numpy()].to_numpy())
+                done += len(chunk)
+                tracker.update(len(chunk))
+    rows = np.concatenate(row_parts) if row_parts else np.zeros(0, dtype=np.int64)
+    keyword_ids = np.concatenate(keyword_parts) if keyword_parts else np.zeros(0, dtype=np.int64)
+    return _matrix(rows, keyword_ids, len(df), len(keywords))
+
+
+def keyword_profiles(codes, n_codes, selected, counts):
+    """
+    The keyword counts of the selected reviews, summed up per user (or beer).
+    :param codes: the non-negative code of the user (beer) of every row of counts, at least for the selected rows
+    :param n_codes: the number of users (beers)
+    :param selected: bool per row of counts, e.g. the good reviews
+    :param counts: the keyword counts of the ratings (see keyword_counts)
+    :return: (csr matrix with a row per code and a column per keyword, the total count of every row)
+    """
+    # the rows of counts are relabelled with the codes, csr sums up the duplicates
+    entries = counts.tocoo()
+    keep = selected[entries.row]
+    profiles = sparse.csr_matrix(
+        (entries.data[keep], (codes[entries.row[keep]], entries.col[keep])), shape=(n_codes, counts.shape[1])
+    )
+    return profiles, np.asarray(profiles.sum(axis=1), dtype=np.float64).ravel()
+
+
+def _rowwise_dot(a, b):
+    # a sparse, b sparse or dense: only the non-zeros of a are touched
+    return np.asarray(a.multiply(b).sum(axis=1), dtype=np.float64).ravel()
+
+
+def keyword_similarity_features(
+    df,
+    counts,
+    good_threshold=GOOD_THRESHOLD,
+    bad_threshold=BAD_THRESHOLD,
+    batch_size=200_000,
+    progress=None,
+):
+    """
+    The inner product of the keyword distributions of the user and of the beer, over the good and the bad reviews,
+    for every rating. The rating itself is left out of both distributions.
+    :param df: the ratings (user_id, beer_id, rating), in the order of counts
+    :param counts: the keyword counts of the ratings (see keyword_counts)
+    :param good_threshold: reviews with a higher rating are good
+    :param bad_threshold: reviews with a lower rating are bad
+    :param batch_size: ratings per batch of row-wise products (bounds the memory)
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: df indexed like df with the columns good_similarity and bad_similarity (float32), NaN where the user or
+    the beer have no keywords in their other good (bad) reviews
+    """
+    counts = sparse.csr_matrix(counts, dtype=np.float32)
+    ratings = df["rating"].to_numpy(dtype=np.float64)
+    user_codes, users = pd.factorize(df["user_id"])
+    beer_codes, beers = pd.factorize(df["beer_id"])
+    # ratings without user or beer point to an extra row that stays empty
+    known = (user_codes >= 0) & (beer_codes >= 0)
+    user_codes = np.where(user_codes >= 0, user_codes, len(users))
+    beer_codes = np.where(beer_codes >= 0, beer_codes, len(beers))
+    own_sums = np.asarray(counts.sum(axis=1)).ravel()
+
+    features = {}
+    with np.errstate(invalid="ignore"):
+        classes = {"good": known & (ratings > good_threshold), "bad": known & (ratings < bad_threshold)}
+    with track(progress, "keyword similarities", total=len(df) * len(classes)) as tracker:
+        for name, selected in classes.items():
+            user_profiles, user_sums = keyword_profiles(user_codes, len(users) + 1, selected, counts)
+            beer_profiles, beer_sums = keyword_profiles(beer_codes, len(beers) + 1, selected, counts)
+            similarity = np.empty(len(df), dtype=np.float32)
+            for start in range(0, len(df), batch_size):
+                batch = slice(start, start + batch_size)
+                own = counts[batch]
+                # the profiles of the batch as dense blocks: with 77 keywords that is cheaper than sparse × sparse,
+                # and the memory stays bounded by the batch size
+                users_batch = user_profiles[user_codes[batch]].toarray()
+                beers_batch = beer_profiles[beer_codes[batch]].toarray()
+                # (u - s·r)·(b - s·r) = u·b - s·(u·r + b·r) + s·r·r, with s = 1 if the rating is in the class
+                s = selected[batch].astype(np.float64)
+                dot = (
+                    np.einsum("ij,ij->i", users_batch, beers_batch, dtype=np.float64)
+                    - s * (_rowwise_dot(own, users_batch) + _rowwise_dot(own, beers_batch))
+                    + s * _rowwise_dot(own, own)
+                )
+                user_total = user_sums[user_codes[batch]] - s * own_sums[batch]
+                beer_total = beer_sums[beer_codes[batch]] - s * own_sums[batch]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    similarity[batch] = np.where(
+                        (user_total > 0) & (beer_total > 0), dot / (user_total * beer_total), np.nan
+                    )
+                tracker.update(len(s))
+            features[f"{name}_similarity"] = similarity
+    return pd.DataFrame(features, index=df.index)
+
+
+instrument_module(__name__)
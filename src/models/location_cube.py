@@ -0,0 +1,262 @@
+"""
+Sparse cross-tab of the ratings by user location × brewery location.
+
+The cube holds the number of ratings and the number, sum and sum of squares of the rating values of every
+combination of locations that occurs, built in one pass over the integer codes of the locations. Like the groupby of
+foreign_beer, count_ratings (and every min_count) counts all the ratings of a combination, also those without a
+rating value, while the averages and deviations are over the rating values. Everything the heatmap and the best/worst queries of
+foreign_beer need (averages, standard deviations, confidence intervals, thresholded top-K, the heatmap of any
+subset of countries) is computed from these few thousand cells, without touching the ratings again.
+
+    cube = build_location_cube(df_joined)     # df_joined: see join_users_breweries_ratings
+    cube.save("src/data/BA_location_cube.npz")
+    cube = LocationCube.load("src/data/BA_location_cube.npz")
+    cube.top(10, min_count=1000)              # the 10 best combinations with at least 1000 ratings
+    cube.heatmap(["Germany", "Belgium", "England"])
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t
+
+from src.utils.backend import get_backend, query
+from src.utils.instrument import instrument_module
+
+
+class LocationCube:
+    """
+    The statistics of the ratings per (user location, brewery location), stored sparse: one entry per combination
+    with at least one rating, sorted by the user location and then by the brewery location. The sums are taken over
+    rating - shift (the mean of all the ratings), so the variances don't lose precision.
+    """
+
+    def __init__(self, locations, user_codes, brewery_codes, count, total, total_sq, shift=0.0, size=None):
+        """
+        :param locations: the sorted names of all the locations, shared by users and breweries
+        :param user_codes: the user location of every entry, as index into locations
+        :param brewery_codes: the brewery location of every entry, as index into locations
+        :param count: the number of rating values (ratings that aren't NaN) of every entry
+        :param total: the sum of rating - shift of every entry
+        :param total_sq: the sum of (rating - shift)² of every entry
+        :param shift: see above
+        :param size: the number of ratings of every entry, with or without rating value (default: count)
+        """
+        self.locations = pd.Index(locations, dtype=object)
+        self.user_codes = np.asarray(user_codes, dtype=np.int32)
+        self.brewery_codes = np.asarray(brewery_codes, dtype=np.int32)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.total = np.asarray(total, dtype=np.float64)
+        self.total_sq = np.asarray(total_sq, dtype=np.float64)
+        self.shift = float(shift)
+        self.size = self.count if size is None else np.asarray(size, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.count)
+
+    @property
+    def mean(self):
+        """
+        :return: the average rating of every entry (NaN without rating values)
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.total / self.count + self.shift
+
+    @property
+    def std(self):
+        """
+        :return: the sample standard deviation of the ratings of every entry (NaN for a single rating)
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (self.total_sq - self.total**2 / self.count) / (self.count - 1)
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def ci(self, confidence=0.95):
+        """
+        :param confidence: the confidence level
+        :return: the half-width of the confidence interval of the average of every entry (t-distribution, like
+        calculate_score_difference), NaN for a single rating
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.std / np.sqrt(self.count) * t.ppf((1 + confidence) / 2, df=self.count - 1)
+
+    def _frame(self, entries, confidence=None):
+        data = {
+            "user_location": self.locations[self.user_codes[entries]],
+            "brewery_location": self.locations[self.brewery_codes[entries]],
+            "avg_rating": self.mean[entries],
+            "count_ratings": self.size[entries],
+        }
+        if confidence is not None:
+            data["std_dev"] = self.std[entries]
+            data[f"ci_{round(confidence * 100)}"] = self.ci(confidence)[entries]
+        return pd.DataFrame(data)
+
+    def pair_stats(self, min_count=1, confidence=None):
+        """
+        :param min_count: only the combinations with at least this many ratings (with or without rating value)
+        :param confidence: if given, also the columns std_dev and ci_<confidence in %> (e.g. ci_95)
+        :return: df with the columns user_location, brewery_location, avg_rating and count_ratings, sorted by the
+        locations (the same as location_pair_stats)
+        """
+        return self._frame(np.flatnonzero(self.size >= min_count), confidence)
+
+    def top(self, k, min_count=1, best=True, confidence=None):
+        """
+        The combinations with the highest (or lowest) average rating. Only the k selected entries are sorted
+        (np.argpartition), not all of them. Combinations without any rating value have no average and are left out.
+        :param k: the number of combinations
+        :param min_count: only the combinations with at least this many ratings (with or without rating value)
+        :param best: the highest averages (False: the lowest)
+        :param confidence: see pair_stats
+        :return: df like pair_stats, the best (worst) first
+        """
+        candidates = np.flatnonzero((self.size >= min_count) & (self.count > 0))
+        keys = self.mean[candidates] * (-1 if best else 1)
+        k = min(k, len(candidates))
+        if k == 0:
+            return self._frame(candidates[:0], confidence)
+        selected = np.argpartition(keys, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+        selected = selected[np.argsort(keys[selected], kind="stable")]
+        return self._frame(candidates[selected], confidence).reset_index(drop=True)
+
+    def heatmap(self, user_locations=None, brewery_locations=None, min_count=1, value="avg_rating"):
+        """
+        The dense matrix of a subset of the locations, for plotting.
+        :param user_locations: the rows (default: all user locations with ratings)
+        :param brewery_locations: the columns (default: all brewery locations with ratings)
+        :param min_count: combinations with fewer ratings are left empty (NaN)
+        :param value: avg_rating, count_ratings, std_dev or ci_95
+        :return: df indexed by user_location with one column per brewery_location, NaN where there are no ratings
+        """
+        values = {
+            "avg_rating": self.mean,
+            "count_ratings": self.size,
+            "std_dev": self.std,
+            "ci_95": self.ci(0.95),
+        }[value]
+        if user_locations is None:
+            user_locations = self.locations[np.unique(self.user_codes)]
+        if brewery_locations is None:
+            brewery_locations = self.locations[np.unique(self.brewery_codes)]
+        user_locations = pd.Index(user_locations, name="user_location")
+        brewery_locations = pd.Index(brewery_locations, name="brewery_location")
+
+        # the position of every location in the rows / columns of the matrix, -1 if it isn't part of it
+        row_of = np.full(len(self.locations) + 1, -1)
+        column_of = np.full(len(self.locations) + 1, -1)
+        row_of[self.locations.get_indexer(user_locations)] = np.arange(len(user_locations))
+        column_of[self.locations.get_indexer(brewery_locations)] = np.arange(len(brewery_locations))
+        rows, columns = row_of[self.user_codes], column_of[self.brewery_codes]
+        selected = (rows >= 0) & (columns >= 0) & (self.size >= min_count)
+
+        matrix = np.full((len(user_locations), len(brewery_locations)), np.nan)
+        matrix[rows[selected], columns[selected]] = values[selected]
+        return pd.DataFrame(matrix, index=user_locations, columns=brewery_locations)
+
+    def save(self, path):
+        """
+        Writes the cube to one .npz file.
+        :param path: the file
+        """
+        np.savez(
+            path,
+            locations=np.asarray(self.locations, dtype=str),
+            user_codes=self.user_codes,
+            brewery_codes=self.brewery_codes,
+            count=self.count,
+            total=self.total,
+            total_sq=self.total_sq,
+            shift=np.float64(self.shift),
+            size=self.size,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a file written by save
+        :return: the cube
+        """
+        with np.load(path) as data:
+            return cls(
+                data["locations"].astype(object),
+                data["user_codes"],
+                data["brewery_codes"],
+                data["count"],
+                data["total"],
+                data["total_sq"],
+                data["shift"],
+                # cubes saved before the size was stored
+                data["size"] if "size" in data.files else None,
+            )
+
+
+def _build_duckdb(df):
+    shift = query("SELECT avg(rating) AS shift FROM ratings", ratings=df)["shift"].iloc[0]
+    shift = 0.0 if pd.isna(shift) else float(shift)
+    cells = query(
+        f"""
+        SELECT user_location, brewery_location, count(*) AS size, count(rating) AS count,
+            coalesce(sum(rating - {shift!r}), 0) AS total, coalesce(sum((rating - {shift!r}) ^ 2), 0) AS total_sq
+        FROM ratings
+        WHERE user_location IS NOT NULL AND brewery_location IS NOT NULL
+        GROUP BY ALL ORDER BY user_location, brewery_location
+        """,
+        ratings=df,
+    )
+    locations = pd.Index(np.union1d(cells["user_location"].unique(), cells["brewery_location"].unique()))
+    return LocationCube(
+        locations,
+        locations.get_indexer(cells["user_location"]),
+        locations.get_indexer(cells["brewery_location"]),
+        cells["count"],
+        cells["total"],
+        cells["total_sq"],
+        shift,
+        cells["size"],
+    )
+
+
+def build_location_cube(df, backend=None):
+    """
+    Builds the cube in one pass over the ratings.
+    :param df: the ratings joined with users and breweries (user_location, brewery_location, rating), with the
+    duckdb backend also the path of such a csv or parquet file. Ratings without location are left out, ratings
+    without a rating value only count for count_ratings.
+    :param backend: "pandas" or "duckdb" (None: the global backend, see src.utils.backend)
+    :return: the LocationCube
+    """
+    if get_backend(backend) == "duckdb":
+        return _build_duckdb(df)
+
+    # one sorted dictionary for both columns, so that the codes of a location are the same in both
+    user_codes, user_locations = pd.factorize(df["user_location"], sort=True)
+    brewery_codes, brewery_locations = pd.factorize(df["brewery_location"], sort=True)
+    locations = pd.Index(
+        np.union1d(np.asarray(user_locations, dtype=object), np.asarray(brewery_locations, dtype=object))
+    )
+    user_codes = np.where(user_codes >= 0, locations.get_indexer(user_locations)[user_codes], -1)
+    brewery_codes = np.where(brewery_codes >= 0, locations.get_indexer(brewery_locations)[brewery_codes], -1)
+
+    ratings = df["rating"].to_numpy(dtype=np.float64)
+    located = (user_codes >= 0) & (brewery_codes >= 0)
+    ratings = ratings[located]
+    rated = ~np.isnan(ratings)
+    shift = ratings[rated].mean() if rated.any() else 0.0
+    centered = np.where(rated, ratings - shift, 0.0)
+
+    # one integer key per combination, the cells are the combinations that occur
+    pair_keys = user_codes[located].astype(np.int64) * len(locations) + brewery_codes[located]
+    cell_of, cells = pd.factorize(pair_keys, sort=True)
+    return LocationCube(
+        locations,
+        cells // len(locations),
+        cells % len(locations),
+        np.bincount(cell_of, weights=rated, minlength=len(cells)),
+        np.bincount(cell_of, weights=centered, minlength=len(cells)),
+        np.bincount(cell_of, weights=centered**2, minlength=len(cells)),
+        shift,
+        np.bincount(cell_of, minlength=len(cells)),
+    )
+
+
+instrument_module(__name__)
@@ -0,0 +1,530 @@
+"""
+Batch scoring of the rating preference predictor of the site ("Taking bias into account"): which of a list of
+candidate beers a user most likely rates above their own average, e.g. to decide which beers to advertise to whom.
+
+The features of a (user, beer) pair are the features of the feature table (see build_feature_table) as a new rating
+would get them today. They come from a feature store that is computed once per dataset: the user features over all
+the ratings of the user, the user × style statistics and the keyword distributions of the good and the bad reviews of
+every user and beer. Scoring a block of users × candidates is then only gathers from the store, one matrix product
+per similarity and the matrix products of the network, in large float32 batches on a pool of threads (NumPy and
+BLAS release the GIL):
+
+    store = load_feature_store("src/data/BeerAdvocate/ratings.csv")
+    model = PreferenceMLP.load("src/data/preference_model.npz")
+    top = score_candidates(store, model, user_ids, candidate_beer_ids, k=10, exclude=df_ratings)
+    top.attrs["pairs_per_second"]
+
+    python -m src.models.preference_scoring src/data/BeerAdvocate/ratings.csv src/data/preference_model.npz \\
+        --users users.txt --beers beers.txt --k 10 --out top10.csv
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.data.some_dataloader import load_rating_columns, load_rating_texts, load_text_index
+from src.models.experience_words import exp_word_matches, exp_words1
+from src.models.keyword_features import BAD_THRESHOLD, GOOD_THRESHOLD, KEYWORDS, keyword_counts, keyword_profiles
+from src.models.user_features import FEATURE_INPUT_COLUMNS
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+# the layers of the network of the site, between the features and the output
+HIDDEN_LAYERS = (52, 35, 25, 20)
+STORE_VERSION = 1
+USER_STYLE_FEATURES = ["user_style_num_rating", "user_style_mean"]
+SIMILARITY_FEATURES = {"good_similarity": "good", "bad_similarity": "bad"}
+
+
+class PreferenceMLP:
+    """
+    The predictor as a NumPy network: fully connected ReLU layers and a sigmoid output, the probability that the user
+    rates the beer above their average. The inputs are standardized with shift and scale first, which is folded into
+    the first layer, so predicting is only matrix products.
+    """
+
+    def __init__(self, features, weights, biases, shift=None, scale=None):
+        """
+        :param features: the names of the inputs, in the order of the columns of X
+        :param weights: the weight matrices (inputs × outputs) of the layers, the last one has one output
+        :param biases: the bias vectors of the layers
+        :param shift: subtracted from the inputs (default: 0)
+        :param scale: the shifted inputs are divided by it (default: 1)
+        """
+        if len(weights) != len(biases) or not weights:
+            raise ValueError("The network needs a bias for every weight matrix and at least one layer")
+        if weights[0].shape[0] != len(features) or weights[-1].shape[1] != 1:
+            raise ValueError(f"The network needs {len(features)} inputs and one output")
+        self.features = list(features)
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32).ravel() for b in biases]
+        self.shift = np.zeros(len(features)) if shift is None else np.asarray(shift, dtype=np.float64)
+        self.scale = np.ones(len(features)) if scale is None else np.asarray(scale, dtype=np.float64)
+        # (X - shift) / scale @ W + b = X @ (W / scale) + (b - shift / scale @ W)
+        first = self.weights[0].astype(np.float64)
+        self._layers = [
+            ((first / self.scale[:, None]).astype(np.float32),
+             (self.biases[0] - (self.shift / self.scale) @ first).astype(np.float32))
+        ] + list(zip(self.weights[1:], self.biases[1:]))
+
+    @classmethod
+    def random(cls, features, hidden=HIDDEN_LAYERS, seed=0, shift=None, scale=None):
+        """
+        An untrained network (He initialization), the start of a training or a stand-in for benchmarks.
+        :param features: the names of the inputs
+        :param hidden: the sizes of the hidden layers
+        :param seed: the seed of the weights
+        :return: the PreferenceMLP
+        """
+        rng = np.random.default_rng(seed)
+        sizes = [len(features), *hidden, 1]
+        weights = [rng.normal(0, np.sqrt(2 / n_in), (n_in, n_out)) for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+        return cls(features, weights, [np.zeros(n) for n in sizes[1:]], shift, scale)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a npz file written by save
+        :return: the PreferenceMLP
+        """
+        with np.load(path) as f:
+            n_layers = sum(name.startswith("weight") for name in f.files)
+            return cls(
+                [str(name) for name in f["features"]],
+                [f[f"weight{i}"] for i in range(n_layers)],
+                [f[f"bias{i}"] for i in range(n_layers)],
+                f["shift"],
+                f["scale"],
+            )
+
+    def save(self, path):
+        """
+        :param path: the npz file
+        """
+        layers = {f"weight{i}": w for i, w in enumerate(self.weights)}
+        layers.update({f"bias{i}": b for i, b in enumerate(self.biases)})
+        np.savez(path, features=np.array(self.features), shift=self.shift, scale=self.scale, **layers)
+
+    def predict(self, X, block_rows=16384):
+        """
+        :param X: float32 array (rows × features), without NaN
+        :param block_rows: rows that go through the network at once, small enough that the activations stay in the
+        CPU cache (twice as fast as whole batches of a million rows)
+        :return: the probability of every row, float32
+        """
+        scores = np.empty(len(X), dtype=np.float32)
+        for start in range(0, len(X), block_rows):
+            out = X[start : start + block_rows]
+            for W, b in self._layers[:-1]:
+                out = out @ W
+                out += b
+                np.maximum(out, 0, out=out)
+            W, b = self._layers[-1]
+            scores[start : start + block_rows] = (out @ W).ravel() + b
+        # the sigmoid, in place (exp overflows to inf for very negative logits, which gives the right 0)
+        np.negative(scores, out=scores)
+        with np.errstate(over="ignore"):
+            np.exp(scores, out=scores)
+        scores += 1
+        return np.reciprocal(scores, out=scores)
+
+
+def _distributions(profiles, sums):
+    # the rows of the profiles divided by their totals (float32, dense), and which rows have keywords at all
+    dense = profiles.toarray().astype(np.float32)
+    has_keywords = sums > 0
+    dense[has_keywords] /= sums[has_keywords, None].astype(np.float32)
+    return dense, has_keywords
+
+
+def build_feature_store(
+    df,
+    directory,
+    exp_matches=None,
+    counts=None,
+    min_exp_ratings=10,
+    min_exp_words=5,
+    good_threshold=GOOD_THRESHOLD,
+    bad_threshold=BAD_THRESHOLD,
+):
+    """
+    Writes the feature store of a ratings dataset: the features of point_in_time_features and of
+    keyword_similarity_features as they are after all the ratings.
+    :param df: the ratings (user_id, beer_id, style, date, rating), ratings without user, date or rating don't count
+    :param directory: the directory of the store, replaced if it exists
+    :param exp_matches: the exp words of the ratings (see exp_word_matches), None leaves out the experience features
+    :param counts: the keyword counts of the ratings (see keyword_counts), None leaves out the similarities
+    :param min_exp_ratings: see point_in_time_features
+    :param min_exp_words: see point_in_time_features
+    :param good_threshold: see keyword_similarity_features
+    :param bad_threshold: see keyword_similarity_features
+    :return: the directory
+    """
+    ratings = df["rating"].to_numpy(dtype=np.float64)
+    user_codes, users = pd.factorize(df["user_id"])
+    beer_codes, beers = pd.factorize(df["beer_id"])
+    style_codes, styles = pd.factorize(df["style"])
+    valid = (user_codes >= 0) & ~np.isnan(ratings) & df["date"].notna().to_numpy()
+    n_users = len(users)
+
+    user_count = np.bincount(user_codes[valid], minlength=n_users)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        user_mean = np.bincount(user_codes[valid], weights=ratings[valid], minlength=n_users) / user_count
+    user_table = pd.DataFrame(
+        {
+            "user_id": np.asarray(users),
+            "user_num_rating": user_count.astype(np.int32),
+            "user_mean": user_mean.astype(np.float32),
+        }
+    )
+    features = ["user_num_rating", "user_mean", *USER_STYLE_FEATURES]
+    if exp_matches is not None:
+        positions = pd.Index(df.index).get_indexer(exp_matches["row"])
+        matched = positions >= 0
+        positions, words = positions[matched], exp_matches["word"].to_numpy()[matched]
+        counted = valid[positions]
+        positions, words = positions[counted], pd.factorize(words[counted])[0]
+        exp_ratings = np.bincount(user_codes[np.unique(positions)], minlength=n_users)
+        # the distinct (user, word) pairs
+        n_words = words.max(initial=-1) + 1
+        pairs = np.unique(user_codes[positions].astype(np.int64) * n_words + words)
+        exp_words = np.bincount(pairs // max(n_words, 1), minlength=n_users)
+        user_table["user_exp_ratings"] = exp_ratings.astype(np.int32)
+        user_table["user_exp_words"] = exp_words.astype(np.int32)
+        user_table["is_exp"] = ((exp_ratings >= min_exp_ratings) & (exp_words >= min_exp_words)).astype(np.int8)
+        features += ["user_exp_ratings", "user_exp_words", "is_exp"]
+
+    # the (user, style) pairs with ratings as sorted keys, looked up with searchsorted
+    styled = valid & (style_codes >= 0)
+    keys, inverse = np.unique(
+        user_codes[styled].astype(np.int64) * len(styles) + style_codes[styled], return_inverse=True
+    )
+    style_count = np.bincount(inverse, minlength=len(keys))
+    style_mean = np.bincount(inverse, weights=ratings[styled], minlength=len(keys)) / np.maximum(style_count, 1)
+    # the style of a beer is the style of its ratings
+    beer_style = np.full(len(beers), -1, dtype=np.int32)
+    known_beer = (beer_codes >= 0) & (style_codes >= 0)
+    beer_style[beer_codes[known_beer]] = style_codes[known_beer]
+
+    tmp_directory = directory + ".tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    try:
+        user_table.to_parquet(os.path.join(tmp_directory, "users.parquet"), index=False)
+        pd.DataFrame({"beer_id": np.asarray(beers), "style": beer_style}).to_parquet(
+            os.path.join(tmp_directory, "beers.parquet"), index=False
+        )
+        np.savez(
+            os.path.join(tmp_directory, "user_styles.npz"),
+            keys=keys,
+            count=style_count.astype(np.int32),
+            mean=style_mean.astype(np.float32),
+        )
+        if counts is not None:
+            counts = sparse.csr_matrix(counts, dtype=np.float32)
+            with np.errstate(invalid="ignore"):
+                classes = {"good": valid & (ratings > good_threshold), "bad": valid & (ratings < bad_threshold)}
+            for name, selected in classes.items():
+                for owner, codes, n_codes in (("user", user_codes, n_users), ("beer", beer_codes, len(beers))):
+                    profiles, _ = keyword_profiles(np.maximum(codes, 0), n_codes, selected & (codes >= 0), counts)
+                    sparse.save_npz(os.path.join(tmp_directory, f"{owner}_{name}.npz"), profiles)
+            features += list(SIMILARITY_FEATURES)
+        meta = {
+            "version": STORE_VERSION,
+            "features": features,
+            "users": n_users,
+            "beers": len(beers),
+            "styles": len(styles),
+            "keywords": None if counts is None else counts.shape[1],
+        }
+        with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return directory
+
+
+class FeatureStore:
+    """
+    Read access to a store written by build_feature_store. Users and beers that are not in the store get the
+    features of a user without ratings (a beer without reviews).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.features = self.meta["features"]
+        user_table = pd.read_parquet(os.path.join(directory, "users.parquet"))
+        beer_table = pd.read_parquet(os.path.join(directory, "beers.parquet"))
+        self.users = pd.Index(user_table["user_id"])
+        self.beers = pd.Index(beer_table["beer_id"])
+        self.n_styles = self.meta["styles"]
+        # one extra row at the end for the unknown users (beers)
+        defaults = {"user_mean": np.nan}
+        self.user_features = {
+            name: np.r_[user_table[name].to_numpy(), np.array([defaults.get(name, 0)], dtype=user_table[name].dtype)]
+            for name in user_table.columns
+            if name != "user_id"
+        }
+        self.beer_style = np.r_[beer_table["style"].to_numpy(), -1]
+        with np.load(os.path.join(directory, "user_styles.npz")) as f:
+            self.style_keys, self.style_count, self.style_mean = f["keys"], f["count"], f["mean"]
+        self.profiles = {}
+        if self.meta["keywords"] is not None:
+            empty = sparse.csr_matrix((1, self.meta["keywords"]), dtype=np.float32)
+            for owner in ("user", "beer"):
+                for name in SIMILARITY_FEATURES.values():
+                    profiles = sparse.vstack(
+                        [sparse.load_npz(os.path.join(directory, f"{owner}_{name}.npz")), empty], format="csr"
+                    )
+                    self.profiles[owner, name] = (profiles, np.asarray(profiles.sum(axis=1)).ravel())
+
+    def user_codes(self, user_ids):
+        """
+        :return: the row of every user in the store, the row of the unknown users for the others
+        """
+        codes = self.users.get_indexer(pd.Index(user_ids))
+        return np.where(codes >= 0, codes, len(self.users))
+
+    def beer_codes(self, beer_ids):
+        """
+        :return: the row of every beer in the store, the row of the unknown beers for the others
+        """
+        codes = self.beers.get_indexer(pd.Index(beer_ids))
+        return np.where(codes >= 0, codes, len(self.beers))
+
+    def pair_features(self, user_codes, beer_codes, features, fill_nan=0.0):
+        """
+        The features of all the pairs of the users and the beers.
+        :param user_codes: the users (see user_codes)
+        :param beer_codes: the beers (see beer_codes)
+        :param features: the names of the features, in the order of the columns
+        :param fill_nan: missing features become this (as in FeatureLoader), None keeps NaN
+        :return: float32 array (users · beers × features), the beers of the first user first
+        """
+        missing = [name for name in features if name not in self.features]
+        if missing:
+            raise ValueError(f"The feature store has no features {missing}")
+        n_users, n_beers = len(user_codes), len(beer_codes)
+        # filled feature by feature as features × users × beers, X is the transposed view (no copy)
+        columns = np.empty((len(features), n_users, n_beers), dtype=np.float32)
+        style_found = None
+        for j, name in enumerate(features):
+            if name in self.user_features:
+                columns[j] = self.user_features[name][user_codes][:, None]
+            elif name in USER_STYLE_FEATURES:
+                if style_found is None:
+                    beer_style = self.beer_style[beer_codes]
+                    keys = user_codes[:, None].astype(np.int64) * self.n_styles + beer_style[None, :]
+                    positions = np.minimum(np.searchsorted(self.style_keys, keys), max(len(self.style_keys) - 1, 0))
+                    style_found = (beer_style[None, :] >= 0) & (user_codes[:, None] < len(self.users))
+                    if len(self.style_keys):
+                        style_found &= self.style_keys[positions] == keys
+                    else:
+                        style_found[:] = False
+                if name == "user_style_num_rating":
+                    columns[j] = np.where(style_found, self.style_count[positions], 0)
+                else:
+                    columns[j] = np.where(style_found, self.style_mean[positions], np.nan)
+            else:
+                kind = SIMILARITY_FEATURES[name]
+                users, user_has = _distributions(self.profiles["user", kind][0][user_codes],
+                                                 self.profiles["user", kind][1][user_codes])
+                beers, beer_has = _distributions(self.profiles["beer", kind][0][beer_codes],
+                                                 self.profiles["beer", kind][1][beer_codes])
+                np.matmul(users, beers.T, out=columns[j])
+                columns[j][~(user_has[:, None] & beer_has[None, :])] = np.nan
+        if fill_nan is not None:
+            np.nan_to_num(columns, copy=False, nan=fill_nan)
+        return columns.reshape(len(features), -1).T
+
+
+def feature_store_path(csv_path):
+    """
+    :param csv_path: the path of a ratings csv
+    :return: the directory of its feature store
+    """
+    return os.path.splitext(csv_path)[0] + ".store"
+
+
+def load_feature_store(csv_path, directory=None, exp_words=exp_words1, keywords=KEYWORDS, progress=None, **kwargs):
+    """
+    The feature store of a ratings dataset, built from the column store, the text store and the text index (see
+    build_feature_table) on first use and reused as long as it is newer than the csv.
+    :param csv_path: the path to the ratings.csv
+    :param directory: the directory of the store (default: feature_store_path(csv_path))
+    :param exp_words: the exp words for is_exp (None: no experience features)
+    :param keywords: the vocabulary of the keyword similarities (None: no similarities)
+    :param progress: None, True or a progress callback for building the store (see src.utils.progress)
+    :param kwargs: passed to build_feature_store. The store is only reused if they and the words are the same as when
+    it was built.
+    :return: the FeatureStore
+    """
+    directory = directory or feature_store_path(csv_path)
+    settings = {"exp_words": exp_words and list(exp_words), "keywords": keywords and list(keywords), **kwargs}
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(csv_path):
+        store = FeatureStore(directory)
+        if store.meta.get("version") == STORE_VERSION and store.meta.get("settings") == settings:
+            return store
+    df = load_rating_columns(csv_path, FEATURE_INPUT_COLUMNS, strings="category", progress=progress)
+    exp_matches = counts = None
+    if exp_words is not None:
+        texts = load_rating_texts(csv_path, progress)
+        exp_matches = exp_word_matches(df[["user_id"]], exp_words, progress, texts=texts)
+    if keywords is not None:
+        counts = keyword_counts(df, keywords, index=load_text_index(csv_path, progress))
+    build_feature_store(df, directory, exp_matches, counts, **kwargs)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta["settings"] = settings
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    return FeatureStore(directory)
+
+
+def _top_k(scores, k):
+    # the columns of the k highest scores of every row, highest first
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def score_candidates(
+    store,
+    model,
+    user_ids,
+    beer_ids,
+    k=10,
+    exclude=None,
+    batch_pairs=1_000_000,
+    workers=None,
+    fill_nan=0.0,
+    progress=None,
+):
+    """
+    Scores every candidate beer for every user and keeps the best k per user.
+    :param store: the FeatureStore of the dataset
+    :param model: the predictor: features (the names of its inputs) and predict(X) -> one score per row, e.g. a
+    PreferenceMLP
+    :param user_ids: the users
+    :param beer_ids: the candidate beers
+    :param k: the number of beers per user
+    :param exclude: df with the pairs (user_id, beer_id) that are left out, e.g. the ratings (beers the user rated)
+    :param batch_pairs: pairs per batch of the model, the users are scored in blocks of about that many pairs
+    :param workers: threads scoring the blocks (default: the number of CPUs)
+    :param fill_nan: missing features become this, it should be the fill_nan of the training (see FeatureLoader)
+    :param progress: None, True or a progress callback (see src.utils.progress), reports the pairs per second
+    :return: df with the columns user_id, rank (1 is the best), beer_id and score, the users in the order of user_ids
+    (duplicates are scored once). The attrs pairs, seconds and pairs_per_second hold the throughput.
+    """
+    users = pd.Index(pd.unique(np.asarray(user_ids)))
+    beers = pd.Index(pd.unique(np.asarray(beer_ids)))
+    user_codes, beer_codes = store.user_codes(users), store.beer_codes(beers)
+    n_users, n_beers = len(users), len(beers)
+    k = min(k, n_beers)
+    excluded = np.zeros(0, dtype=np.int64)
+    if exclude is not None:
+        user_positions = users.get_indexer(exclude["user_id"])
+        beer_positions = beers.get_indexer(exclude["beer_id"])
+        known = (user_positions >= 0) & (beer_positions >= 0)
+        excluded = np.unique(user_positions[known].astype(np.int64) * n_beers + beer_positions[known])
+    block_users = max(1, batch_pairs // max(n_beers, 1))
+    starts = range(0, n_users if k > 0 else 0, block_users)
+
+    def score_block(start):
+        stop = min(start + block_users, n_users)
+        X = store.pair_features(user_codes[start:stop], beer_codes, model.features, fill_nan)
+        scores = np.asarray(model.predict(X), dtype=np.float32).reshape(stop - start, n_beers)
+        first, last = np.searchsorted(excluded, [start * n_beers, stop * n_beers])
+        scores.reshape(-1)[excluded[first:last] - start * n_beers] = -np.inf
+        return _top_k(scores, k)
+
+    parts = []
+    begin = time.perf_counter()
+    with track(progress, "score pairs", total=n_users * n_beers, unit="pairs") as tracker:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for start, (top, top_scores) in zip(starts, pool.map(score_block, starts)):
+                parts.append((start, top, top_scores))
+                tracker.update(len(top) * n_beers)
+    seconds = time.perf_counter() - begin
+
+    if parts:
+        top = np.concatenate([top for _, top, _ in parts])
+        top_scores = np.concatenate([top_scores for _, _, top_scores in parts])
+    else:
+        top, top_scores = np.zeros((0, max(k, 0)), dtype=np.int64), np.zeros((0, max(k, 0)), dtype=np.float32)
+    result = pd.DataFrame(
+        {
+            "user_id": np.repeat(np.asarray(users), top.shape[1]) if len(top) else np.asarray(users)[:0],
+            "rank": np.tile(np.arange(1, top.shape[1] + 1, dtype=np.int32), len(top)),
+            "beer_id": np.asarray(beers)[top.ravel()],
+            "score": top_scores.ravel(),
+        }
+    )
+    # the excluded beers of users with fewer than k other candidates
+    result = result[np.isfinite(result["score"].to_numpy())].reset_index(drop=True)
+    pairs = n_users * n_beers
+    result.attrs.update(pairs=pairs, seconds=seconds, pairs_per_second=pairs / seconds if seconds > 0 else None)
+    return result
+
+
+def _read_ids(path, index):
+    # one id per line, as the type of the ids of the store
+    ids = pd.read_csv(path, header=None, dtype=str).iloc[:, 0]
+    return ids.astype(index.dtype) if index.dtype != object else ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scores candidate beers for users and keeps the best per user.")
+    parser.add_argument("ratings", help="the ratings.csv of the dataset")
+    parser.add_argument("model", help="npz file of a PreferenceMLP")
+    parser.add_argument("--users", default=None, help="file with one user id per line (default: all the users)")
+    parser.add_argument("--beers", default=None, help="file with one beer id per line (default: all the beers)")
+    parser.add_argument("--k", type=int, default=10, help="beers per user")
+    parser.add_argument("--keep-rated", action="store_true", help="also recommend beers the user already rated")
+    parser.add_argument("--batch-pairs", type=int, default=1_000_000, help="pairs per batch of the model")
+    parser.add_argument("--workers", type=int, default=None, help="scoring threads (default: number of CPUs)")
+    parser.add_argument("--out", default="top_beers.csv", help="the csv the best beers are written to")
+    parser.add_argument("--progress", action="store_true", help="show a progress bar")
+    args = parser.parse_args(argv)
+
+    progress = args.progress or None
+    store = load_feature_store(args.ratings, progress=progress)
+    model = PreferenceMLP.load(args.model)
+    user_ids = store.users if args.users is None else _read_ids(args.users, store.users)
+    beer_ids = store.beers if args.beers is None else _read_ids(args.beers, store.beers)
+    exclude = None
+    if not args.keep_rated:
+        exclude = load_rating_columns(args.ratings, ["user_id", "beer_id"], strings="category", progress=progress)
+    top = score_candidates(
+        store, model, user_ids, beer_ids, args.k, exclude, args.batch_pairs, args.workers, progress=progress
+    )
+    top.to_csv(args.out, index=False)
+    rate = top.attrs["pairs_per_second"] or 0
+    print(f"{top.attrs['pairs']} pairs in {top.attrs['seconds']:.1f}s, {rate:,.0f} pairs/s, written to {args.out}")
+    return 0
+
+
+instrument_module(__name__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,44 +3,83 @@ import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import plotly.express as px
+from src.utils.backend import import_polars, is_polars, lazy
+from src.utils.cache import memoize
+from src.utils.plot_export import write_html
+from src.utils.instrument import instrument_module
 
 
 
-def plot_and_head_average_rating_per_month(df):
+def _polars_month(pl):
+    # the same month as pd.to_datetime(unit='s').dt.month, also as int32
+    return pl.from_epoch('date', time_unit='s').dt.month().cast(pl.Int32).alias('month')
+
+
+def average_rating_per_month(df):
     """
     Calculate the average rating per month
-    :param df: df_rb_ratings
-    :return: the average rating per month
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it for the lazy mode (see src.utils.backend)
+    :return: df with the columns month and rating
     """
-    df['month'] = pd.to_datetime(df['date'], unit = 's').dt.month
+    if is_polars(df):
+        pl = import_polars()
+        return (
+            lazy(df).group_by(_polars_month(pl)).agg(pl.col('rating').mean())
+            .sort('month').collect().to_pandas()
+        )
+
+    # a derived column instead of a new column in the caller's df
+    month = pd.to_datetime(df['date'], unit = 's').dt.month.rename('month')
 
     # Group by month and calculate the average rating
-    monthly_avg_rating = df.groupby('month')['rating'].mean().reset_index()
+    return df.groupby(month)['rating'].mean().reset_index()
+
+
+def plot_and_head_average_rating_per_month(df):
+    """
+    Calculate the average rating per month
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it
+    :return: the average rating per month
+    """
+    monthly_avg_rating = average_rating_per_month(df)
 
     fig = px.bar(monthly_avg_rating, x='month', y='rating', title='Average Rating per month RateBeers Dataset')
     fig.update_layout(
         xaxis_title='Month',
         yaxis_title='Average Rating',
     )
-    fig.write_html("src/plots/average_rating_per_month.html", include_plotlyjs="cdn")
+    write_html(fig, "src/plots/average_rating_per_month.html")
     print(f"Average rating per month: f{monthly_avg_rating.mean()} \n Stdev of average rating per month: f{monthly_avg_rating.std()}")
 
 
+@memoize
 def filter_beer_style_ranking_by_amount(df, styles, cutoff = 500, interesting_threshhold = 10):
     """
     Calculate the ranking of beer styles by the amount of reviews per month
-    :param df: df_rb_ratings
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it for the lazy mode (see src.utils.backend)
     :param styles: styles to show in plot
     :param cutoff: the minimum amount of reviews per style. Default value 500
     :param interesting_threshhold: the minimum difference in max and min to be considered interesting. Default value 10
     """
-    df['month'] = pd.to_datetime(df['date'], unit = 's').dt.month
-
-    # Filters based on styles provided
-    df_filtered = df[df['style'].isin(styles)]
-
-    # Group by month and style, and count the number of reviews per month and style
-    ranked_by_amount_beer_styles_per_season = df_filtered.groupby(['month', 'style']).size().reset_index(name='review_count')
+    if is_polars(df):
+        # the counts are small, so only the steps up to them run in polars
+        pl = import_polars()
+        ranked_by_amount_beer_styles_per_season = (
+            lazy(df)
+            .filter(pl.col('style').is_in([style for style in styles if isinstance(style, str)]))
+            .group_by(_polars_month(pl), 'style')
+            .agg(pl.len().cast(pl.Int64).alias('review_count'))
+            .sort('month', 'style')
+            .collect()
+            .to_pandas()
+        )
+    else:
+        # Filters based on styles provided (only the two columns we need)
+        df_filtered = df.loc[df['style'].isin(styles), ['date', 'style']]
+        month = pd.to_datetime(df_filtered['date'], unit = 's').dt.month.rename('month')
+
+        # Group by month and style, and count the number of reviews per month and style
+        ranked_by_amount_beer_styles_per_season = df_filtered.groupby([month, 'style']).size().reset_index(name='review_count')
 
     ##  Filter out styles with less than cutoff reviews ---
 
@@ -51,7 +90,8 @@ def filter_beer_style_ranking_by_amount(df, styles, cutoff = 500, interesting_th
 
 
     # Rank the styles within each month
-    ranked_by_amount_beer_styles_per_season['rank'] = ranked_by_amount_beer_styles_per_season.groupby('month')['review_count'].rank(ascending=False, method='min')
+    ranked_by_amount_beer_styles_per_season = ranked_by_amount_beer_styles_per_season.assign(
+        rank=ranked_by_amount_beer_styles_per_season.groupby('month')['review_count'].rank(ascending=False, method='min'))
 
     # Sort the df by month and rank
     ranked_by_amount_beer_styles_per_season = ranked_by_amount_beer_styles_per_season.sort_values(['month', 'rank'])
@@ -74,7 +114,7 @@ def filter_beer_style_ranking_by_amount(df, styles, cutoff = 500, interesting_th
 def plot_beer_style_ranking_by_amount(df, styles, cutoff=500, interesting_threshhold=10):
     """
     Calculate the ranking of beer styles by the amount of reviews per month
-    :param df: df_rb_ratings
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it
     :param styles: styles to show in plot
     :param cutoff: the minimum amount of reviews per style. Default value 500
     :param interesting_threshhold: the minimum difference in max and min to be considered interesting. Default value 10
@@ -113,29 +153,47 @@ def plot_beer_style_ranking_by_amount(df, styles, cutoff=500, interesting_thresh
         ),
     )
 
-    fig.write_html("src/plots/beer_style_ranking_by_amount.html", include_plotlyjs="cdn")
+    write_html(fig, "src/plots/beer_style_ranking_by_amount.html")
 
 
-def plot_beer_style_ranking_by_avg_score(df, cutoff = 500, interesting_threshhold = 0.1):
+def filter_beer_style_ranking_by_avg_score(df, cutoff = 500, interesting_threshhold = 0.1):
     """
-    Calculate the average rating per month
-    :param df: df_rb_ratings
+    Calculate the average rating per month and style
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it for the lazy mode (see src.utils.backend)
     :param cutoff: the minimum amount of reviews per style. Default value 500
     :param interesting_threshhold: the minimum difference in rank to be considered interesting. Default value 0.1
-    :return: the average rating per month
+    :return: the average rating per month (columns) and style (rows)
     """
-    # Group by month and style, and count the average rating (average score) per month and style
-    ranked_by_avg_score_beer_styles_per_season = df.groupby(['month', 'style'])['rating'].agg(
-        avg_score='mean',
-        review_count='count').reset_index()
+    if is_polars(df):
+        pl = import_polars()
+        ranked_by_avg_score_beer_styles_per_season = (
+            lazy(df)
+            .filter(pl.col('style').is_not_null())
+            .group_by(_polars_month(pl), 'style')
+            .agg(
+                pl.col('rating').mean().alias('avg_score'),
+                pl.col('rating').count().cast(pl.Int64).alias('review_count'),
+            )
+            .sort('month', 'style')
+            .collect()
+            .to_pandas()
+        )
+    else:
+        # we don't rely on the month column of an earlier call here, that one might come from the cache
+        month = pd.to_datetime(df['date'], unit = 's').dt.month.rename('month')
+
+        # Group by month and style, and count the average rating (average score) per month and style
+        ranked_by_avg_score_beer_styles_per_season = df.groupby([month, 'style'])['rating'].agg(
+            avg_score='mean',
+            review_count='count').reset_index()
 
     ##  Filter out styles with less than cutoff reviews ---
 
     size_before_filtering = len(ranked_by_avg_score_beer_styles_per_season)
-    ranked_by_avg_score_beer_styles_per_season = ranked_by_avg_score_beer_styles_per_season.groupby('style').filter(lambda x: (x['review_count'] >= 500).all())
+    ranked_by_avg_score_beer_styles_per_season = ranked_by_avg_score_beer_styles_per_season.groupby('style').filter(lambda x: (x['review_count'] >= cutoff).all())
 
     # Drop the review_count column
-    ranked_by_avg_score_beer_styles_per_season.drop(columns='review_count', axis = 1, inplace=True)
+    ranked_by_avg_score_beer_styles_per_season = ranked_by_avg_score_beer_styles_per_season.drop(columns='review_count')
 
     print(f'We lost {size_before_filtering - len(ranked_by_avg_score_beer_styles_per_season)} rows by filtering out styles with less than {cutoff} reviews.')
 
@@ -152,9 +210,17 @@ def plot_beer_style_ranking_by_avg_score(df, cutoff = 500, interesting_threshhol
     styles_with_high_change = rank_change >= interesting_threshhold #Fitler
 
     # Apply the filter
-    beer_style_ranking_by_avg_score = beer_style_ranking_by_avg_score[styles_with_high_change]
+    return beer_style_ranking_by_avg_score[styles_with_high_change]
 
-    # ---
+
+def plot_beer_style_ranking_by_avg_score(df, cutoff = 500, interesting_threshhold = 0.1):
+    """
+    Plot the average rating per month of the styles with a high change
+    :param df: df_rb_ratings, or a polars (Lazy)Frame of it
+    :param cutoff: the minimum amount of reviews per style. Default value 500
+    :param interesting_threshhold: the minimum difference in rank to be considered interesting. Default value 0.1
+    """
+    beer_style_ranking_by_avg_score = filter_beer_style_ranking_by_avg_score(df, cutoff, interesting_threshhold)
 
     fig = go.Figure()
 
@@ -188,5 +254,7 @@ def plot_beer_style_ranking_by_avg_score(df, cutoff = 500, interesting_threshhol
         ),
     )
 
-    fig.write_html("src/plots/beer_style_ranking_by_avg_score.html", include_plotlyjs="cdn")
+    write_html(fig, "src/plots/beer_style_ranking_by_avg_score.html")
+
 
+instrument_module(__name__)
@@ -0,0 +1,249 @@
+"""
+Seasonality of the beer styles on the year-month time axis.
+
+seasonality_analysis collapses all the years into 12 calendar months, so a style that became popular in the
+summer of a year when the platform grew a lot looks like a summer style. Here every style gets its own monthly
+time series (number and average of the ratings per year-month, built for all the styles in one pass), and the
+series are decomposed into trend, seasonal part and rest:
+
+- "harmonic" (the default): a weighted regression of every series on a smooth trend (piecewise linear with one
+  knot per year) and n_harmonics sine/cosine pairs of the calendar month. All the styles share the design matrix,
+  so all the regressions are solved together as one batched linear system.
+- "stl": STL (statsmodels), one style at a time in a process pool. The seasonal part may then change over the
+  years.
+
+    counts, means = style_month_series(df_rb_ratings, min_ratings=1000)
+    trend, seasonal, resid = harmonic_decomposition(counts, means)
+    profile = seasonal_profile(counts, seasonal, resid)        # amplitude and peak month per style
+    profile = style_seasonality(df_rb_ratings)                  # all of the above
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.utils.instrument import instrument_module
+from src.utils.progress import track
+
+
+def style_month_series(df, styles=None, min_ratings=1):
+    """
+    The number and the average of the ratings of every style in every month, in one pass over the ratings.
+    :param df: the ratings (style, date as unix timestamp, rating)
+    :param styles: the styles to keep (default: all)
+    :param min_ratings: styles with fewer ratings are left out
+    :return: (counts, means): dfs with one row per style and one column per month (a monthly PeriodIndex from the
+    first to the last month with ratings, in UTC like seasonality_analysis). means is NaN where there are no ratings.
+    """
+    ratings = df["rating"].to_numpy(dtype=np.float64, na_value=np.nan)
+    months = pd.to_datetime(df["date"], unit="s").to_numpy().astype("datetime64[M]")
+    style_codes, style_names = pd.factorize(df["style"], sort=True)
+    valid = (style_codes >= 0) & ~np.isnat(months) & ~np.isnan(ratings)
+    if styles is not None:
+        valid &= np.isin(style_codes, style_names.get_indexer(pd.Index(styles)))
+    if not valid.any():
+        empty = pd.DataFrame(index=pd.Index([], name="style"), columns=pd.PeriodIndex([], freq="M", name="month"))
+        return empty.astype(np.int64), empty.astype(np.float64)
+
+    month_numbers = months[valid].astype(np.int64)  # months since 1970-01
+    first, last = month_numbers.min(), month_numbers.max()
+    n_months = last - first + 1
+    keys = style_codes[valid].astype(np.int64) * n_months + (month_numbers - first)
+    counts = np.bincount(keys, minlength=len(style_names) * n_months).reshape(len(style_names), n_months)
+    sums = np.bincount(keys, weights=ratings[valid], minlength=len(style_names) * n_months)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums.reshape(len(style_names), n_months) / counts
+
+    keep = counts.sum(axis=1) >= max(min_ratings, 1)
+    index = pd.Index(np.asarray(style_names, dtype=object)[keep], name="style")
+    start = pd.Period(year=1970 + int(first) // 12, month=int(first) % 12 + 1, freq="M")
+    columns = pd.period_range(start, periods=n_months, freq="M", name="month")
+    return (
+        pd.DataFrame(counts[keep], index=index, columns=columns),
+        pd.DataFrame(means[keep], index=index, columns=columns),
+    )
+
+
+def _trend_basis(n_months, knot_every=12):
+    # continuous piecewise linear functions: one hat function per knot, the knots are knot_every months apart
+    knots = np.arange(0, n_months - 1 + knot_every, knot_every)
+    t = np.arange(n_months)[:, None]
+    return np.maximum(0.0, 1.0 - np.abs(t - knots[None, :]) / knot_every)
+
+
+def _harmonic_basis(calendar_months, n_harmonics):
+    # cosine and sine of the calendar month (0 = January), the sine of the 6th harmonic is always 0
+    angles = 2 * np.pi * calendar_months[:, None] * np.arange(1, n_harmonics + 1)[None, :] / 12
+    columns = [np.cos(angles), np.sin(angles)[:, : min(n_harmonics, 5)]]
+    return np.concatenate(columns, axis=1)
+
+
+def harmonic_decomposition(counts, means, n_harmonics=2, knot_every=12):
+    """
+    Decomposes the series of all the styles at once by weighted least squares: every series is regressed on a
+    piecewise linear trend and n_harmonics harmonics of the calendar month, weighted by the number of ratings of
+    the months (months without ratings don't count).
+    :param counts: see style_month_series
+    :param means: see style_month_series
+    :param n_harmonics: 1 (one peak per year) to 6 (any shape)
+    :param knot_every: months between the knots of the trend, the trend can't follow faster changes
+    :return: (trend, seasonal, resid), dfs like means. trend and seasonal are defined for all the months, resid only
+    for the months with ratings.
+    """
+    if not 1 <= n_harmonics <= 6:
+        raise ValueError(f"n_harmonics must be between 1 and 6, not {n_harmonics}")
+    weights = counts.to_numpy(dtype=np.float64)
+    values = np.nan_to_num(means.to_numpy(dtype=np.float64))
+    trend_basis = _trend_basis(len(means.columns), knot_every)
+    harmonic_basis = _harmonic_basis(np.asarray(means.columns.month) - 1, n_harmonics)
+    design = np.concatenate([trend_basis, harmonic_basis], axis=1)
+
+    # the normal equations of all the styles as one stack of small systems
+    lhs = np.einsum("tk,st,tl->skl", design, weights, design)
+    rhs = np.einsum("tk,st->sk", design, weights * values)
+    # a tiny ridge, so that knots without ratings (e.g. before a style existed) don't make the systems singular
+    scale = np.maximum(lhs.diagonal(axis1=1, axis2=2).max(axis=1, initial=0.0), 1.0)
+    lhs += 1e-9 * scale[:, None, None] * np.eye(design.shape[1])
+    coefficients = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+    n_trend = trend_basis.shape[1]
+    trend = coefficients[:, :n_trend] @ trend_basis.T
+    seasonal = coefficients[:, n_trend:] @ harmonic_basis.T
+    resid = np.where(weights > 0, values - trend - seasonal, np.nan)
+    return tuple(pd.DataFrame(part, index=means.index, columns=means.columns) for part in (trend, seasonal, resid))
+
+
+def _stl_task(task):
+    values, robust = task
+    from statsmodels.tsa.seasonal import STL
+
+    result = STL(values, period=12, robust=robust).fit()
+    return np.asarray(result.trend), np.asarray(result.seasonal), np.asarray(result.resid)
+
+
+def stl_decomposition(counts, means, robust=True, workers=None, progress=None):
+    """
+    Decomposes the series of every style with STL, in a pool of processes. Every series is cut to the months from
+    the first to the last one with ratings, months without ratings in between are interpolated.
+    :param counts: see style_month_series
+    :param means: see style_month_series
+    :param robust: the robust version of STL, which gives outlier months less weight
+    :param workers: the number of processes (default: all cores, 1 runs in this process)
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: (trend, seasonal, resid) like harmonic_decomposition, NaN outside the months of a style and for
+    styles with less than two years of ratings
+    """
+    try:
+        import statsmodels  # noqa: F401
+    except ImportError as e:
+        raise ImportError("The stl method needs the statsmodels package (pip install statsmodels)") from e
+
+    values = means.to_numpy(dtype=np.float64)
+    rated = counts.to_numpy() > 0
+    spans, tasks = [], []
+    for style in range(len(values)):
+        months = np.flatnonzero(rated[style])
+        if len(months) == 0 or months[-1] - months[0] + 1 < 24:
+            continue  # STL needs at least two periods
+        start, stop = months[0], months[-1] + 1
+        series = pd.Series(values[style, start:stop]).interpolate().to_numpy()
+        spans.append((style, start, stop))
+        tasks.append((series, robust))
+
+    parts = [np.full(values.shape, np.nan) for _ in range(3)]
+    with track(progress, "stl", total=len(tasks)) as tracker:
+        if workers == 1:
+            results = map(_stl_task, tasks)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+            results = pool.map(_stl_task, tasks, chunksize=max(1, len(tasks) // 64))
+        try:
+            for (style, start, stop), result in zip(spans, results):
+                for part, values_part in zip(parts, result):
+                    part[style, start:stop] = values_part
+                tracker.update()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    parts[2] = np.where(rated, parts[2], np.nan)
+    return tuple(pd.DataFrame(part, index=means.index, columns=means.columns) for part in parts)
+
+
+def seasonal_profile(counts, seasonal, resid):
+    """
+    Sums up the seasonal part of every style.
+    :param counts: see style_month_series
+    :param seasonal: see harmonic_decomposition / stl_decomposition
+    :param resid: see harmonic_decomposition / stl_decomposition
+    :return: df indexed by style with the columns n_ratings, n_months (with ratings), amplitude (of the average
+    seasonal part over the calendar months, in rating points), peak_month and trough_month (1 = January) and
+    strength (the share of the variance of seasonal + resid explained by the seasonal part, 0 to 1), sorted by
+    the amplitude
+    """
+    weights = counts.to_numpy(dtype=np.float64)
+    rated = weights > 0
+    seasonal_values = np.where(rated, seasonal.to_numpy(dtype=np.float64), np.nan)
+    resid_values = resid.to_numpy(dtype=np.float64)
+
+    # the average seasonal part per calendar month, over the months with ratings
+    calendar_months = np.eye(12)[np.asarray(seasonal.columns.month) - 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pattern = np.nan_to_num(seasonal_values) @ calendar_months / (~np.isnan(seasonal_values) @ calendar_months)
+    # styles without a seasonal part (stl_decomposition of a short series) get NaN / NA
+    has_pattern = ~np.isnan(pattern).all(axis=1)
+    peak = pd.array(np.argmax(np.where(np.isnan(pattern), -np.inf, pattern), axis=1) + 1, dtype="Int64")
+    trough = pd.array(np.argmin(np.where(np.isnan(pattern), np.inf, pattern), axis=1) + 1, dtype="Int64")
+    peak[~has_pattern] = pd.NA
+    trough[~has_pattern] = pd.NA
+    with np.errstate(invalid="ignore"):
+        amplitude = np.fmax.reduce(pattern, axis=1) - np.fmin.reduce(pattern, axis=1)
+
+    def weighted_var(values):
+        values = np.where(rated, np.nan_to_num(values), 0.0)
+        total = weights.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = (weights * values).sum(axis=1) / total
+            return (weights * (values - mean[:, None]) ** 2).sum(axis=1) / total
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        strength = np.clip(1 - weighted_var(resid_values) / weighted_var(seasonal_values + resid_values), 0, 1)
+
+    profile = pd.DataFrame(
+        {
+            "n_ratings": weights.sum(axis=1).astype(np.int64),
+            "n_months": rated.sum(axis=1),
+            "amplitude": amplitude,
+            "peak_month": peak,
+            "trough_month": trough,
+            "strength": strength,
+        },
+        index=seasonal.index,
+    )
+    return profile.sort_values("amplitude", ascending=False, kind="stable")
+
+
+def style_seasonality(df, method="harmonic", min_ratings=1000, n_harmonics=2, workers=None, progress=None):
+    """
+    The seasonal profile of every style with at least min_ratings ratings, see seasonal_profile.
+    :param df: the ratings (style, date, rating), e.g. df_rb_ratings
+    :param method: "harmonic" (see harmonic_decomposition) or "stl" (see stl_decomposition)
+    :param min_ratings: styles with fewer ratings are left out
+    :param n_harmonics: see harmonic_decomposition
+    :param workers: see stl_decomposition
+    :param progress: see stl_decomposition
+    :return: the profile df
+    """
+    counts, means = style_month_series(df, min_ratings=min_ratings)
+    if method == "harmonic":
+        _, seasonal, resid = harmonic_decomposition(counts, means, n_harmonics)
+    elif method == "stl":
+        _, seasonal, resid = stl_decomposition(counts, means, workers=workers, progress=progress)
+    else:
+        raise ValueError(f"Unknown method {method}, use harmonic or stl")
+    return seasonal_profile(counts, seasonal, resid)
+
+
+instrument_module(__name__)
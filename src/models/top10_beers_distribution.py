@@ -1,11 +1,23 @@
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from src.utils.plot_export import savefig
+from src.utils.instrument import instrument_module
 
 experience_threshold = 15  # Can be changed. Defines experience
 
 
-def top10beers_ratings(df_ratings, df_nb_ratings, df_name):
+def merge_top10_ratings(df_ratings, df_nb_ratings, top_n=10, by="beer_name"):
+    """
+    Joins the ratings with the number of ratings of their reviewer and keeps only the ratings of the
+    10(/top_n) most reviewed beers (or beer styles).
+    :param df_ratings: the BA or RB ratings
+    :param df_nb_ratings: the BA or RB users (we need nbr_ratings and user_id)
+    :param top_n: how many of the most reviewed beers we keep
+    :param by: "beer_name" for the most reviewed beers, "style" for the most reviewed beer styles
+    :return: df with the columns nb_ratings, user_id, user_name, ratings, beer_id and beer_name (and style)
+    """
     # Selecting the wanted columns and creating new df for ratings:
     filtered_ratings_df = pd.DataFrame(
         {
@@ -16,6 +28,8 @@ def top10beers_ratings(df_ratings, df_nb_ratings, df_name):
             "beer_name": df_ratings["beer_name"],
         }
     )
+    if by != "beer_name":
+        filtered_ratings_df[by] = df_ratings[by]
 
     # And new df for the reviewers to have the number of given ratings per reviewer
     users_df = pd.DataFrame(
@@ -28,41 +42,179 @@ def top10beers_ratings(df_ratings, df_nb_ratings, df_name):
     # Merging the ratings with their respective BA or RB users_df via the 'user_id' column
     filtered_ratings_df = pd.merge(users_df, filtered_ratings_df, on="user_id")
 
-    # Classifying by the number of reviews given per beer
+    # Classifying by the number of reviews given per beer (or style)
     valuecount = pd.DataFrame(
-        filtered_ratings_df["beer_name"].value_counts().reset_index()
+        filtered_ratings_df[by].value_counts().reset_index()
     )
-    valuecount.columns = ["beer_name", "count"]
+    valuecount.columns = [by, "count"]
 
     # Saving the 10 most reviewed beers
-    top_10_beers = valuecount.head(10)
+    top_10_beers = valuecount.head(top_n)
 
     # Selecting the rows from the BA or RB ratings that match with the Top_10 BA or RB respectively
-    top10_ratings_df = filtered_ratings_df[
-        filtered_ratings_df["beer_name"].isin(top_10_beers["beer_name"])
+    return filtered_ratings_df[
+        filtered_ratings_df[by].isin(top_10_beers[by])
     ]
 
-    # Sharing the Top10_ratings between experienced and new reviewers. The experience_threshold is used as separation
 
-    top10_ratings_df.insert(5, "Experience", "Experienced")
+def top10beers_ratings(
+    df_ratings, df_nb_ratings, df_name, threshold=experience_threshold, path=None, by="beer_name"
+):
+    """
+    Box plots of the ratings of the 10 most reviewed beers (or beer styles) for new, experienced and all reviewers.
+    :param df_ratings: the BA or RB ratings
+    :param df_nb_ratings: the BA or RB users (we need nbr_ratings and user_id)
+    :param df_name: the name of the dataset for the title
+    :param threshold: reviewers with fewer ratings are new
+    :param path: where the figure is saved (None: not saved)
+    :param by: "beer_name" or "style" (the figures of the site), see merge_top10_ratings
+    """
+    top10_ratings_df = merge_top10_ratings(df_ratings, df_nb_ratings, by=by)
 
-    top10_ratings_df.loc[
-        top10_ratings_df["nb_ratings"] < experience_threshold, "Experience"
-    ] = "New"
+    # Sharing the Top10_ratings between experienced and new reviewers. The experience_threshold is used as separation
 
-    top10_ratings_copy_df = top10_ratings_df.copy(deep=True)
-    top10_ratings_copy_df["Experience"] = "All"
-    top10_ratings_df = pd.concat([top10_ratings_df, top10_ratings_copy_df])
+    is_new = (top10_ratings_df["nb_ratings"] < threshold).to_numpy(dtype=bool, na_value=False)
+    top10_ratings_df = pd.concat(
+        [
+            top10_ratings_df.assign(Experience=np.where(is_new, "New", "Experienced")),
+            top10_ratings_df.assign(Experience="All"),
+        ]
+    )
 
     fig, ax1 = plt.subplots(figsize=(12, 6))
     ax = sns.boxplot(
-        x="beer_name",
+        x=by,
         y="ratings",
         data=top10_ratings_df,
         hue="Experience",
+        hue_order=["Experienced", "New", "All"],
         showfliers=False,
     )
     plt.xticks(rotation=90)
-    ax.set_title(f"Top 10 Beers Ratings Distribution {df_name}")
-    ax.set_xlabel("Beer Name")
+    if by == "style":
+        ax.set_title(f"Top 10 Beer Style Ratings Distribution {df_name}")
+        ax.set_xlabel("Beer Style")
+    else:
+        ax.set_title(f"Top 10 Beers Ratings Distribution {df_name}")
+        ax.set_xlabel("Beer Name")
     ax.set_ylabel("Ratings")
+    if path is not None:
+        savefig(fig, path, bbox_inches="tight")
+
+
+def experience_threshold_sweep(
+    df_top10_ratings, thresholds=range(1, 51), by_beer=False
+):
+    """
+    Computes the New vs. Experienced statistics for every threshold at once. A reviewer is "New" if
+    nb_ratings < threshold, exactly like in top10beers_ratings.
+    Instead of re-splitting the df for every threshold we sort once by nb_ratings and build cumulative
+    sums of the count, the sum and the sum of squares of the ratings. The "New" group of a threshold is then
+    just a prefix of the sorted ratings (found by a binary search), the "Experienced" group is the rest.
+    :param df_top10_ratings: the result of merge_top10_ratings (needs nb_ratings, ratings and beer_name)
+    :param thresholds: the experience thresholds we want to look at
+    :param by_beer: whether we want the statistics per beer or over all the top 10 ratings
+    :return: df indexed by threshold (and beer_name) with count, mean and std for both groups
+    """
+    thresholds = np.asarray(thresholds)
+    df_cleaned = df_top10_ratings.dropna(subset=["nb_ratings", "ratings"])
+
+    if by_beer:
+        beer_codes, beer_names = pd.factorize(df_cleaned["beer_name"], sort=True)
+    else:
+        beer_codes, beer_names = np.zeros(len(df_cleaned), dtype=np.int64), None
+    n_beers = beer_codes.max() + 1 if len(beer_codes) else 0
+
+    nb_ratings = df_cleaned["nb_ratings"].to_numpy(dtype=np.int64)
+    # we center the ratings before summing up the squares, this keeps the variance numerically stable
+    ratings = df_cleaned["ratings"].to_numpy(dtype=np.float64)
+    shift = ratings.mean() if len(ratings) else 0.0
+    ratings = ratings - shift
+
+    # one composite sort key per rating: beer first, then the number of ratings of the reviewer.
+    # the thresholds are clipped, so that a threshold never reaches into the range of the next beer
+    stride = max(nb_ratings.max(initial=0), thresholds.max(initial=0)) + 2
+    keys = beer_codes * stride + np.clip(nb_ratings, -1, None) + 1
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    ratings = ratings[order]
+
+    # cumulative moments with a leading zero, so that cum[i] holds the moments of the first i ratings
+    cum_n = np.arange(len(ratings) + 1)
+    cum_sum = np.concatenate([[0.0], np.cumsum(ratings)])
+    cum_sq = np.concatenate([[0.0], np.cumsum(ratings**2)])
+
+    beers = np.arange(n_beers)
+    beer_start = np.searchsorted(keys, beers * stride)
+    beer_end = np.searchsorted(keys, (beers + 1) * stride)
+    # position of the first "Experienced" rating for every (beer, threshold) combination
+    split = np.searchsorted(
+        keys, beers[:, None] * stride + np.clip(thresholds, 0, None)[None, :] + 1
+    )
+
+    def moments(start, stop):
+        n = cum_n[stop] - cum_n[start]
+        s = cum_sum[stop] - cum_sum[start]
+        sq = cum_sq[stop] - cum_sq[start]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(n > 0, s / n, np.nan)
+            # sample variance (ddof=1) just like pandas' std
+            var = np.where(n > 1, (sq - s**2 / np.maximum(n, 1)) / (n - 1), np.nan)
+        return n, mean + shift, np.sqrt(np.clip(var, 0, None))
+
+    n_new, mean_new, std_new = moments(beer_start[:, None], split)
+    n_exp, mean_exp, std_exp = moments(split, beer_end[:, None])
+
+    if by_beer:
+        index = pd.MultiIndex.from_product(
+            [beer_names, thresholds], names=["beer_name", "threshold"]
+        )
+    else:
+        index = pd.Index(thresholds, name="threshold")
+
+    df_sweep = pd.DataFrame(
+        {
+            "n_new": n_new.ravel(),
+            "mean_new": mean_new.ravel(),
+            "std_new": std_new.ravel(),
+            "n_experienced": n_exp.ravel(),
+            "mean_experienced": mean_exp.ravel(),
+            "std_experienced": std_exp.ravel(),
+        },
+        index=index,
+    )
+    df_sweep["mean_difference"] = df_sweep["mean_experienced"] - df_sweep["mean_new"]
+    return df_sweep
+
+
+def plot_experience_threshold_sweep(df_sweep, df_name):
+    """
+    Plots the average rating of new and experienced reviewers over all thresholds of the sweep.
+    :param df_sweep: the result of experience_threshold_sweep (with by_beer=False)
+    :param df_name: the name of the dataset for the title
+    :return: Nothing (plots stuff)
+    """
+    fig, ax1 = plt.subplots(figsize=(12, 6))
+    ax1.plot(df_sweep.index, df_sweep["mean_new"], label="New")
+    ax1.plot(df_sweep.index, df_sweep["mean_experienced"], label="Experienced")
+    ax1.axvline(experience_threshold, color="grey", linestyle="--", label="Current threshold")
+    ax1.set_xlabel("Experience threshold (number of ratings)")
+    ax1.set_ylabel("Average rating")
+    ax1.set_title(f"Top 10 Beers average rating by experience threshold {df_name}")
+    ax1.legend(loc="upper left")
+
+    # the share of new reviewers tells us how much data is behind the "New" line
+    ax2 = ax1.twinx()
+    ax2.plot(
+        df_sweep.index,
+        df_sweep["n_new"] / (df_sweep["n_new"] + df_sweep["n_experienced"]),
+        color="black",
+        linestyle=":",
+        label="Share of new reviewers",
+    )
+    ax2.set_ylabel("Share of ratings from new reviewers")
+    ax2.legend(loc="upper right")
+    plt.show()
+
+
+instrument_module(__name__)
@@ -0,0 +1,203 @@
+"""
+Point-in-time user features for the rating preference predictor of the site ("Taking bias into account").
+
+Every rating gets the features of its user as they were just before the rating was written: the number and the
+average of the user's previous ratings (user_num_rating, user_mean), the same for the previous ratings of the same
+style (user_style_num_rating, user_style_mean) and whether the user was experienced at that time (is_exp, the
+criteria of get_experienced_users2 applied to the previous ratings only). Nothing of a rating or of later ratings
+leaks into its features. Ratings with the same timestamp don't see each other, whatever their order in the csv.
+
+The rows are sorted by (user, date) once and the features are differences of cumulative sums at the first row of
+the user and at the first row of the rating's timestamp, so there is no Python per row or per user:
+
+    features = point_in_time_features(df_ratings, exp_matches=exp_word_matches(df_ratings, exp_words1))
+    build_feature_table({"ba": ba_path, "rb": rb_path}, "src/data/features.parquet", exp_words1, KEYWORDS)
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.data.some_dataloader import load_rating_columns, load_rating_texts, load_text_index
+from src.models.experience_words import exp_word_matches
+from src.models.keyword_features import keyword_counts, keyword_similarity_features
+from src.models.user_trajectories import group_date_keys
+from src.utils.instrument import instrument_module
+from src.utils.plot_export import atomic_write
+
+FEATURE_INPUT_COLUMNS = ["user_id", "beer_id", "brewery_id", "style", "date", "rating"]
+
+
+def prior_stats(group_codes, dates, values=()):
+    """
+    For every row: the number of rows of the same group with an earlier date and the sums of values over them.
+    :param group_codes: the non-negative integer code of the group of every row (e.g. the user)
+    :param dates: the date of every row
+    :param values: arrays of numbers, one value per row
+    :return: (counts, list of sums), in the order of the rows
+    """
+    n = len(group_codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), [np.zeros(0) for _ in values]
+    keys = group_date_keys(group_codes, dates)
+    # rows with the same key get the same results, so their order doesn't matter and the sort needn't be stable
+    order = np.argsort(keys)
+    keys, groups = keys[order], np.asarray(group_codes)[order]
+    positions = np.arange(n)
+    # the first row of the group and the first row with the same timestamp, for every row
+    group_start = np.maximum.accumulate(np.where(np.r_[True, groups[1:] != groups[:-1]], positions, 0))
+    date_start = np.maximum.accumulate(np.where(np.r_[True, keys[1:] != keys[:-1]], positions, 0))
+
+    inverse = np.empty(n, dtype=np.int64)
+    inverse[order] = positions
+    counts = (date_start - group_start)[inverse]
+    sums = []
+    for value in values:
+        cumulative = np.r_[0.0, np.cumsum(np.asarray(value, dtype=np.float64)[order])]
+        sums.append((cumulative[date_start] - cumulative[group_start])[inverse])
+    return counts, sums
+
+
+def _prior_mean(count, total, shift):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(count > 0, total / count + shift, np.nan)
+
+
+def _exp_word_events(user_codes, dates, rows, exp_matches):
+    """
+    :return: (which ratings have exp words, and the user and date of the first use of every (user, exp word))
+    """
+    positions = pd.Index(rows).get_indexer(exp_matches["row"])
+    matched = positions >= 0
+    positions = positions[matched]
+    has_exp = np.zeros(len(rows), dtype=np.float64)
+    has_exp[positions] = 1.0
+    words = pd.factorize(exp_matches["word"].to_numpy()[matched])[0]
+    first_use = (
+        pd.DataFrame({"user": user_codes[positions], "word": words, "date": dates[positions]})
+        .groupby(["user", "word"], sort=False)["date"]
+        .min()
+    )
+    return has_exp, first_use.index.get_level_values("user").to_numpy(), first_use.to_numpy().astype(dates.dtype)
+
+
+def point_in_time_features(df, exp_matches=None, min_exp_ratings=10, min_exp_words=5):
+    """
+    The user features of every rating, from the user's earlier ratings only.
+    :param df: the ratings (user_id, style, date, rating). Ratings without user, date or rating are left out, they
+    neither get features nor count for the other ratings.
+    :param exp_matches: the exp words of the ratings (see exp_word_matches), None leaves out the experience features
+    :param min_exp_ratings: is_exp needs at least this many earlier ratings with exp words (see
+    filter_experienced_users)
+    :param min_exp_words: and at least this many distinct exp words used before (see get_users_with_min_exp_words)
+    :return: df indexed like the (valid) ratings with the columns user_num_rating, user_mean,
+    user_style_num_rating, user_style_mean (NaN without earlier ratings), with exp_matches also user_exp_ratings,
+    user_exp_words and is_exp, and target: 1 if the rating is above user_mean, 0 if not, NaN for the first ratings
+    """
+    ratings = df["rating"].to_numpy(dtype=np.float64)
+    user_codes, _ = pd.factorize(df["user_id"])
+    valid = (user_codes >= 0) & ~np.isnan(ratings) & df["date"].notna().to_numpy()
+    rows = df.index[valid]
+    user_codes, ratings = user_codes[valid], ratings[valid]
+    dates = df["date"].to_numpy()[valid]
+    style_codes, styles = pd.factorize(df["style"])
+    style_codes = style_codes[valid]
+
+    # centred on the overall average, so the differences of the cumulative sums don't lose precision
+    shift = ratings.mean() if len(ratings) else 0.0
+    centered = ratings - shift
+    if exp_matches is None:
+        user_count, (user_total,) = prior_stats(user_codes, dates, [centered])
+    else:
+        # the first uses of the exp words are extra rows of the user that only count for user_exp_words, so the
+        # experience comes out of the same sort as the other user features
+        has_exp, event_users, event_dates = _exp_word_events(user_codes, dates, rows, exp_matches)
+        n, n_events = len(rows), len(event_users)
+        _, (user_count, user_total, exp_ratings, exp_words) = prior_stats(
+            np.r_[user_codes, event_users],
+            np.r_[dates, event_dates],
+            [
+                np.r_[np.ones(n), np.zeros(n_events)],
+                np.r_[centered, np.zeros(n_events)],
+                np.r_[has_exp, np.zeros(n_events)],
+                np.r_[np.zeros(n), np.ones(n_events)],
+            ],
+        )
+        user_count, user_total, exp_ratings, exp_words = (
+            user_count[:n], user_total[:n], exp_ratings[:n], exp_words[:n]
+        )
+    # ratings without style form their own group per user, their style features are left empty
+    n_styles = len(styles) + 1
+    user_style = user_codes.astype(np.int64) * n_styles + np.where(style_codes >= 0, style_codes, len(styles))
+    style_count, (style_total,) = prior_stats(user_style, dates, [centered])
+    style_count = np.where(style_codes >= 0, style_count, 0)
+
+    user_mean = _prior_mean(user_count, user_total, shift)
+    features = {
+        "user_num_rating": user_count.astype(np.int32),
+        "user_mean": user_mean.astype(np.float32),
+        "user_style_num_rating": style_count.astype(np.int32),
+        "user_style_mean": _prior_mean(style_count, style_total, shift).astype(np.float32),
+    }
+    if exp_matches is not None:
+        is_exp = (exp_ratings >= min_exp_ratings) & (exp_words >= min_exp_words)
+        features.update(
+            user_exp_ratings=exp_ratings.astype(np.int32),
+            user_exp_words=exp_words.astype(np.int32),
+            is_exp=is_exp.astype(np.int8),
+        )
+    with np.errstate(invalid="ignore"):
+        features["target"] = np.where(user_count > 0, ratings > user_mean, np.nan).astype(np.float32)
+    return pd.DataFrame(features, index=rows)
+
+
+def build_feature_table(
+    ratings_paths,
+    path,
+    exp_words=None,
+    keywords=None,
+    min_exp_ratings=10,
+    min_exp_words=5,
+    row_group_size=1_000_000,
+    progress=None,
+):
+    """
+    The training table of the predictor for whole datasets, as one parquet file. The ratings come from the column
+    stores (see load_rating_columns), the texts for the exp words from the text stores and the keyword counts from
+    the text indexes. The users of different datasets are different users.
+    :param ratings_paths: dict dataset name -> path to the ratings.csv, e.g. {"ba": ..., "rb": ...}
+    :param path: the parquet file
+    :param exp_words: the exp words for is_exp (None: no experience features)
+    :param keywords: the vocabulary of the keyword similarity features, e.g. KEYWORDS of src.models.keyword_features
+    (None: no keyword features)
+    :param min_exp_ratings: see point_in_time_features
+    :param min_exp_words: see point_in_time_features
+    :param row_group_size: rows per parquet row group, the unit in which the table can be read back in parts
+    :param progress: None, True or a progress callback (see src.utils.progress)
+    :return: the table: dataset, row (the row of the rating in its csv), the columns of FEATURE_INPUT_COLUMNS (user_id
+    as string), the features of point_in_time_features and with keywords good_similarity and bad_similarity (see
+    keyword_similarity_features)
+    """
+    tables = []
+    for name, csv_path in ratings_paths.items():
+        df = load_rating_columns(csv_path, FEATURE_INPUT_COLUMNS, strings="category", progress=progress)
+        exp_matches = None
+        if exp_words is not None:
+            texts = load_rating_texts(csv_path, progress)
+            exp_matches = exp_word_matches(df[["user_id"]], exp_words, progress, texts=texts)
+        features = point_in_time_features(df, exp_matches, min_exp_ratings, min_exp_words)
+        if keywords is not None:
+            counts = keyword_counts(df, keywords, index=load_text_index(csv_path, progress))
+            similarities = keyword_similarity_features(df, counts, progress=progress)
+            features = features.join(similarities)
+        table = df.loc[features.index].assign(user_id=lambda d: d["user_id"].astype(str))
+        table.insert(0, "row", features.index.to_numpy(dtype=np.int64))
+        table.insert(0, "dataset", name)
+        tables.append(pd.concat([table, features], axis=1))
+    table = pd.concat(tables, ignore_index=True)
+    # categories of the datasets differ, the columns are concatenated as strings
+    table = table.astype({"dataset": "category", "user_id": "category", "style": "category"})
+    atomic_write(path, lambda f: table.to_parquet(f, index=False, row_group_size=row_group_size), binary=True)
+    return table
+
+
+instrument_module(__name__)
@@ -0,0 +1,202 @@
+"""
+Per-user rating trajectories: how the ratings of every single user drift with the number of ratings they gave.
+
+rating_evolution_with_rating_number shows the distribution of all the 1st, 2nd, ... ratings of the population, which
+mixes the drift of the users with who is still around at rating 300. Here every user gets its own statistics: the
+slope of the rating over the rating number, the average of the early and the late ratings (the first and the last
+half of its ratings, or the first and last window ratings) and the change of the variance between them. The ratings
+are sorted by user and date once, and all the sums are segmented reductions (np.add.reduceat) over the users, so
+millions of users take seconds instead of a groupby-apply per user.
+
+The table has one compact row per user and is meant to be computed once and reused by the experience analyses (it
+is a stage of the data_pipeline, load_user_trajectories keeps it as parquet next to the csv). It summarizes the whole
+history of a user, so it is no input of the point-in-time features of the predictor (see user_features), where it
+would leak the later ratings into the features of the earlier ones:
+
+    trajectories = load_user_trajectories("src/data/BeerAdvocate/BA_ratings.csv")
+    compare_trajectories(trajectories, df_ba_users.set_index("user_id")["location"])   # drift per location
+    experience_classes(df_ratings, trajectories)     # the table works as df_users (user_id, nbr_ratings)
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t
+
+from src.data.some_dataloader import load_rating_columns
+from src.utils.cache import memoize
+from src.utils.instrument import instrument_module
+
+TRAJECTORY_COLUMNS = ["user_id", "date", "rating"]
+
+
+def _segment_sums(values, starts):
+    # the sum of every segment, np.add.reduceat over the segment starts
+    return np.add.reduceat(values, starts) if len(values) else np.zeros(0)
+
+
+def group_date_keys(group_codes, dates):
+    """
+    One int64 sort key per row that orders by group and then by date, so sorting by (group, date) is one argsort
+    and the rows of a group before a date are one searchsorted. Dates that don't fit next to the group codes (or
+    aren't integers) are replaced by their rank.
+    :param group_codes: the non-negative integer code of the group of every row (e.g. the user)
+    :param dates: the date of every row
+    :return: the keys, equal keys mean the same group and date
+    """
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    dates = np.asarray(dates)
+    if not len(dates):
+        return np.zeros(0, dtype=np.int64)
+    first, span = 0, None
+    if np.issubdtype(dates.dtype, np.integer):
+        first = int(dates.min())
+        span = int(dates.max()) - first + 1
+    if span is None or (int(group_codes.max()) + 1) * span >= 2**63:
+        ranks, dates = np.unique(dates, return_inverse=True)
+        first, span = 0, len(ranks)
+    return group_codes * span + (dates.astype(np.int64) - first)
+
+
+def _variance(n, total, total_sq):
+    # the sample variance from the sums, NaN for fewer than 2 values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (total_sq - total**2 / n) / (n - 1)
+    return np.where(n >= 2, np.maximum(variance, 0.0), np.nan)
+
+
+@memoize
+def user_trajectories(df, window=None, min_ratings=1):
+    """
+    The trajectory statistics of every user.
+    :param df: the ratings (user_id, date, rating). Ratings without user or rating are left out, ratings of the
+    same user on the same date keep their order in df.
+    :param window: the number of ratings that count as early and as late (default: the first and the last half).
+    Users with fewer than 2 * window ratings use their halves.
+    :param min_ratings: users with fewer ratings are left out
+    :return: df with one row per user and the columns user_id, nbr_ratings, first_date,
+    last_date, mean_rating, slope (rating per rating number, least squares), early_mean, late_mean, mean_change
+    (late - early), early_var, late_var and var_change (late - early). The statistics are float32, NaN where they are
+    undefined (e.g. the slope of a single rating).
+    """
+    ratings = df["rating"].to_numpy(dtype=np.float64)
+    user_codes, users = pd.factorize(df["user_id"], sort=True)
+    valid = (user_codes >= 0) & ~np.isnan(ratings)
+    user_codes, ratings = user_codes[valid], ratings[valid]
+    dates = df["date"].to_numpy()[valid]
+
+    # by user, then by date, the ties in the order of df
+    order = np.argsort(group_date_keys(user_codes, dates), kind="stable")
+    user_codes, ratings, dates = user_codes[order], ratings[order], dates[order]
+    starts = np.flatnonzero(np.r_[True, user_codes[1:] != user_codes[:-1]]) if len(order) else np.zeros(0, int)
+    counts = np.diff(np.r_[starts, len(order)])
+    segment = np.repeat(np.arange(len(starts)), counts)
+    # the rating number of every rating (0 for the first rating of the user)
+    ordinal = np.arange(len(order)) - starts[segment]
+
+    # centred on the overall average, so the sums of squares don't lose precision
+    shift = ratings.mean() if len(ratings) else 0.0
+    y = ratings - shift
+    n = counts.astype(np.float64)
+    total = _segment_sums(y, starts)
+
+    # least squares slope over the rating numbers 0..n-1, the sums over x are known in closed form
+    sum_x = n * (n - 1) / 2
+    sum_xx = (n - 1) * n * (2 * n - 1) / 6
+    sum_xy = _segment_sums(ordinal * y, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sum_xy - sum_x * total / n) / (sum_xx - sum_x**2 / n)
+
+    # the early and the late ratings of every user: the first and the last h of them
+    half = counts // 2
+    h = half if window is None else np.minimum(half, window)
+    early = ordinal < h[segment]
+    late = ordinal >= (counts - h)[segment]
+    h = h.astype(np.float64)
+    early_total = _segment_sums(np.where(early, y, 0.0), starts)
+    late_total = _segment_sums(np.where(late, y, 0.0), starts)
+    early_var = _variance(h, early_total, _segment_sums(np.where(early, y**2, 0.0), starts))
+    late_var = _variance(h, late_total, _segment_sums(np.where(late, y**2, 0.0), starts))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        early_mean = early_total / h + shift
+        late_mean = late_total / h + shift
+
+    table = pd.DataFrame(
+        {
+            "user_id": np.asarray(users)[user_codes[starts]],
+            "nbr_ratings": counts.astype(np.int32),
+            "first_date": dates[starts],
+            "last_date": dates[starts + counts - 1],
+            "mean_rating": (total / n + shift).astype(np.float32),
+            "slope": slope.astype(np.float32),
+            "early_mean": early_mean.astype(np.float32),
+            "late_mean": late_mean.astype(np.float32),
+            "mean_change": (late_mean - early_mean).astype(np.float32),
+            "early_var": early_var.astype(np.float32),
+            "late_var": late_var.astype(np.float32),
+            "var_change": (late_var - early_var).astype(np.float32),
+        }
+    )
+    return table[table["nbr_ratings"] >= min_ratings].reset_index(drop=True)
+
+
+def trajectory_path(csv_path):
+    """
+    :param csv_path: the path of a ratings csv
+    :return: the parquet file of its trajectories
+    """
+    return os.path.splitext(csv_path)[0] + ".trajectories.parquet"
+
+
+def load_user_trajectories(csv_path, path=None, progress=None, **kwargs):
+    """
+    The trajectories of all the users of a ratings dataset. They are computed from the column store (see
+    load_rating_columns) on first use, written to parquet and read from there as long as the parquet file is newer
+    than the csv.
+    :param csv_path: the path to the ratings.csv
+    :param path: the parquet file (default: trajectory_path(csv_path))
+    :param progress: None, True or a progress callback for building the column store (see src.utils.progress)
+    :param kwargs: passed to user_trajectories. The stored table is only reused if they are the same as when it
+    was written.
+    :return: the table of user_trajectories
+    """
+    path = path or trajectory_path(csv_path)
+    settings = repr(sorted(kwargs.items()))
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(csv_path):
+        table = pd.read_parquet(path)
+        if table.attrs.get("settings") == settings:
+            return table
+    df = load_rating_columns(csv_path, TRAJECTORY_COLUMNS, strings="category", progress=progress)
+    table = user_trajectories(df, **kwargs)
+    table.attrs["settings"] = settings
+    table.to_parquet(path, index=False)
+    return table
+
+
+def compare_trajectories(trajectories, groups, min_ratings=10, confidence=0.95):
+    """
+    The average trajectory statistics of groups of users, e.g. experienced vs inexperienced users or the users of
+    every location.
+    :param trajectories: the table of user_trajectories
+    :param groups: Series user_id -> group. Users without a group are left out.
+    :param min_ratings: only users with at least this many ratings (the drift of a user with 3 ratings is noise)
+    :param confidence: the level of the confidence intervals
+    :return: df indexed by the group with the number of users and, for slope, mean_change and var_change, the
+    average over the users and the half-width of its confidence interval (<column>_ci)
+    """
+    table = trajectories[trajectories["nbr_ratings"] >= min_ratings]
+    group = table["user_id"].map(groups)
+    stats = ["slope", "mean_change", "var_change"]
+    grouped = table[stats].astype(np.float64).groupby(group.rename("group"))
+    mean, std, count = grouped.mean(), grouped.std(), grouped.count()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ci = std / np.sqrt(count) * t.ppf((1 + confidence) / 2, df=count - 1)
+    result = pd.DataFrame({"users": grouped.size()})
+    for column in stats:
+        result[column] = mean[column]
+        result[f"{column}_ci"] = ci[column]
+    return result
+
+
+instrument_module(__name__)
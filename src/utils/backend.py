@@ -0,0 +1,180 @@
+"""
+Execution backends for the heavy groupby/join functions in src/models.
+
+"pandas" (the default) runs them as before. "duckdb" runs the same operations as SQL in an embedded DuckDB
+engine: multi-threaded, with a memory limit beyond which it spills to disk, and directly on csv or parquet files
+if a path is given instead of a frame. The functions return the same pandas objects either way.
+
+    set_backend("duckdb", threads=8, memory_limit="8GB")   # for all the calls from now on
+    avg_rating_by_location(df, backend="pandas")            # or per call
+
+The time series analyses (seasonality_analysis, change_in_rating_distribution) have a lazy mode instead: given
+a polars LazyFrame, e.g. scan("src/data/RateBeer/RB_ratings.csv"), they run the whole chain up to the aggregates
+in polars (only the needed columns are read, filters are pushed into the scan, the aggregation is multi-threaded)
+and hand back the same pandas tables as for a pandas df.
+
+None of the functions in src/models changes the frames passed to it (see checking_mutations in
+src.utils.instrument). With pandas' Copy-on-Write mode, set_copy_on_write(), the frames they derive (assign,
+column selections, renames, ...) therefore share the memory of their inputs instead of copying them, and the
+defensive copies of memoize and Pipeline become shallow.
+"""
+
+import os
+
+import pandas as pd
+
+_backend = "pandas"
+_settings = {"threads": None, "memory_limit": None, "temp_directory": "src/data/duckdb_tmp"}
+
+BACKENDS = ("pandas", "duckdb")
+
+
+def set_backend(backend, **settings):
+    """
+    Sets the backend used by all calls that don't pass one.
+    :param backend: "pandas" or "duckdb"
+    :param settings: duckdb settings: threads (default: all cores), memory_limit (e.g. "8GB", default: 80% of
+    the RAM) and temp_directory (where it spills to)
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, use one of {BACKENDS}")
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise ValueError(f"Unknown settings: {sorted(unknown)}")
+    _backend = backend
+    _settings.update(settings)
+
+
+def get_backend(backend=None):
+    """
+    :param backend: the backend argument of a call (None: use the global one)
+    :return: the backend to use
+    """
+    backend = backend or _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, use one of {BACKENDS}")
+    return backend
+
+
+def connect():
+    """
+    :return: a new in-memory duckdb connection with the current settings (one per call, so that calls from
+    several threads don't share a connection)
+    """
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb backend needs the duckdb package (pip install duckdb)") from e
+
+    con = duckdb.connect()
+    if _settings["threads"] is not None:
+        con.execute(f"SET threads = {int(_settings['threads'])}")
+    if _settings["memory_limit"] is not None:
+        con.execute(f"SET memory_limit = '{_settings['memory_limit']}'")
+    if _settings["temp_directory"] is not None:
+        os.makedirs(_settings["temp_directory"], exist_ok=True)
+        con.execute(f"SET temp_directory = '{_settings['temp_directory']}'")
+    return con
+
+
+def register(con, name, value):
+    """
+    Makes a frame or a file available as a view in the connection.
+    :param con: the connection
+    :param name: the name of the view
+    :param value: a DataFrame, or the path of a csv or parquet file with the same columns
+    """
+    if isinstance(value, str):
+        path = value.replace("'", "''")
+        reader = "read_parquet" if value.endswith(".parquet") else "read_csv"
+        con.execute(f"CREATE VIEW {name} AS SELECT * FROM {reader}('{path}')")
+    else:
+        con.register(name, value)
+
+
+def columns(con, name):
+    """
+    :return: the column names of a view, in order
+    """
+    return [row[0] for row in con.execute(f"DESCRIBE {name}").fetchall()]
+
+
+def query(sql, **tables):
+    """
+    Runs a query on frames and/or files.
+    :param sql: the query, it refers to the tables by their keyword names
+    :param tables: name -> DataFrame or file path
+    :return: the result as a pandas df
+    """
+    con = connect()
+    try:
+        for name, value in tables.items():
+            register(con, name, value)
+        return con.execute(sql).df()
+    finally:
+        con.close()
+
+
+def quote(name):
+    """
+    :return: the column name quoted for SQL (some of ours are keywords, e.g. foreign)
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def set_copy_on_write(enabled=True):
+    """
+    Switches pandas' Copy-on-Write mode on or off for all the calls from now on (it is always on from pandas 3 on).
+    :param enabled: True or False
+    """
+    pd.set_option("mode.copy_on_write", enabled)
+
+
+def copy_on_write():
+    """
+    :return: whether pandas runs with Copy-on-Write, i.e. whether shallow copies are as safe as deep ones
+    """
+    try:
+        return pd.get_option("mode.copy_on_write") is True
+    except KeyError:
+        return True  # pandas 3 removed the option, Copy-on-Write is the only mode there
+
+
+def import_polars():
+    """
+    :return: the polars module
+    """
+    try:
+        import polars
+    except ImportError as e:
+        raise ImportError("The lazy mode needs the polars package (pip install polars)") from e
+    return polars
+
+
+def is_polars(value):
+    """
+    :return: whether value is a polars DataFrame or LazyFrame (checked without importing polars)
+    """
+    return type(value).__module__.split(".")[0] == "polars"
+
+
+def lazy(df):
+    """
+    :param df: a polars DataFrame or LazyFrame
+    :return: it as a LazyFrame
+    """
+    return df if type(df).__name__ == "LazyFrame" else df.lazy()
+
+
+def scan(path, **kwargs):
+    """
+    Scans a csv or parquet file lazily, nothing is read before a query on it is collected.
+    :param path: the path of the file
+    :param kwargs: passed to polars.scan_csv / polars.scan_parquet
+    :return: a polars LazyFrame
+    """
+    pl = import_polars()
+    if path.endswith(".parquet"):
+        return pl.scan_parquet(path, **kwargs)
+    return pl.scan_csv(path, **kwargs)
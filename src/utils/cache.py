@@ -0,0 +1,342 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.utils.backend import copy_on_write, is_polars
+
+# the cache is switched off by default, memoized functions then behave exactly like the undecorated ones
+_active_cache = None
+
+
+class ResultCache:
+    """
+    On-disk store for the results of memoized functions.
+    DataFrames and Series are written as parquet files (one file per result), everything else is pickled.
+    The modification time of a file is used as its last access time, which gives us LRU eviction as soon as
+    the total size of the cache exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir="src/data/cache", max_bytes=2 * 1024**3, sample_rows=None):
+        """
+        :param cache_dir: the directory the results are stored in
+        :param max_bytes: the size budget of the cache, the least recently used results are evicted beyond that
+        :param sample_rows: if given, only this many (evenly spaced) rows of large frames are hashed for the key
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.sample_rows = sample_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def stats(self):
+        """
+        :return: a dict with the hit/miss/eviction counters, the hit rate and the current size of the cache
+        """
+        calls = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / calls if calls else 0.0,
+            "entries": len(self._entries()),
+            "bytes": sum(size for _, size, _ in self._entries()),
+        }
+
+    def get(self, key):
+        """
+        Looks up a result and marks it as recently used.
+        :param key: the key created by memoize
+        :return: (True, result) on a hit and (False, None) on a miss
+        """
+        found, value, path = read_result(os.path.join(self.cache_dir, key))
+        if not found:
+            self.misses += 1
+            return False, None
+        os.utime(path)  # touching the file makes it the most recently used one
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        """
+        Stores a result and evicts the least recently used ones if we are over budget.
+        :param key: the key created by memoize
+        :param value: the result of the function call
+        """
+        suffix = write_result(os.path.join(self.cache_dir, key), value)
+        if suffix is not None:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits into max_bytes again.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])  # oldest access first
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another process was faster
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all the entries of the cache.
+        """
+        for path, _, _ in self._entries():
+            os.remove(path)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("."):
+                continue  # temporary files of writes in progress
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+
+RESULT_SUFFIXES = (".parquet", ".series.parquet", ".pkl")
+
+
+def read_result(base_path):
+    """
+    Reads a result written by write_result.
+    :param base_path: the path without the suffix
+    :return: (found, value, path of the file)
+    """
+    for suffix in RESULT_SUFFIXES:
+        path = base_path + suffix
+        if not os.path.exists(path):
+            continue
+        try:
+            if suffix == ".pkl":
+                with open(path, "rb") as f:
+                    return True, pickle.load(f), path
+            df = pd.read_parquet(path)
+        except Exception:
+            # a broken file (e.g. from an interrupted run) is just treated as missing
+            return False, None, path
+        if suffix == ".series.parquet":
+            series = df.iloc[:, 0]
+            df = series.rename(None) if series.name == "__series__" else series
+        return True, df, path
+    return False, None, None
+
+
+def write_result(base_path, value):
+    """
+    Writes a result atomically (temp file + rename), so parallel readers never see half written files.
+    DataFrames and Series go to parquet if they survive the round trip, everything else is pickled.
+    :param base_path: the path without the suffix
+    :param value: the result
+    :return: the suffix of the written file or None if the value could not be stored
+    """
+    candidates = []
+    # parquet turns all column labels into strings, so only frames with string labels survive the round trip
+    if isinstance(value, pd.DataFrame) and _has_string_labels(value.columns):
+        candidates.append((".parquet", lambda f: value.to_parquet(f)))
+    elif isinstance(value, pd.Series) and (value.name is None or isinstance(value.name, str)):
+        name = "__series__" if value.name is None else value.name
+        candidates.append((".series.parquet", lambda f: value.to_frame(name).to_parquet(f)))
+    candidates.append((".pkl", lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    directory = os.path.dirname(base_path)
+    for suffix, write in candidates:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+        except Exception:
+            os.remove(tmp_path)
+            if suffix == ".pkl":
+                return None  # not even picklable, so we simply don't cache it
+            # parquet can't store everything (e.g. non-string column names or a missing pyarrow),
+            # in that case we fall back to pickle
+            continue
+        os.replace(tmp_path, base_path + suffix)
+        return suffix
+    return None
+
+
+def _has_string_labels(columns):
+    return not isinstance(columns, pd.MultiIndex) and all(isinstance(c, str) for c in columns)
+
+
+def frame_fingerprint(obj, sample_rows=None):
+    """
+    Creates a content fingerprint of a DataFrame or Series by hashing every column on its own.
+    :param obj: the DataFrame or Series
+    :param sample_rows: if given and the frame is larger, only this many evenly spaced rows are hashed.
+    The shape, column names and dtypes are always part of the fingerprint.
+    :return: the hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    frame = obj.to_frame() if isinstance(obj, pd.Series) else obj
+    h.update(
+        repr(
+            (type(obj).__name__, frame.shape, list(frame.columns), list(map(str, frame.dtypes)))
+        ).encode()
+    )
+    if sample_rows is not None and len(frame) > sample_rows:
+        frame = frame.iloc[np.linspace(0, len(frame) - 1, sample_rows).astype(np.int64)]
+    h.update(_hash_values(frame.index))
+    for i in range(frame.shape[1]):
+        h.update(_hash_values(frame.iloc[:, i]))
+    return h.hexdigest()
+
+
+def _hash_values(values):
+    try:
+        return pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes()
+    except TypeError:
+        # unhashable cell values like lists
+        return pickle.dumps(list(values))
+
+
+def _argument_key(value, sample_rows):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return "frame:" + frame_fingerprint(value, sample_rows)
+    if isinstance(value, pd.Index):
+        return "index:" + hashlib.blake2b(_hash_values(value), digest_size=16).hexdigest()
+    if isinstance(value, np.ndarray):
+        return "array:" + hashlib.blake2b(
+            repr((value.dtype, value.shape)).encode() + _hash_values(pd.Series(value.ravel())),
+            digest_size=16,
+        ).hexdigest()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value
+        return repr((type(value).__name__, [_argument_key(v, sample_rows) for v in items]))
+    if isinstance(value, dict):
+        return repr({k: _argument_key(v, sample_rows) for k, v in value.items()})
+    if isinstance(value, str) and os.path.isfile(value):
+        # functions that also accept file paths (e.g. with the duckdb backend) must see changes of the file
+        stat = os.stat(value)
+        return repr(("file", os.path.abspath(value), stat.st_size, stat.st_mtime_ns))
+    return repr(value)
+
+
+def code_version(func, whole_module=False):
+    """
+    :param func: the function in question
+    :param whole_module: hash the source of the whole module instead of just the function, this also covers
+    changes in the helper functions it calls
+    :return: a short hash of the source code
+    """
+    try:
+        source = inspect.getsource(inspect.getmodule(func) if whole_module else func)
+    except (OSError, TypeError):
+        source = func.__qualname__
+    return hashlib.blake2b(source.encode(), digest_size=8).hexdigest()
+
+
+def call_fingerprint(func, args, kwargs, sample_rows=None):
+    """
+    Fingerprints a function call: the function itself plus the content of all the arguments.
+    Default values are filled in, so f(df) and f(df, cutoff=500) get the same fingerprint.
+    :param func: the called function
+    :param args: the positional arguments
+    :param kwargs: the keyword arguments
+    :param sample_rows: see frame_fingerprint
+    :return: the hex digest
+    """
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    key_source = repr(
+        (
+            func.__module__,
+            func.__qualname__,
+            [(name, _argument_key(v, sample_rows)) for name, v in bound.arguments.items()],
+        )
+    )
+    return hashlib.blake2b(key_source.encode(), digest_size=20).hexdigest()
+
+
+def memoize(func=None, *, mutates=False):
+    """
+    Decorator that caches the results of a function on disk as long as a cache is enabled (see enable_cache).
+    The key consists of the function, its source code and a content fingerprint of all the arguments,
+    so changing either the data or the function invalidates old results.
+    :param func: the function to decorate
+    :param mutates: set this for functions that change their input frames. With a cache enabled these functions
+    are run on copies of their inputs, so the caller sees the same (unchanged) inputs on a hit and on a miss.
+    Use the return value instead of relying on the mutation.
+    :return: the decorated function
+    """
+    if func is None:
+        return functools.partial(memoize, mutates=mutates)
+
+    version = code_version(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = _active_cache
+        if cache is None:
+            return func(*args, **kwargs)
+
+        if any(is_polars(a) for a in [*args, *kwargs.values()]):
+            # the lazy mode (see src.utils.backend) isn't cached: a LazyFrame is a query, not data, so we can't
+            # fingerprint what it is going to read
+            return func(*args, **kwargs)
+
+        key = version + "-" + call_fingerprint(func, args, kwargs, cache.sample_rows)
+
+        hit, value = cache.get(key)
+        if hit:
+            return value
+
+        if mutates:
+            # with Copy-on-Write a shallow copy is enough, the writes of func then copy what they change
+            deep = not copy_on_write()
+            args = [a.copy(deep=deep) if isinstance(a, (pd.DataFrame, pd.Series)) else a for a in args]
+            kwargs = {
+                k: v.copy(deep=deep) if isinstance(v, (pd.DataFrame, pd.Series)) else v
+                for k, v in kwargs.items()
+            }
+        value = func(*args, **kwargs)
+        cache.put(key, value)
+        return value
+
+    wrapper.mutates = mutates
+    return wrapper
+
+
+def enable_cache(cache_dir="src/data/cache", max_bytes=2 * 1024**3, sample_rows=None):
+    """
+    Switches on the memoization of all the functions decorated with memoize.
+    :param cache_dir: the directory for the results
+    :param max_bytes: the size budget of the cache directory
+    :param sample_rows: hash only that many rows of large frames (faster, but a change in a row that is not
+    sampled goes unnoticed)
+    :return: the cache, e.g. for cache.stats()
+    """
+    global _active_cache
+    _active_cache = ResultCache(cache_dir, max_bytes, sample_rows)
+    return _active_cache
+
+
+def disable_cache():
+    """
+    Switches the memoization off again. The files on disk are kept.
+    """
+    global _active_cache
+    _active_cache = None
+
+
+def cache_stats():
+    """
+    :return: the statistics of the active cache or None if no cache is enabled
+    """
+    return _active_cache.stats() if _active_cache is not None else None
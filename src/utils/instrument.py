@@ -0,0 +1,367 @@
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+from src.utils.cache import frame_fingerprint
+from src.utils.plot_export import atomic_write
+
+# instrumentation is switched off by default, instrumented functions then only pay for one global lookup.
+# _active_recorder is what the instrumented functions call: the Recorder, the MutationCheck or both (see _activate)
+_active_recorder = None
+_recorder = None
+_mutation_check = None
+
+
+class Recorder:
+    """
+    Collects one record per call of an instrumented function: wall and CPU time, the peak of the memory traced by
+    tracemalloc during the call, the number of rows and the memory footprint of the frames going in and out.
+    tracemalloc only has one process-wide peak, so the peak of a call that overlapped with an instrumented call in
+    another thread (e.g. the stages of a parallel Pipeline run) can't be told apart: it is recorded as None and
+    peak_shared is set.
+    The records can be written as a JSON log (one record per line) or in the Chrome trace-event format, which
+    can be opened in chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self, trace_memory=True, deep=False):
+        """
+        :param trace_memory: whether the peak memory is traced (tracemalloc slows python code down noticeably)
+        :param deep: whether the memory footprint of the frames includes the python objects (strings) in object
+        columns. Accurate, but as slow as a full pass over the data.
+        """
+        self.trace_memory = trace_memory
+        self.deep = deep
+        self.records = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+        # the threads with an instrumented call in flight, and how often two of them overlapped so far
+        self._threads_in_flight = 0
+        self._overlaps = 0
+
+    def call(self, func, args, kwargs):
+        """
+        Calls func and records the call.
+        """
+        stack = self._stack()
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # the peak is reset for every call, the parent has to remember what it has seen so far
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        frame = {"current": current, "peak": current}
+        with self._lock:
+            if not stack:
+                self._threads_in_flight += 1
+                if self._threads_in_flight > 1:
+                    self._overlaps += 1
+            frame["shared"] = self._threads_in_flight > 1
+            frame["overlaps"] = self._overlaps
+        stack.append(frame)
+
+        error = None
+        start_cpu = time.thread_time()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except BaseException as e:
+            error = repr(e)
+            result = None
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - start_cpu
+            stack.pop()
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1]) if self.trace_memory else 0
+            with self._lock:
+                # another thread was in flight at some point during the call: the peak may be its allocations
+                shared = frame["shared"] or self._overlaps != frame["overlaps"]
+                if not stack:
+                    self._threads_in_flight -= 1
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            inputs = [*args, *kwargs.values()]
+            record = {
+                "name": f"{func.__module__}.{func.__qualname__}",
+                "start": start - self.start,
+                "wall": wall,
+                "cpu": cpu,
+                "peak_traced_bytes": None if shared else peak - frame["current"],
+                "peak_shared": shared,
+                "input_rows": _rows(inputs),
+                "output_rows": _rows(_flatten(result)),
+                "input_bytes": _footprint(inputs, self.deep),
+                "output_bytes": _footprint(_flatten(result), self.deep),
+                "depth": len(stack),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "error": error,
+            }
+            with self._lock:
+                self.records.append(record)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def write_log(self, path):
+        """
+        Writes the records as JSON lines.
+        :param path: the target file
+        """
+        lines = "".join(json.dumps(record) + "\n" for record in self.records)
+        atomic_write(path, lambda f: f.write(lines), binary=False)
+
+    def write_trace(self, path):
+        """
+        Writes the records as complete ("X") events of the Chrome trace-event format.
+        :param path: the target file
+        """
+        events = [
+            {
+                "name": record["name"].rsplit(".", 1)[-1],
+                "cat": record["name"].rsplit(".", 1)[0],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["wall"] * 1e6,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": {k: v for k, v in record.items() if k not in ("name", "start", "wall", "pid", "tid")},
+            }
+            for record in self.records
+        ]
+        content = json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+        atomic_write(path, lambda f: f.write(content), binary=False)
+
+    def summary(self):
+        """
+        :return: df with one row per function: number of calls, total wall and CPU time, max. peak memory (over the
+        calls that didn't overlap with other threads, NaN if there are none) and rows, sorted by the total wall time
+        """
+        df = pd.DataFrame(self.records, columns=["name", "wall", "cpu", "peak_traced_bytes", "input_rows"])
+        return (
+            df.groupby("name")
+            .agg(
+                calls=("wall", "size"),
+                wall=("wall", "sum"),
+                cpu=("cpu", "sum"),
+                peak_traced_bytes=("peak_traced_bytes", "max"),
+                input_rows=("input_rows", "max"),
+            )
+            .sort_values("wall", ascending=False)
+        )
+
+
+class InputMutationError(AssertionError):
+    """
+    Raised by the mutation check when a function changed a frame that was passed to it.
+    """
+
+
+class MutationCheck:
+    """
+    Checks that instrumented functions leave the frames passed to them unchanged: every DataFrame and Series
+    argument is fingerprinted (values, index, columns and dtypes, see frame_fingerprint) before and after the call.
+    Meant for tests and debugging, hashing all the inputs of every call is slow.
+    """
+
+    def __init__(self):
+        self.inner = None  # the Recorder, if instrumentation is enabled as well
+        self.checked = 0
+
+    def call(self, func, args, kwargs):
+        """
+        Calls func and raises InputMutationError if it changed one of its input frames.
+        """
+        frames = _frame_arguments(func, args, kwargs)
+        before = {name: frame_fingerprint(frame) for name, frame in frames.items()}
+        if self.inner is None:
+            result = func(*args, **kwargs)
+        else:
+            result = self.inner.call(func, args, kwargs)
+        changed = [name for name, frame in frames.items() if frame_fingerprint(frame) != before[name]]
+        self.checked += 1
+        if changed:
+            raise InputMutationError(f"{func.__module__}.{func.__qualname__} changed its input(s) {', '.join(changed)}")
+        return result
+
+
+def _frame_arguments(func, args, kwargs):
+    try:
+        arguments = inspect.signature(func).bind(*args, **kwargs).arguments
+    except (TypeError, ValueError):
+        arguments = {**{f"args[{i}]": a for i, a in enumerate(args)}, **kwargs}
+    return {name: value for name, value in arguments.items() if isinstance(value, (pd.DataFrame, pd.Series))}
+
+
+def _flatten(result):
+    if isinstance(result, tuple):
+        return list(result)
+    return [] if result is None else [result]
+
+
+def _rows(values):
+    return sum(len(v) for v in values if isinstance(v, (pd.DataFrame, pd.Series)))
+
+
+def _footprint(values, deep):
+    total = 0
+    for v in values:
+        if isinstance(v, pd.DataFrame):
+            total += int(v.memory_usage(index=True, deep=deep).sum())
+        elif isinstance(v, pd.Series):
+            total += int(v.memory_usage(index=True, deep=deep))
+    return total
+
+
+def instrument(func):
+    """
+    Decorator that records the calls of a function as long as instrumentation is enabled
+    (see enable_instrumentation / instrumented).
+    :param func: the function to decorate
+    :return: the decorated function
+    """
+    if getattr(func, "instrumented", False):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _active_recorder
+        if recorder is None:
+            return func(*args, **kwargs)
+        return recorder.call(func, args, kwargs)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_module(module_name):
+    """
+    Decorates all the public functions defined in a module with instrument. Called at the end of the modules in
+    src/data and src/models, so that also `from module import *` picks up the decorated functions.
+    :param module_name: __name__ of the module
+    """
+    module = sys.modules[module_name]
+    for name, value in list(vars(module).items()):
+        if (
+            not name.startswith("_")
+            and callable(value)
+            and not isinstance(value, type)
+            and getattr(value, "__module__", None) == module_name
+        ):
+            setattr(module, name, instrument(value))
+
+
+def _activate():
+    global _active_recorder
+    if _mutation_check is None:
+        _active_recorder = _recorder
+    else:
+        _mutation_check.inner = _recorder
+        _active_recorder = _mutation_check
+
+
+def enable_instrumentation(trace_memory=True, deep=False):
+    """
+    Switches on the recording of all the instrumented functions.
+    :param trace_memory: see Recorder
+    :param deep: see Recorder
+    :return: the recorder holding the records
+    """
+    global _recorder
+    recorder = Recorder(trace_memory, deep)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        recorder._started_tracemalloc = True
+    _recorder = recorder
+    _activate()
+    return recorder
+
+
+def disable_instrumentation():
+    """
+    Switches the recording off again.
+    :return: the recorder that was active (or None)
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    _activate()
+    if recorder is not None and recorder._started_tracemalloc:
+        tracemalloc.stop()
+    return recorder
+
+
+def enable_mutation_check():
+    """
+    Switches on the MutationCheck of all the instrumented functions (independent of the recording).
+    :return: the MutationCheck
+    """
+    global _mutation_check
+    _mutation_check = MutationCheck()
+    _activate()
+    return _mutation_check
+
+
+def disable_mutation_check():
+    """
+    Switches the mutation check off again.
+    :return: the MutationCheck that was active (or None)
+    """
+    global _mutation_check
+    check, _mutation_check = _mutation_check, None
+    _activate()
+    return check
+
+
+@contextlib.contextmanager
+def checking_mutations():
+    """
+    Raises InputMutationError as soon as an instrumented function inside the block changes one of its input frames:
+
+        with checking_mutations():
+            build()
+    """
+    check = enable_mutation_check()
+    try:
+        yield check
+    finally:
+        disable_mutation_check()
+
+
+@contextlib.contextmanager
+def instrumented(log_path=None, trace_path=None, trace_memory=True, deep=False):
+    """
+    Records all the calls of instrumented functions inside the block (also usable as a decorator):
+
+        with instrumented(log_path="profile.jsonl", trace_path="profile.trace.json") as recorder:
+            plot_and_head_average_rating_per_month(df_rb_ratings)
+        print(recorder.summary())
+
+    :param log_path: if given, the JSON log is written there at the end
+    :param trace_path: if given, the Chrome trace is written there at the end
+    :param trace_memory: see Recorder
+    :param deep: see Recorder
+    """
+    recorder = enable_instrumentation(trace_memory, deep)
+    try:
+        yield recorder
+    finally:
+        disable_instrumentation()
+        if log_path is not None:
+            recorder.write_log(log_path)
+        if trace_path is not None:
+            recorder.write_trace(trace_path)
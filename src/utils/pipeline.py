@@ -0,0 +1,228 @@
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from src.utils.backend import copy_on_write
+from src.utils.cache import code_version, frame_fingerprint, read_result, write_result
+
+
+class Stage:
+    """
+    One step of a Pipeline: a function together with the names of the datasets it reads and writes.
+    """
+
+    def __init__(self, func, inputs=(), outputs=None, name=None, params=None, mutates=False, persist=True):
+        """
+        :param func: the function, it gets the inputs as positional arguments and the params as keyword arguments
+        :param inputs: the names of the datasets the function reads
+        :param outputs: the names of the datasets the function returns (several names if it returns a tuple).
+        Defaults to the name of the stage. A stage without outputs is a sink (e.g. a plot), it runs whenever it is
+        one of the targets.
+        :param name: the name of the stage, defaults to the name of the function
+        :param params: constant keyword arguments for the function
+        :param mutates: set this for functions that change their inputs, they then get copies of them
+        :param persist: whether the outputs are written to disk. Cheap stages don't need to be.
+        """
+        self.func = func
+        self.name = name or func.__name__
+        self.inputs = list(inputs)
+        self.outputs = [self.name] if outputs is None else list(outputs)
+        self.params = params or {}
+        self.mutates = mutates
+        self.persist = persist
+
+    def __repr__(self):
+        return f"Stage({self.name}: {self.inputs} -> {self.outputs})"
+
+
+class Pipeline:
+    """
+    A small DAG of Stages. Every dataset gets a key that is derived from the code of the stage producing it, its
+    params and the keys of its inputs (the keys of the sources come from their content). Persisted outputs are
+    stored under that key, so on the next run only the stages whose key changed (or whose outputs are missing)
+    are executed again. Stages that don't depend on each other (e.g. the BeerAdvocate and the RateBeer branch)
+    run concurrently in a thread pool.
+    """
+
+    def __init__(self, stages, cache_dir="src/data/pipeline", max_workers=None):
+        """
+        :param stages: the list of stages
+        :param cache_dir: where the persisted intermediates go
+        :param max_workers: the number of threads used to run independent stages
+        """
+        self.stages = {}
+        self.producers = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Two stages are called {stage.name}")
+            self.stages[stage.name] = stage
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"{output} is produced by {self.producers[output].name} and {stage.name}")
+                self.producers[output] = stage
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.last_run = []  # (stage, "ran"/"loaded", seconds) of the last run
+
+    def sources(self):
+        """
+        :return: the names of the datasets that are read but not produced by any stage
+        """
+        return sorted(
+            {i for stage in self.stages.values() for i in stage.inputs} - set(self.producers)
+        )
+
+    def keys(self, sources):
+        """
+        Computes the key of every dataset without running anything.
+        :param sources: dict name -> value for all the sources
+        :return: dict dataset name -> key
+        """
+        missing = set(self.sources()) - set(sources)
+        if missing:
+            raise ValueError(f"Missing sources: {sorted(missing)}")
+        keys = {name: _source_key(value) for name, value in sources.items()}
+        visiting = set()
+
+        def stage_key(stage):
+            if stage.name in visiting:
+                raise ValueError(f"The pipeline has a cycle through {stage.name}")
+            visiting.add(stage.name)
+            input_keys = [keys[i] if i in keys else dataset_key(i) for i in stage.inputs]
+            visiting.discard(stage.name)
+            # the whole module of the function, so that changes in its helpers invalidate the stage as well
+            version = code_version(stage.func, whole_module=True)
+            return _hash((stage.name, version, sorted(map(repr, stage.params.items())), input_keys))
+
+        def dataset_key(name):
+            if name not in keys:
+                stage = self.producers[name]
+                key = stage_key(stage)
+                for output in stage.outputs:
+                    keys[output] = _hash((key, output))
+            return keys[name]
+
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                dataset_key(output)
+        return keys
+
+    def run(self, sources, targets=None, force=False):
+        """
+        Computes the targets, running only the stages that are needed and not up to date.
+        :param sources: dict name -> value for all the sources
+        :param targets: names of datasets and/or sink stages (default: all the outputs and sinks)
+        :param force: run all the needed stages even if their persisted outputs are up to date
+        :return: dict name -> value for all the dataset targets
+        """
+        keys = self.keys(sources)
+        if targets is None:
+            targets = list(self.producers) + [s.name for s in self.stages.values() if not s.outputs]
+
+        # deciding for every needed dataset whether we load it from disk or run its stage
+        to_run, to_load = {}, {}
+
+        def need(name):
+            if name in sources or name in to_load:
+                return
+            stage = self.producers.get(name) or self.stages[name]
+            if stage.name in to_run:
+                return
+            if not force and stage.persist and stage.outputs and name in self.producers:
+                found = self._stored_path(name, keys[name]) is not None
+                if found:
+                    to_load[name] = stage
+                    return
+            to_run[stage.name] = stage
+            for i in stage.inputs:
+                need(i)
+
+        for target in targets:
+            need(target)
+
+        values = dict(sources)
+        self.last_run = []
+        tasks = {}  # future -> name
+        pending = dict(to_run)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for name in to_load:
+                tasks[pool.submit(self._load, name, keys[name])] = ("load", name)
+            while tasks or pending:
+                for stage_name, stage in list(pending.items()):
+                    if all(i in values for i in stage.inputs):
+                        del pending[stage_name]
+                        args = [values[i] for i in stage.inputs]
+                        tasks[pool.submit(self._run_stage, stage, args, keys)] = ("run", stage_name)
+                if not tasks:
+                    raise RuntimeError(f"Stages can't run, inputs are missing: {list(pending)}")
+                done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, name = tasks.pop(future)
+                    produced, seconds = future.result()  # re-raises the exception of a failed stage
+                    values.update(produced)
+                    self.last_run.append((name, "ran" if kind == "run" else "loaded", seconds))
+        return {t: values[t] for t in targets if t in values}
+
+    def report(self):
+        """
+        :return: df with one row per executed or loaded stage of the last run
+        """
+        return pd.DataFrame(self.last_run, columns=["stage", "action", "seconds"])
+
+    def _run_stage(self, stage, args, keys):
+        start = time.perf_counter()
+        if stage.mutates:
+            # with Copy-on-Write a shallow copy is enough (see src.utils.backend)
+            deep = not copy_on_write()
+            args = [a.copy(deep=deep) if isinstance(a, (pd.DataFrame, pd.Series)) else a for a in args]
+        result = stage.func(*args, **stage.params)
+        if len(stage.outputs) == 0:
+            produced = {}
+        elif len(stage.outputs) == 1:
+            produced = {stage.outputs[0]: result}
+        else:
+            produced = dict(zip(stage.outputs, result))
+        if stage.persist:
+            for name, value in produced.items():
+                self._store(name, keys[name], value)
+        return produced, time.perf_counter() - start
+
+    def _load(self, name, key):
+        start = time.perf_counter()
+        found, value, _ = read_result(os.path.join(self.cache_dir, f"{name}-{key}"))
+        if not found:
+            raise RuntimeError(f"The stored version of {name} disappeared")
+        return {name: value}, time.perf_counter() - start
+
+    def _stored_path(self, name, key):
+        base_path = os.path.join(self.cache_dir, f"{name}-{key}")
+        for path in glob.glob(glob.escape(base_path) + ".*"):
+            return path
+        return None
+
+    def _store(self, name, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if write_result(os.path.join(self.cache_dir, f"{name}-{key}"), value) is None:
+            return
+        # older versions of the same dataset are of no use anymore
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), glob.escape(name) + "-*")):
+            if not os.path.basename(path).startswith(f"{name}-{key}."):
+                os.remove(path)
+
+
+def _hash(obj):
+    return hashlib.blake2b(repr(obj).encode(), digest_size=16).hexdigest()
+
+
+def _source_key(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return frame_fingerprint(value)
+    if isinstance(value, str) and os.path.isfile(value):
+        # for files we use the size and the modification time, hashing multi-GB csv files would take too long
+        stat = os.stat(value)
+        return _hash((os.path.abspath(value), stat.st_size, stat.st_mtime_ns))
+    return _hash(value)
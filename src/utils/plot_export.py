@@ -0,0 +1,206 @@
+import base64
+import gzip
+import os
+import tempfile
+
+import numpy as np
+import plotly.io as pio
+import plotly.offline
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, without it we only write the .gz variants
+    brotli = None
+
+PLOTLYJS_NAME = "plotly.min.js"
+
+# the dtypes plotly.js understands in typed arrays, smallest first
+_INT_DTYPES = {"i1": np.int8, "u1": np.uint8, "i2": np.int16, "u2": np.uint16, "i4": np.int32, "u4": np.uint32}
+
+
+def atomic_write(path, write, binary):
+    """
+    Writes to a temporary file next to the target and renames it afterwards, so the site never serves a
+    half written figure (os.replace is atomic on the same file system).
+    :param path: the target path
+    :param write: function that gets the open temporary file and writes the content
+    :param binary: whether the file is opened in binary mode
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=".tmp-", suffix=os.path.splitext(path)[1]
+    )
+    try:
+        with os.fdopen(fd, "wb" if binary else "w", **({} if binary else {"encoding": "utf-8"})) as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)  # mkstemp only gives the owner access
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_html(fig, path, compact=True, decimals=4, compress=True, **kwargs):
+    """
+    Atomic replacement for plotly's fig.write_html that keeps the published figures small:
+    the numeric arrays are rounded and stored as typed binary arrays (see compact_figure), plotly.js is not
+    embedded but loaded from one shared file next to the html (see shared_plotlyjs), and precompressed .gz
+    (and .br if brotli is installed) variants are written alongside for the site.
+    :param fig: the plotly figure
+    :param path: where the html file should go
+    :param compact: whether the trace data is compacted
+    :param decimals: the number of decimals kept when compacting (significant digits for smaller values)
+    :param compress: whether the precompressed variants are written
+    :param kwargs: passed on to plotly.io.to_html (e.g. include_plotlyjs="cdn" to use the CDN instead)
+    """
+    if "include_plotlyjs" not in kwargs:
+        kwargs["include_plotlyjs"] = shared_plotlyjs(os.path.dirname(path) or ".", compress)
+    if compact:
+        html = pio.to_html(compact_figure(fig, decimals), validate=False, **kwargs)
+    else:
+        html = fig.to_html(**kwargs)
+    _write_variants(path, html.encode("utf-8"), compress)
+
+
+def compact_figure(fig, decimals=4):
+    """
+    Makes the trace data of a figure as small as possible without visible changes: floats are rounded to
+    the given number of decimals (values smaller than 10**-decimals keep decimals significant digits instead, so
+    small probabilities don't become 0), numeric arrays become base64 encoded typed arrays with the smallest dtype
+    that holds the rounded values (e.g. u2 for counts, f4 for ratings) instead of verbose JSON numbers.
+    Only the arrays plotly itself treats as data are encoded, lists of numbers (e.g. axis ranges) are rounded.
+    :param fig: the plotly figure
+    :param decimals: the number of decimals kept (significant digits for values below 10**-decimals)
+    :return: the figure as a dict, to be written with plotly.io.to_html(..., validate=False)
+    """
+    fig_dict = fig.to_dict()
+    binary = _typed_arrays_supported()
+    fig_dict["data"] = [_compact(trace, decimals, binary) for trace in fig_dict.get("data", [])]
+    for frame in fig_dict.get("frames", []):
+        frame["data"] = [_compact(trace, decimals, binary) for trace in frame.get("data", [])]
+    return fig_dict
+
+
+def shared_plotlyjs(directory, compress=True):
+    """
+    Writes the plotly.js bundle of the installed plotly version once into the directory, so all the figures
+    in there share it (and the browser caches it) instead of embedding 3+ MB each.
+    :param directory: the directory of the html files
+    :param compress: whether the precompressed variants are written
+    :return: the value for include_plotlyjs
+    """
+    path = os.path.join(directory, PLOTLYJS_NAME)
+    version = plotly.offline.get_plotlyjs_version()
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            # the version is in the license header at the top of the bundle
+            if f"v{version}".encode() in f.read(512):
+                return PLOTLYJS_NAME
+    _write_variants(path, plotly.offline.get_plotlyjs().encode("utf-8"), compress)
+    return PLOTLYJS_NAME
+
+
+def savefig(fig, path, **kwargs):
+    """
+    Atomic replacement for matplotlib's fig.savefig.
+    :param fig: the matplotlib figure
+    :param path: where the image should go, the format is taken from the file extension
+    :param kwargs: passed on to fig.savefig (e.g. bbox_inches="tight")
+    """
+    kwargs.setdefault("format", os.path.splitext(path)[1].lstrip(".") or None)
+    atomic_write(path, lambda f: fig.savefig(f, **kwargs), binary=True)
+
+
+def _write_variants(path, data, compress):
+    atomic_write(path, lambda f: f.write(data), binary=True)
+    variants = {".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = lambda: brotli.compress(data, quality=11)
+    for suffix in (".gz", ".br"):
+        if compress and suffix in variants:
+            compressed = variants[suffix]()
+            atomic_write(path + suffix, lambda f: f.write(compressed), binary=True)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)  # it would be stale
+
+
+def _typed_arrays_supported():
+    # plotly.js reads base64 typed arrays since version 2.28
+    major, minor = map(int, plotly.offline.get_plotlyjs_version().split(".")[:2])
+    return (major, minor) >= (2, 28)
+
+
+def _compact(value, decimals, binary):
+    if isinstance(value, dict):
+        if "bdata" in value and "dtype" in value:
+            # newer plotly versions already encode numpy arrays, but always with the full dtype
+            return _encode(_decode(value), decimals, binary)
+        return {k: _compact(v, decimals, binary) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        return _encode(value, decimals, binary)
+    if isinstance(value, (list, tuple)):
+        return [_compact(v, decimals, binary) for v in value]
+    if isinstance(value, (float, np.floating)):
+        return _round(np.array([value], dtype=np.float64), decimals)[0].item()
+    return value
+
+
+def _round(values, decimals):
+    # decimals decimals, but at least decimals significant digits for the values below 10**-decimals
+    rounded = np.round(values, decimals)
+    small = np.abs(values) < 10.0**-decimals
+    if small.any():
+        rounded[small] = [float(f"{v:.{decimals}g}") for v in values[small]]
+    return rounded
+
+
+def _decode(value):
+    values = np.frombuffer(base64.b64decode(value["bdata"]), dtype=np.dtype(value["dtype"]).newbyteorder("<"))
+    if "shape" in value:
+        values = values.reshape([int(n) for n in str(value["shape"]).split(",")])
+    return values
+
+
+def _encode(values, decimals, binary):
+    if values.dtype.kind in "Mm":
+        # plotly's serializer writes dates as ISO strings, tolist would give nanosecond integers
+        return values
+    if values.dtype.kind not in "iuf" or values.ndim > 2:
+        return values.tolist()
+    if values.dtype.kind == "f":
+        values = _round(values.astype(np.float64), decimals)
+        finite = values[np.isfinite(values)]
+        integral = len(finite) == len(values.ravel()) and np.array_equal(finite, np.rint(finite))
+        # beyond 2**53 the floats aren't exact integers anymore, and beyond int64 the cast would overflow
+        if integral and len(finite) and np.abs(finite).max() < 2**53:
+            values = values.astype(np.int64)
+    if not binary:
+        return [None if isinstance(v, float) and np.isnan(v) else v for v in values.tolist()]
+
+    if values.dtype.kind in "iu":
+        low, high = (values.min(), values.max()) if values.size else (0, 0)
+        dtype = next(
+            (code for code, t in _INT_DTYPES.items() if np.iinfo(t).min <= low and high <= np.iinfo(t).max),
+            "f8",
+        )
+    else:
+        # float32 keeps about 7 significant digits, enough for ratings with 4 decimals but not for timestamps, and
+        # the small values must keep their significant digits (no underflow to 0)
+        as_f4 = values.astype(np.float32)
+        large = np.abs(values) >= 10.0**-decimals
+        close = np.all(
+            np.where(
+                large,
+                np.isclose(as_f4, values, rtol=0, atol=0.5 * 10.0**-decimals, equal_nan=True),
+                np.isclose(as_f4, values, rtol=10.0**-decimals, atol=0, equal_nan=True),
+            )
+        )
+        dtype = "f4" if close else "f8"
+    encoded = {
+        "dtype": dtype,
+        "bdata": base64.b64encode(values.astype(np.dtype(dtype).newbyteorder("<")).tobytes()).decode("ascii"),
+    }
+    if values.ndim == 2:
+        encoded["shape"] = f"{values.shape[0]},{values.shape[1]}"
+    return encoded
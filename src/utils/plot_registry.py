@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from src.utils.cache import call_fingerprint, code_version
+from src.utils.plot_export import atomic_write
+
+
+class PlotRegistry:
+    """
+    Keeps track of the figures under src/plots and rebuilds only the stale ones.
+    For every artifact the manifest stores the fingerprint of the inputs and the version of the code that
+    produced it. A figure counts as stale if one of these changed or if one of its files is missing.
+
+    Example:
+        registry = PlotRegistry()
+        registry.build(
+            "beer_style_ranking_by_amount",
+            plot_beer_style_ranking_by_amount,
+            df_rb_ratings,
+            styles,
+            outputs=["src/plots/beer_style_ranking_by_amount.html"],
+        )
+        print(registry.report())
+    """
+
+    def __init__(self, manifest_path="src/plots/.manifest.json", sample_rows=None):
+        """
+        :param manifest_path: the json file holding the state of all the artifacts
+        :param sample_rows: only hash that many rows of large input frames (see frame_fingerprint)
+        """
+        self.manifest_path = manifest_path
+        self.sample_rows = sample_rows
+        self.runs = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def state(self, func, args=(), kwargs=None, input_keys=None):
+        """
+        :param func: the plot function
+        :param args: the positional arguments of the call
+        :param kwargs: the keyword arguments of the call
+        :param input_keys: keys that already identify the content of the positional arguments (e.g. the dataset keys
+        of a Pipeline). If given, args is not needed and nothing has to be hashed.
+        :return: the input fingerprint and the code version for calling func with the given arguments
+        """
+        if input_keys is not None:
+            key_source = repr((list(input_keys), sorted((k, repr(v)) for k, v in (kwargs or {}).items())))
+            inputs = hashlib.blake2b(key_source.encode(), digest_size=20).hexdigest()
+        else:
+            inputs = call_fingerprint(func, args, kwargs or {}, self.sample_rows)
+        return {
+            "inputs": inputs,
+            # the whole module, so that changes in helper functions also trigger a rebuild
+            "code": code_version(func, whole_module=True),
+        }
+
+    def is_stale(self, name, outputs, state):
+        """
+        :param name: the name of the artifact
+        :param outputs: the files the artifact consists of
+        :param state: the result of state()
+        :return: whether the artifact needs to be rebuilt
+        """
+        entry = self.manifest.get(name)
+        if entry is None:
+            return True
+        if entry["inputs"] != state["inputs"] or entry["code"] != state["code"]:
+            return True
+        return not all(os.path.exists(path) for path in outputs)
+
+    def record(self, name, outputs, state, seconds, rebuilt=True):
+        """
+        Marks an artifact as up to date and persists the manifest.
+        :param name: the name of the artifact
+        :param outputs: the files the artifact consists of
+        :param state: the result of state()
+        :param seconds: how long the build took
+        :param rebuilt: False if the artifact was skipped
+        """
+        self.runs.append(
+            {"name": name, "rebuilt": rebuilt, "seconds": seconds, "outputs": list(outputs)}
+        )
+        if not rebuilt:
+            return
+        self.manifest[name] = {
+            **state,
+            "outputs": list(outputs),
+            "seconds": seconds,
+            "built_at": time.time(),
+        }
+        self.save()
+
+    def build(self, name, func, *args, outputs, force=False, **kwargs):
+        """
+        Calls func(*args, **kwargs) if the artifact is stale. The function is expected to write the output files
+        itself (use write_html/savefig from src.utils.plot_export, they write atomically).
+        :param name: the name of the artifact
+        :param func: the plot function
+        :param outputs: the files the function writes
+        :param force: rebuild even if nothing changed
+        :return: whether the artifact was rebuilt
+        """
+        state = self.state(func, args, kwargs)
+        if not force and not self.is_stale(name, outputs, state):
+            self.record(name, outputs, state, 0.0, rebuilt=False)
+            return False
+
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        self.record(name, outputs, state, time.perf_counter() - start)
+        return True
+
+    def save(self):
+        """
+        Writes the manifest (atomically, so an interrupted run can't corrupt it).
+        """
+        content = json.dumps(self.manifest, indent=2, sort_keys=True)
+        atomic_write(self.manifest_path, lambda f: f.write(content), binary=False)
+
+    def report(self):
+        """
+        :return: df with one row per build() call of this session: name, whether it was rebuilt and the seconds
+        """
+        return pd.DataFrame(self.runs, columns=["name", "rebuilt", "seconds", "outputs"])
@@ -0,0 +1,209 @@
+"""
+Progress reporting for the long running steps (csv loads, text scans, joins, geocoding, data generation).
+
+A progress callback is any callable that takes one event dict:
+
+    {
+        "stage": "load BA_ratings.csv",  # what is running
+        "done": 1200000, "total": 2700000, "unit": "bytes",  # total is None if unknown
+        "rows": 350000,  # rows processed so far (None if the stage doesn't count rows)
+        "elapsed": 12.1, "rate": 99173.5, "rows_per_second": 28925.6,  # per second, in unit and in rows
+        "eta": 15.1,  # seconds, None if unknown
+        "finished": False,
+        "time": 1734700000.0,  # wall clock, to detect stalls
+    }
+
+The functions that support it take a progress argument: None (the default) reports nothing, True renders a
+progress bar on stderr, and any other value is used as the callback (e.g. TerminalProgress() or
+JsonLinesProgress("progress.jsonl") for batch jobs).
+"""
+
+import json
+import sys
+import time
+
+
+class Tracker:
+    """
+    Tracks one stage and sends throttled events to a progress callback.
+
+    Example:
+        tracker = track(progress, "scan texts", total=len(df), unit="rows")
+        for chunk in chunks:
+            ...
+            tracker.update(len(chunk), rows=len(chunk))
+        tracker.close()
+    """
+
+    def __init__(self, callback, stage, total=None, unit="rows", min_interval=0.2):
+        """
+        :param callback: the progress callback (None: the tracker does nothing)
+        :param stage: the name of the stage
+        :param total: the total amount of work in unit (None if unknown)
+        :param unit: the unit of done and total
+        :param min_interval: minimal number of seconds between two events (the first and the last are always sent)
+        """
+        self.callback = callback
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.min_interval = min_interval
+        self.done = 0
+        self.rows = None
+        self.start = time.perf_counter()
+        self.last_event = None
+        self.finished = False
+        self._emit()
+
+    def update(self, done=1, rows=None):
+        """
+        :param done: the amount of work done since the last update, in unit
+        :param rows: the number of rows processed since the last update
+        """
+        self.done += done
+        if rows is not None:
+            self.rows = (self.rows or 0) + rows
+        if self.callback is not None and time.perf_counter() - self.last_event >= self.min_interval:
+            self._emit()
+
+    def close(self):
+        """
+        Marks the stage as finished and sends the last event.
+        """
+        if not self.finished:
+            self.finished = True
+            if self.total is not None:
+                self.done = max(self.done, self.total)
+            self._emit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _emit(self):
+        if self.callback is None:
+            return
+        now = time.perf_counter()
+        self.last_event = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else None
+        eta = None
+        if self.total is not None and rate:
+            eta = max(self.total - self.done, 0) / rate
+        self.callback(
+            {
+                "stage": self.stage,
+                "done": self.done,
+                "total": self.total,
+                "unit": self.unit,
+                "rows": self.rows,
+                "elapsed": elapsed,
+                "rate": rate,
+                "rows_per_second": self.rows / elapsed if self.rows is not None and elapsed > 0 else None,
+                "eta": eta,
+                "finished": self.finished,
+                "time": time.time(),
+            }
+        )
+
+
+def track(progress, stage, total=None, unit="rows", min_interval=0.2):
+    """
+    :param progress: the progress argument of the calling function (None, True or a callback)
+    :return: a Tracker for the stage (see Tracker for the other parameters)
+    """
+    return Tracker(resolve(progress), stage, total, unit, min_interval)
+
+
+def resolve(progress):
+    """
+    :param progress: None, True or a callback
+    :return: the callback to use (None for no reporting)
+    """
+    if progress is True:
+        return TerminalProgress()
+    if progress is None or progress is False:
+        return None
+    return progress
+
+
+def _format_number(value):
+    for limit, suffix in [(1e9, "G"), (1e6, "M"), (1e3, "k")]:
+        if abs(value) >= limit:
+            return f"{value / limit:.1f}{suffix}"
+    return f"{value:.0f}" if value == int(value) else f"{value:.1f}"
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+class TerminalProgress:
+    """
+    tqdm-style progress bar, one line per stage:
+
+        load BA_ratings.csv  45%|█████▍      | 1.2M/2.7M bytes [00:12<00:15, 99.2k bytes/s, 28.9k rows/s]
+    """
+
+    def __init__(self, stream=None, width=12):
+        """
+        :param stream: where the bar is written (default: stderr)
+        :param width: the number of characters of the bar
+        """
+        self.stream = stream
+        self.width = width
+        self._length = 0
+
+    def __call__(self, event):
+        stream = self.stream or sys.stderr
+        parts = [event["stage"]]
+        if event["total"]:
+            fraction = min(event["done"] / event["total"], 1.0)
+            filled = fraction * self.width
+            bar = "█" * int(filled)
+            if int(filled) < self.width:
+                bar += " ▏▎▍▌▋▊▉"[int((filled - int(filled)) * 8)] + " " * (self.width - int(filled) - 1)
+            parts.append(f"{fraction:4.0%}|{bar}| {_format_number(event['done'])}/{_format_number(event['total'])}")
+        else:
+            parts.append(_format_number(event["done"]))
+        details = [_format_seconds(event["elapsed"])]
+        if event["eta"] is not None and not event["finished"]:
+            details[0] += "<" + _format_seconds(event["eta"])
+        if event["rate"] is not None:
+            details.append(f"{_format_number(event['rate'])} {event['unit']}/s")
+        if event["rows_per_second"] is not None and event["unit"] != "rows":
+            details.append(f"{_format_number(event['rows_per_second'])} rows/s")
+        line = f"{' '.join(parts)} {event['unit']} [{', '.join(details)}]"
+        # padded, so that a shorter line fully overwrites the previous one
+        stream.write("\r" + line.ljust(self._length) + ("\n" if event["finished"] else ""))
+        self._length = 0 if event["finished"] else len(line)
+        stream.flush()
+
+
+class JsonLinesProgress:
+    """
+    Machine-readable sink: every event as one line of JSON, e.g. for batch jobs that detect stalls (no new line
+    for a while) or estimate time budgets from the rates.
+    """
+
+    def __init__(self, path=None, stream=None):
+        """
+        :param path: the file the events are appended to
+        :param stream: alternatively an open text stream (default: stdout)
+        """
+        self.path = path
+        self.stream = stream
+
+    def __call__(self, event):
+        line = json.dumps(event) + "\n"
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(line)
+        else:
+            stream = self.stream or sys.stdout
+            stream.write(line)
+            stream.flush()
@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+
+from src.utils.plot_export import _decode, _encode, compact_figure
+
+
+def _written_trace(fig):
+    # the first trace as plotly.js gets it, with the typed arrays decoded
+    trace = json.loads(pio.to_json(compact_figure(fig), validate=False))["data"][0]
+    return {k: _decode(v).tolist() if isinstance(v, dict) and "bdata" in v else v for k, v in trace.items()}
+
+
+def test_datetime_axis_keeps_its_dates():
+    dates = pd.date_range("2020-01-01", periods=3, freq="MS")
+    trace = _written_trace(go.Figure(go.Scatter(x=dates, y=np.array([1.0, 2.0, 3.0]))))
+    assert trace["x"] == [date.isoformat() for date in dates]
+
+
+def test_small_values_keep_significant_digits():
+    values = np.array([1.23456e-7, 3e-6, 0.5, 2.123456])
+    trace = _written_trace(go.Figure(go.Scatter(x=np.arange(4), y=values)))
+    np.testing.assert_allclose(trace["y"], [1.235e-7, 3e-6, 0.5, 2.1235], rtol=1e-6)
+    scalar = compact_figure(go.Figure(go.Scatter(x=[0, 1], y=[4.2e-8, 1.0])))["data"][0]["y"]
+    assert scalar[0] == 4.2e-8
+
+
+def test_large_integral_floats_are_not_cast_to_int64():
+    values = np.array([1e20, 2e20])
+    assert np.array_equal(_decode(_encode(values, 4, True)), values)